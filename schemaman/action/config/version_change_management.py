@@ -26,6 +26,22 @@ def Action(connection_data, action_input_args):
   if data == None:
     return '\nAborting configuration...'
   
+  request = datasource.Request(connection_data, connection_data['owner_user'], 'auth')
+  
+  # Create the indexes the version history lookups use
+  created_indexes = datasource.CreateVersionIndexes(request)
+  
+  for index in created_indexes:
+    print 'Created index: %s' % index
+  
+  # The 'record' working version storage mode keeps each working record in its own row, in its own table
+  handler = datasource.DetermineHandlerModule(request)
+  
+  if datasource.GetWorkingVersionStorage(request) == handler.WORKING_VERSION_STORAGE_RECORD:
+    datasource.CreateWorkingRecordTable(request)
+    
+    print 'Ensured working record table exists'
+  
   return 'Configured Version Management'
 
 
@@ -90,10 +90,8 @@ def Action(connection_data, action_input_args):
       print 'Populating Schema for Field: %s: %s' % (table, field)
     
       field_record = {'name':field, 'schema_table_id':schema_table_id}
-      schema_field_list = datasource.Filter(target_request, data['table_field'], field_record)
-      
       # If we dont have this table, create it
-      if not schema_field_list:
+      if not datasource.Exists(target_request, data['table_field'], field_record):
         # Determine the Value Type ID
         #TODO(g): This isnt always part of the process...  We need some other way to do this update, and a post-script or something...?
         if field_data['type'] == 'int':
@@ -110,6 +110,13 @@ def ProcessAction(action, action_args, command_options):
         result = action_module.test.test_vmcm.Action(connection_data, action_input_args)
         print result
       
+      elif action_args[2] == 'benchmark_version_codec':
+        result = action_module.test.benchmark_version_codec.Action(connection_data, action_input_args)
+      
+      elif action_args[2] == 'tools':
+        result = action_module.test.test_tools.Action(connection_data, action_input_args)
+        print result
+      
       else:
         Usage('Unknown Action in Category: %s: %s' % (action_args[1], action_args[2]))
     
@@ -254,12 +261,67 @@ def ProcessAction(action, action_args, command_options):
   # Else, if Action prefix is Data
   elif action == 'data':
     if len(action_args) == 0:
-      Usage('"data" action requires arguments: export, import')
+      Usage('"data" action requires arguments: export, import, migrate')
     elif action_args[0] == 'export':
-      result = datasource.ExportData()
+      if len(action_args) < 3:
+        Usage('"data export" action requires arguments: <path to connection spec> <path to export directory>')
+      
+      connection_data = datasource.LoadConnectionSpec(action_args[1])
+      
+      target_path = action_args[2]
+      
+      request = datasource.Request(connection_data, connection_data['owner_user'], 'auth')
+      
+      result = datasource.ExportData(request, target_path, compress=command_options.get('gzip', False), parallel=command_options.get('parallel', 1))
+      
+      print '\nExported Data: %s\n' % target_path
+      
+      for (table, row_count) in sorted(result.items()):
+        print '  %s: %s rows' % (table, row_count)
     
     elif action_args[0] == 'import':
-      result = datasource.ImportData()
+      if len(action_args) < 3:
+        Usage('"data import" action requires arguments: <path to connection spec> <path to import directory>')
+      
+      connection_data = datasource.LoadConnectionSpec(action_args[1])
+      
+      source_path = action_args[2]
+      
+      if not os.path.isdir(source_path):
+        Usage('Path specified is not a directory: %s' % source_path)
+      
+      request = datasource.Request(connection_data, connection_data['owner_user'], 'auth')
+      
+      result = datasource.ImportData(request, source_path, parallel=command_options.get('parallel', 1))
+      
+      print '\nImported Data: %s\n' % source_path
+      
+      for (table, row_count) in sorted(result.items()):
+        print '  %s: %s rows' % (table, row_count)
+    
+    # Copy all the data from one datasource to another
+    elif action_args[0] == 'migrate':
+      if len(action_args) < 3:
+        Usage('"data migrate" action requires arguments: <path to source connection spec> <path to target connection spec> [path to checkpoint file]')
+      
+      source_connection_data = datasource.LoadConnectionSpec(action_args[1])
+      target_connection_data = datasource.LoadConnectionSpec(action_args[2])
+      
+      # Keep a checkpoint, so an interrupted migration can be resumed by running it again
+      if len(action_args) >= 4:
+        checkpoint_path = action_args[3]
+      else:
+        checkpoint_path = 'migrate__%s__%s.checkpoint.yaml' % (source_connection_data['alias'], target_connection_data['alias'])
+      
+      source_request = datasource.Request(source_connection_data, source_connection_data['owner_user'], 'auth')
+      target_request = datasource.Request(target_connection_data, target_connection_data['owner_user'], 'auth')
+      
+      result = datasource.MigrateData(source_request, target_request, checkpoint_path=checkpoint_path)
+      
+      print '\nMigrated Data: %s -> %s\n' % (source_connection_data['alias'], target_connection_data['alias'])
+      
+      for (table, row_count) in sorted(result.items()):
+        print '  %s: %s rows' % (table, row_count)
     
     # ERROR
     else:
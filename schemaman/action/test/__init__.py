@@ -1,2 +1,5 @@
 import test_vmcm
 
+import benchmark_version_codec
+
+import test_tools
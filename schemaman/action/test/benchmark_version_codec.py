@@ -0,0 +1,102 @@
+"""
+Actions: Test: Benchmark Version Codec
+
+Time dumping and loading version data (the version_* `data_yaml` fields) with each codec, on generated working sets.
+Does not use the datasource, so it is safe to run against any connection spec.
+"""
+
+
+import datetime
+import decimal
+import time
+
+# SchemaMan libraries
+from schemaman.utility.log import Log
+import schemaman.datasource.tools as tools
+
+
+# This action's command on the CLI and also in the connection_data.actions dict as a key for our data
+ACTION = 'test__benchmark_version_codec'
+
+# Working set sizes (number of changed records) to benchmark, if none are given
+DEFAULT_RECORD_COUNTS = [10, 1000, 10000]
+
+# Codecs to benchmark.  YAML is the format version data was stored in before there were codecs.
+BENCHMARK_CODECS = ['yaml'] + sorted(tools.VERSION_CODECS.keys())
+
+# Number of times to dump and load each working set, to average the times over
+DEFAULT_REPEAT = 3
+
+
+def Action(connection_data, action_input_args):
+  """Perform action: Benchmark Version Codec.  Optional args are working set sizes (number of changed records)."""
+  print 'Benchmark Version Codec'
+  
+  if action_input_args:
+    record_counts = [int(arg) for arg in action_input_args]
+  else:
+    record_counts = DEFAULT_RECORD_COUNTS
+  
+  results = []
+  
+  for record_count in record_counts:
+    version_data = GenerateWorkingSet(record_count)
+  
+    for codec in BENCHMARK_CODECS:
+      result = BenchmarkCodec(version_data, codec)
+      result['records'] = record_count
+      results.append(result)
+  
+      print '  Records: %7d  Codec: %-6s  Size: %10d bytes  Dump: %9.2f ms  Load: %9.2f ms' % \
+          (record_count, codec, result['size'], result['dump_ms'], result['load_ms'])
+  
+  return results
+
+
+def BenchmarkCodec(version_data, codec, repeat=DEFAULT_REPEAT):
+  """Returns dict, the encoded size and average dump and load times (ms) of the version data with this codec"""
+  start = time.time()
+  for count in range(0, repeat):
+    text = tools.DumpVersionData(version_data, codec=codec)
+  dump_ms = (time.time() - start) * 1000.0 / repeat
+  
+  start = time.time()
+  for count in range(0, repeat):
+    loaded = tools.LoadVersionData(text, {})
+  load_ms = (time.time() - start) * 1000.0 / repeat
+  
+  # Make sure we got back what we put in, or the times dont mean anything
+  if loaded != version_data:
+    Log('Benchmark Version Codec: %s: Loaded data does not match dumped data' % codec)
+  
+  return {'codec': codec, 'size': len(text), 'dump_ms': dump_ms, 'load_ms': load_ms}
+
+
+def GenerateWorkingSet(record_count, schema_id=1, table_count=5):
+  """Returns dict, version data (schema_id -> schema_table_id -> record_id -> record) with record_count changed records.
+  
+  Records look like host records: names, foreign keys, text, a timestamp and a decimal.  Some are new (negative ids).
+  """
+  version_data = {schema_id: {}}
+  
+  for count in range(0, record_count):
+    schema_table_id = 10 + (count % table_count)
+  
+    # Every 10th record is a new record
+    if count % 10 == 0:
+      record_id = -(count + 1)
+    else:
+      record_id = count + 1
+  
+    record = {
+      'name': 'host%05d.example.com' % count,
+      'owner_group_id': count % 50,
+      'parent_id': None,
+      'description': 'Generated record %s for the version codec benchmark' % count,
+      'created': datetime.datetime(2016, 1, 1, 12, 0, 0) + datetime.timedelta(seconds=count),
+      'cost': decimal.Decimal('%d.25' % count),
+    }
+  
+    version_data[schema_id].setdefault(schema_table_id, {})[record_id] = record
+  
+  return version_data
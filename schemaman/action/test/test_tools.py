@@ -0,0 +1,230 @@
+"""
+Actions: Test: Test Tools
+
+Unit tests of the datasource tools that dont need a database: commit planning, version data codecs, version diffs,
+filter matching and data formatting.  Does not use the datasource, so it is safe to run against any connection spec.
+
+Also runs with: python -m unittest schemaman.action.test.test_tools
+"""
+
+
+import datetime
+import decimal
+import json
+import unittest
+
+# SchemaMan libraries
+import schemaman.datasource.tools as tools
+
+
+# This action's command on the CLI and also in the connection_data.actions dict as a key for our data
+ACTION = 'test__test_tools'
+
+
+def Action(connection_data, action_input_args):
+  """Perform action: Test Tools"""
+  print 'Test Tools'
+
+  suite = unittest.defaultTestLoader.loadTestsFromName(__name__)
+
+  result = unittest.TextTestRunner(verbosity=2).run(suite)
+
+  if not result.wasSuccessful():
+    return 'Tools tests failed: %s failures, %s errors' % (len(result.failures), len(result.errors))
+
+  return 'Tools tests passed: %s tests' % result.testsRun
+
+
+class CommitPlannerTest(unittest.TestCase):
+  """tools.PlanCommitLevels() and friends"""
+
+  def testLevels(self):
+    # host references owner_group, host_ip references host
+    dependencies = {'host': {'owner_group': 'owner_group_id'}, 'host_ip': {'host': 'host_id'}}
+
+    levels = tools.PlanCommitLevels(['host_ip', 'host', 'owner_group', 'other'], dependencies)
+
+    self.assertEqual(levels, [['owner_group', 'other'], ['host'], ['host_ip']])
+
+
+  def testOrderKeepsPositionsWithinLevel(self):
+    dependencies = {'c': {'a': 'a_id'}, 'b': {'a': 'a_id'}}
+
+    self.assertEqual(tools.PlanCommitOrder(['c', 'a', 'b'], dependencies), ['a', 'c', 'b'])
+
+
+  def testIgnoresOutsideAndSelfDependencies(self):
+    dependencies = {'a': {'a': 'parent_id', 'missing': 'missing_id'}}
+
+    self.assertEqual(tools.PlanCommitLevels(['a'], dependencies), [['a']])
+
+
+  def testDeleteOrder(self):
+    dependencies = {'host': {'owner_group': 'owner_group_id'}}
+
+    self.assertEqual(tools.PlanDeleteOrder(['owner_group', 'host'], dependencies), ['host', 'owner_group'])
+
+
+  def testCycle(self):
+    # d only depends on the cycle, so it is blocked, but not part of it
+    dependencies = {'a': {'b': 'b_id'}, 'b': {'c': 'c_id'}, 'c': {'a': 'a_id'}, 'd': {'a': 'a_id'}}
+
+    try:
+      tools.PlanCommitLevels(['d', 'a', 'b', 'c', 'e'], dependencies)
+      self.fail('Expected DependencyCycle')
+
+    except tools.DependencyCycle, e:
+      self.assertEqual(e.blocked, ['d', 'a', 'b', 'c'])
+      self.assertEqual(e.cycle, [('a', 'b_id'), ('b', 'c_id'), ('c', 'a_id')])
+      self.assertTrue('a.b_id -> b.c_id -> c.a_id -> a' in str(e))
+
+
+class VersionCodecTest(unittest.TestCase):
+  """tools.DumpVersionData() and tools.LoadVersionData()"""
+
+  def assertRoundTrip(self, data, codec=tools.DEFAULT_VERSION_CODEC, **load_args):
+    text = tools.DumpVersionData(data, codec=codec)
+
+    self.assertEqual(tools.LoadVersionData(text, {}, **load_args), data)
+
+
+  def testIntKeys(self):
+    self.assertRoundTrip({1: {10: {-5: {'name': 'new'}, 7: {'name': 'changed'}}}})
+    self.assertRoundTrip({1: {10: [3, 4]}})
+
+
+  def testFieldValuesKeepStringKeys(self):
+    self.assertRoundTrip({1: {10: {5: {'data': {'10': 1, '-2': {'3': 4}}}}}})
+
+
+  def testSingleRecordKeepsStringKeys(self):
+    self.assertRoundTrip({'10': 'a', 'name': {'20': 2}}, int_key_levels=0)
+
+
+  def testTaggedValues(self):
+    record = {'created': datetime.datetime(2015, 6, 7, 8, 9, 10, 11), 'day': datetime.date(2015, 6, 7),
+              'duration': datetime.timedelta(days=1, hours=2, microseconds=3), 'negative': -datetime.timedelta(seconds=5),
+              'price': decimal.Decimal('10.50'), 'missing': None}
+
+    self.assertRoundTrip({1: {10: {5: record}}})
+
+
+  def testDatesBefore1900(self):
+    record = {'born': datetime.date(1850, 1, 2), 'at': datetime.datetime(1066, 10, 14, 9, 0, 0)}
+
+    self.assertRoundTrip({1: {10: {5: record}}})
+
+
+  def testBinaryStrings(self):
+    record = {'blob': '\xff\xfe\x00\x01', 'text': 'plain'}
+
+    self.assertRoundTrip({1: {10: {5: record}}})
+
+
+  def testYamlStillLoads(self):
+    self.assertRoundTrip({1: {10: {5: {'name': 'yaml'}}}}, codec='yaml')
+
+
+  def testEmpty(self):
+    self.assertEqual(tools.LoadVersionData(None, {}), {})
+    self.assertEqual(tools.LoadVersionData('', {}), {})
+
+
+  def testUnknownCodec(self):
+    self.assertRaises(tools.UnknownVersionCodec, tools.DumpVersionData, {}, codec='nope')
+
+
+class VersionDiffTest(unittest.TestCase):
+  """tools.DiffRecordImages()"""
+
+  def testInsert(self):
+    self.assertEqual(tools.DiffRecordImages(None, {'id': 1, 'name': 'a'}),
+                     (tools.DIFF_INSERT, {'id': (None, 1), 'name': (None, 'a')}))
+
+
+  def testUpdateOnlyChangedFields(self):
+    self.assertEqual(tools.DiffRecordImages({'id': 1, 'name': 'a', 'size': 2}, {'id': 1, 'name': 'b', 'size': 2}),
+                     (tools.DIFF_UPDATE, {'name': ('a', 'b')}))
+
+
+  def testDelete(self):
+    self.assertEqual(tools.DiffRecordImages({'id': 1}, None), (tools.DIFF_DELETE, {'id': (1, None)}))
+
+
+  def testUnchanged(self):
+    self.assertEqual(tools.DiffRecordImages({'id': 1, 'name': 'a'}, {'id': 1, 'name': 'a'}), None)
+    self.assertEqual(tools.DiffRecordImages(None, None), None)
+
+
+class FilterMatchTest(unittest.TestCase):
+  """tools.CompileFilter()"""
+
+  def assertMatches(self, data, record, expected=True):
+    self.assertEqual(tools.CompileFilter(data)(record), expected)
+
+
+  def testEquality(self):
+    self.assertMatches({'name': 'a'}, {'name': 'a'})
+    self.assertMatches({'name': 'a'}, {'name': 'b'}, False)
+    self.assertMatches({'name': 'a'}, {'other': 'a'}, False)
+    self.assertMatches({}, {'name': 'a'})
+
+
+  def testNoneValuesAreSkipped(self):
+    self.assertMatches({'name': None}, {'name': 'a'})
+
+
+  def testIn(self):
+    self.assertMatches({'id': ('IN', [1, 2])}, {'id': 2})
+    self.assertMatches({'id': ('NOT IN', [1, 2])}, {'id': 2}, False)
+    self.assertMatches({'id': ('NOT IN', [1, 2])}, {'id': None}, False)
+
+
+  def testComparisons(self):
+    self.assertMatches({'id': ('>', 2)}, {'id': 3})
+    self.assertMatches({'id': ('<=', 2)}, {'id': 3}, False)
+    self.assertMatches({'id': ('>', 2)}, {'id': None}, False)
+    self.assertMatches({'id': ('BETWEEN', 2, 4)}, {'id': 4})
+    self.assertMatches({'id': ('BETWEEN', 2, 4)}, {'id': 5}, False)
+
+
+  def testLike(self):
+    self.assertMatches({'name': ('LIKE', 'web%')}, {'name': 'WEB01'})
+    self.assertMatches({'name': ('LIKE', 'web_')}, {'name': 'web01'}, False)
+    self.assertMatches({'name': ('LIKE', '100\\%')}, {'name': '100%'})
+    self.assertMatches({'name': ('NOT LIKE', 'web%')}, {'name': 'db01'})
+
+
+  def testNull(self):
+    self.assertMatches({'name': ('IS', 'NULL')}, {'name': None})
+    self.assertMatches({'name': ('IS', 'NOT', 'NULL')}, {'name': None}, False)
+
+
+  def testUnknownDirective(self):
+    self.assertRaises(tools.UnknownFilterDirective, tools.CompileFilter, {'name': ('NEAR', 'a')})
+
+
+class DataFormatTest(unittest.TestCase):
+  """tools.FormatJsonLine(), tools.ParseJsonLine() and page cursors"""
+
+  def testJsonLineRoundTrip(self):
+    row = {'id': 1, 'name': u'host', 'blob': '\x00\xff', 'missing': None}
+
+    self.assertEqual(tools.ParseJsonLine(tools.FormatJsonLine(row)), row)
+    self.assertEqual(tools.ParseJsonLine('  \n'), None)
+
+
+  def testJsonLineValuesMySQLAccepts(self):
+    row = {'at': datetime.datetime(2015, 6, 7, 8, 9, 10), 'price': decimal.Decimal('1.50'),
+           'long': datetime.timedelta(days=1, hours=2), 'short': -datetime.timedelta(minutes=1, microseconds=5)}
+
+    self.assertEqual(json.loads(tools.FormatJsonLine(row)), {'at': '2015-06-07 08:09:10', 'price': '1.50',
+                                                             'long': '26:00:00', 'short': '-00:01:00.000005'})
+
+
+  def testPageCursor(self):
+    cursor = tools.FormatPageCursor('id', 100)
+
+    self.assertEqual(tools.ParsePageCursor(cursor, 'id'), 100)
+    self.assertRaises(tools.InvalidPageCursor, tools.ParsePageCursor, cursor, 'name')
+    self.assertRaises(tools.InvalidPageCursor, tools.ParsePageCursor, 'not a cursor', 'id')
@@ -5,4 +5,9 @@ Datasource Module
 from generic_handler import *
 
 import cache
+import query_cache
+import working_version_cache
+import version_commit_cache
+import lock_manager
+import negative_id_allocator
 
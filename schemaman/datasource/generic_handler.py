@@ -4,6 +4,7 @@
 import os
 import threading
 import time
+import Queue
 from operator import itemgetter
 
 from schemaman.utility.error import *
@@ -14,9 +15,20 @@ from schemaman.utility.log import Log
 # Schema Datasource functions
 from request import Request
 import tools
+import working_version_cache
+import lock_manager
+import negative_id_allocator
 
 print tools
 
+
+# Number of row batches the MigrateData() reader can get ahead of the writer
+DEFAULT_MIGRATE_QUEUE_SIZE = 10
+
+# Number of rows per page for FilterPages() and FilterIter()
+DEFAULT_PAGE_SIZE = 1000
+
+
 class RecordNotFound(Exception):
   """An expected record was not found."""
 
@@ -141,34 +153,371 @@ def UpdateSchema(request, schema):
   return result
 
 
-def ExportData(request, path):
-  """Export/dump data from this datasource, based on spec, or everything"""
+def ExportData(request, path, compress=False, tables=None, parallel=1):
+  """Export/dump data from this datasource, based on spec, or everything.
+  
+  Each table is streamed into its own JSON Lines file (one row per line) inside the path directory,
+  so exporting uses constant memory no matter how large the tables are.
+  
+  With parallel > 1, tables are exported by a pool of workers, each with its own Request (and so its own
+  pooled connection).  Large tables are split into `id` ranges, each written to its own part file.  Export
+  into an empty directory, as any existing data files for these tables will also be imported by ImportData().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    path: string, directory to write the table data files into
+    compress: boolean (default False), if True the data files are gzip compressed
+    tables: list of strings (default None), table names to export.  If None, all tables are exported.
+    parallel: int (default 1), number of workers to export with
+  
+  Returns: dict, keyed on table name (string), values are the number of rows exported (int)
+  """
   handler = DetermineHandlerModule(request)
   
-  result = handler.ExportData(request, path)
+  if parallel <= 1:
+    return handler.ExportData(request, path, compress=compress, tables=tables)
+  
+  # Ensure our output directory exists
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  
+  # If we werent told which tables to export, export all of them
+  if tables == None:
+    tables = handler.ListTables(request)
+  
+  # Create a task for each table, or each part of a large table
+  task_args_list = []
+  for table in tables:
+    ranges = handler.GetExportTableRanges(request, table, parallel)
+    
+    for (part, (start_after, end_at)) in enumerate(ranges):
+      # Only name the file by part, if we split the table into parts
+      if len(ranges) == 1:
+        part = None
+      
+      file_path = tools.GetDataFilePath(path, table, compress=compress, part=part)
+      
+      task_args_list.append((table, file_path, start_after, end_at))
+  
+  
+  def ExportTableTask(worker_request, table, file_path, start_after, end_at):
+    """Export a table (or part of one), with this worker's request"""
+    worker_handler = DetermineHandlerModule(worker_request)
+    
+    return worker_handler.ExportTable(worker_request, table, file_path, start_after=start_after, end_at=end_at)
+  
+  
+  row_counts = utility.worker_pool.RunWorkerPool(ExportTableTask, task_args_list, parallel, worker_setup=request.Clone, worker_teardown=Request.Release)
+  
+  # Total our rows for each table, over all their parts
+  result = {}
+  for (task_args, row_count) in zip(task_args_list, row_counts):
+    table = task_args[0]
+    result[table] = result.get(table, 0) + row_count
   
   return result
 
 
-def ImportData(request, drop_first=False, transaction=False):
+def ImportData(request, path, drop_first=False, transaction=False, tables=None, parallel=1):
   """Import/load data to this datasource, based on spec, or everything.
   
+  Reads the table data files written by ExportData() from the path directory.  Tables are imported in
+  dependency order (see GetTableDependencyLevels()), so referenced tables are loaded first.
+  
+  With parallel > 1, each dependency level is loaded by a pool of workers, each with its own Request (and so
+  its own pooled connection).  Tables in the same level (and the parts of a table) are loaded concurrently.
+  
   Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    path: string, directory to read the table data files from
     drop_first: boolean, optional: If true, all data is dropped/deleted before
         the import occurs, otherwise it is an update.  Defaults to false to
         preserve data.
     transaction: boolean, optional: If true, import is done as a single
         transaction.  Defaults to False to avoid extra memory and slowness.
+        Cannot be used with parallel, as each worker has its own connection.
+    tables: list of strings (default None), table names to import.  If None, all tables with data files are imported.
+    parallel: int (default 1), number of workers to import with
   
-  Returns: None
+  Returns: dict, keyed on table name (string), values are the number of rows imported (int)
   """
   handler = DetermineHandlerModule(request)
   
-  result = handler.ImportData(request, path)
+  if parallel <= 1:
+    return handler.ImportData(request, path, drop_first=drop_first, transaction=transaction, tables=tables)
+  
+  if transaction:
+    raise Exception('ImportData: A single transaction cannot be used with parallel workers: parallel=%s' % parallel)
+  
+  data_files = tools.ListDataFilePaths(path)
+  
+  # If we werent told which tables to import, import all of them
+  if tables == None:
+    tables = sorted(data_files.keys())
+  
+  # Get our tables in the order we need to import them
+  table_levels = GetTableDependencyLevels(request, tables)
+  
+  # Delete in reverse dependency order, so we remove referencing records first
+  if drop_first:
+    for table_level in reversed(table_levels):
+      for table in table_level:
+        handler.DeleteAll(request, table)
+  
+  
+  def ImportTableTask(worker_request, table, file_path):
+    """Import a table data file, with this worker's request"""
+    worker_handler = DetermineHandlerModule(worker_request)
+    
+    return worker_handler.ImportTable(worker_request, table, [file_path])
+  
+  
+  result = {}
+  
+  # Each level must be completely loaded before the next one, but everything in a level can be loaded together
+  for table_level in table_levels:
+    task_args_list = []
+    for table in table_level:
+      result[table] = 0
+      
+      for file_path in data_files.get(table, []):
+        task_args_list.append((table, file_path))
+    
+    row_counts = utility.worker_pool.RunWorkerPool(ImportTableTask, task_args_list, parallel, worker_setup=request.Clone, worker_teardown=Request.Release)
+    
+    # Total our rows for each table, over all their files
+    for (task_args, row_count) in zip(task_args_list, row_counts):
+      result[task_args[0]] += row_count
+  
+  return result
+
+
+def MigrateData(source_request, target_request, tables=None, checkpoint_path=None, queue_size=DEFAULT_MIGRATE_QUEUE_SIZE):
+  """Copy data from one datasource into another, streaming it through a reader and a writer thread.
+  
+  The reader thread pages through each source table with keyset pagination on `id`, and puts the batches of rows on
+  a bounded queue.  The writer thread takes them off and writes them into the target with multi-row upserts.  If the
+  writer falls behind, the reader waits for room on the queue, so memory use stays bounded.
+  
+  Tables are copied in dependency order (see GetTableDependencyLevels()).  After each batch is written, the last copied
+  `id` for its table is saved to checkpoint_path, so an interrupted migration can be run again to resume where it
+  stopped.  The checkpoint file is removed once the migration completes.
+  
+  Args:
+    source_request: Request Object, for the datasource to copy data from
+    target_request: Request Object, for the datasource to copy data into
+    tables: list of strings (default None), table names to copy.  If None, all source tables are copied.
+    checkpoint_path: string (default None), path to the checkpoint YAML file.  If None, no checkpoint is kept.
+    queue_size: int, number of batches the reader can get ahead of the writer
+  
+  Returns: dict, keyed on table name (string), values are the number of rows copied in this run (int)
+  """
+  source_handler = DetermineHandlerModule(source_request)
+  target_handler = DetermineHandlerModule(target_request)
+  
+  # If we werent told which tables to copy, copy all of them
+  if tables == None:
+    tables = source_handler.ListTables(source_request)
+  
+  # Flatten our dependency levels, as we copy a table at a time
+  ordered_tables = []
+  for table_level in GetTableDependencyLevels(source_request, tables):
+    ordered_tables += table_level
+  
+  # Get our progress from any previous run that was interrupted
+  checkpoint = LoadMigrateCheckpoint(checkpoint_path)
+  
+  result = {}
+  batch_queue = Queue.Queue(maxsize=queue_size)
+  reader_errors = []
+  writer_errors = []
+  
+  
+  def QueuePut(item):
+    """Put an item on the queue, waiting for room.  Returns boolean, False if the writer failed, so nothing will take it."""
+    while not writer_errors:
+      try:
+        batch_queue.put(item, timeout=1)
+        return True
+      
+      except Queue.Full:
+        pass
+    
+    return False
+  
+  
+  def Reader():
+    """Read batches of rows from the source tables and queue them for the writer.  Queues (table, None) when a table is finished."""
+    try:
+      for table in ordered_tables:
+        table_checkpoint = checkpoint.get(table, {})
+        
+        # Skip anything we already finished
+        if table_checkpoint.get('done'):
+          continue
+        
+        # If this table has no `id` field we cant page on it, so we get it in a single query
+        if 'id' in source_handler.GetTableFieldNames(source_request, table):
+          batches = source_handler.IterTableBatches(source_request, table, start_after=table_checkpoint.get('last_id'))
+        else:
+          Log('Migrate Data: %s: No `id` field, cannot page, copying in a single query' % table)
+          batches = [source_handler.Query(source_request, "SELECT * FROM `%s`" % table)]
+        
+        for rows in batches:
+          if rows and not QueuePut((table, rows)):
+            return
+        
+        if not QueuePut((table, None)):
+          return
+    
+    except Exception, e:
+      Log('Migrate Data: Reader failed: %s' % e)
+      reader_errors.append(e)
+    
+    finally:
+      # Tell the writer we are done
+      QueuePut(None)
+  
+  
+  def Writer():
+    """Write the queued batches of rows into the target, and checkpoint our progress after each one."""
+    try:
+      while True:
+        item = batch_queue.get()
+        
+        # The reader is done
+        if item == None:
+          break
+        
+        (table, rows) = item
+        
+        if table not in checkpoint:
+          checkpoint[table] = {'last_id': None, 'done': False}
+        
+        # The table is finished
+        if rows == None:
+          checkpoint[table]['done'] = True
+        
+        else:
+          target_handler.SetDirectBatch(target_request, table, rows)
+          
+          checkpoint[table]['last_id'] = rows[-1].get('id')
+          result[table] = result.get(table, 0) + len(rows)
+        
+        SaveMigrateCheckpoint(checkpoint_path, checkpoint)
+    
+    except Exception, e:
+      Log('Migrate Data: Writer failed: %s' % e)
+      writer_errors.append(e)
+  
+  
+  reader_thread = threading.Thread(target=Reader)
+  writer_thread = threading.Thread(target=Writer)
+  
+  reader_thread.start()
+  writer_thread.start()
+  
+  reader_thread.join()
+  writer_thread.join()
+  
+  if reader_errors or writer_errors:
+    raise Exception('Migrate Data: Failed, run again to resume from the checkpoint: %s: Reader: %s  Writer: %s' % (checkpoint_path, reader_errors, writer_errors))
+  
+  # We are done, so a new migration should start from the beginning
+  if checkpoint_path and os.path.isfile(checkpoint_path):
+    os.remove(checkpoint_path)
   
   return result
 
 
+def LoadMigrateCheckpoint(path):
+  """Returns dict, keyed on table name, values are dicts with 'last_id' and 'done'.  Empty if there is no checkpoint at path."""
+  if not path or not os.path.isfile(path):
+    return {}
+  
+  data = LoadYaml(path, use_cache=False)
+  
+  if not data:
+    data = {}
+  
+  Log('Migrate Data: Resuming from checkpoint: %s' % path)
+  
+  return data
+
+
+def SaveMigrateCheckpoint(path, checkpoint):
+  """Save the MigrateData() checkpoint to path.  Writes a temporary file and renames it, so we never leave a partial checkpoint."""
+  if not path:
+    return
+  
+  temp_path = '%s.tmp' % path
+  
+  SaveYaml(temp_path, checkpoint)
+  
+  os.rename(temp_path, path)
+
+
+def GetTableDependencyLevels(request, tables):
+  """Returns list of lists of strings, the tables grouped into levels that must be loaded in order.
+  
+  Dependencies are found from `*_id` fields, where the rest of the field name is another table (ex: `owner_group_id`
+  references `owner_group`).  See SortTablesByDependency().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    tables: list of strings, table names
+  
+  Returns: list of lists of strings, table names
+  """
+  handler = DetermineHandlerModule(request)
+  
+  table_fields = {}
+  for table in tables:
+    table_fields[table] = handler.GetTableFieldNames(request, table)
+  
+  return SortTablesByDependency(table_fields)
+
+
+def SortTablesByDependency(table_fields):
+  """Returns list of lists of strings, tables grouped into dependency levels.
+  
+  The first level has tables that dont reference any of the other tables, and each level after only references
+  tables in earlier levels.  Tables in the same level do not depend on each other, so they can be loaded together.
+  A reference is a `*_id` field, where the rest of the field name is another table in table_fields.  If there are
+  circular references, the tables left over are put together in a final level.
+  
+  Args:
+    table_fields: dict, keyed on table name (string), values are lists of field names (strings)
+  
+  Returns: list of lists of strings, table names
+  """
+  # Find the tables each table depends on
+  dependencies = {}
+  for (table, fields) in table_fields.items():
+    dependencies[table] = set()
+    
+    for field in fields:
+      if field.endswith('_id') and field[:-3] in table_fields and field[:-3] != table:
+        dependencies[table].add(field[:-3])
+  
+  levels = []
+  remaining = set(dependencies.keys())
+  
+  while remaining:
+    # Everything with no remaining dependencies can go in this level
+    level = sorted([table for table in remaining if not (dependencies[table] & remaining)])
+    
+    # Circular references, we cant order these, so put them all last
+    if not level:
+      Log('Sort Tables By Dependency: Circular references between tables: %s' % ', '.join(sorted(remaining)))
+      level = sorted(remaining)
+    
+    levels.append(level)
+    remaining -= set(level)
+  
+  return levels
+
+
 def GetInfoSchema(request):
   """Returns the record for this schema data (schema)"""
   handler = DetermineHandlerModule(request)
@@ -220,6 +569,18 @@ def GetInfoSchemaTableField(request, schema_table, field_name):
   return result
 
 
+def GetForeignKeyGraph(request):
+  """Returns dict, the references between the tables of this schema.  Cached.
+  
+  From the database's foreign keys, or for tables without any, the `<table>_id` and `parent_id` naming convention.
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.GetForeignKeyGraph(request)
+  
+  return result
+
+
 def GetUser(request, username=None, use_cache=True):
   """Returns user record (dict)"""
   handler = DetermineHandlerModule(request)
@@ -245,7 +606,7 @@ def GetUserById(request, user_id, use_cache=True):
   return user
 
 
-def RecordVersionsAvailable(request, table, record_id, username=None):
+def RecordVersionsAvailable(request, table, record_id, username=None, limit=None, row_offset=None):
   """List all of the historical and currently available versions available for this record.
   
   Looks at 3 tables to figure this out: version_changelist_log (un-commited changes),
@@ -258,15 +619,17 @@ def RecordVersionsAvailable(request, table, record_id, username=None):
     record_id: int, primary key (ex: `id`) of the record in this table.  Use Filter() to use other field values
     username: string (default None), if not None, this is a specific user to check versions.  Otherwise the
         request.username is used.
+    limit: int (default None), if not None, the most versions to return, for paging through long histories
+    row_offset: int (default None), if not None, the number of versions to skip.  Requires limit.
     
-  Returns: ...tbd...
+  Returns: list of dicts, dicts have 'id' and 'name' fields
   """
   handler = DetermineHandlerModule(request)
   
   # Get the user's ID
   user = GetUser(request, username)
   
-  result = handler.RecordVersionsAvailable(request, table, record_id, user=user)
+  result = handler.RecordVersionsAvailable(request, table, record_id, user=user, limit=limit, row_offset=row_offset)
   
   return result
 
@@ -357,6 +720,15 @@ def AbandonChangeList(request, change_list_id):
   return result
 
 
+def Begin(request):
+  """Begin a datasource transaction, even if the request auto-commits.  Returns boolean, True if a new transaction was begun."""
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.Begin(request)
+  
+  return result
+
+
 def Commit(request):
   """Commit a datasource transaction that is in the middle of a transaction."""
   handler = DetermineHandlerModule(request)
@@ -424,7 +796,7 @@ def SetDirect(request, table, data, commit=True):
   return result
 
 
-def SetVersion(request, table, data, commit_version=False, version_number=None, version_data=None, commit=True):
+def SetVersion(request, table, data, commit_version=False, version_number=None, version_data=None, commit=True, real_records=None):
   """Put (insert/update) data into this datasource's Version Management tables (working, unless version_number is specified).
   
   This is the same as Set() except version_managament=True, which is more explicit.  This should be easier to read and type,
@@ -438,11 +810,19 @@ def SetVersion(request, table, data, commit_version=False, version_number=None,
         been stored in version_change as a single record update, without any additional VMCM actions
     version_number: int (default None), if an int, this is the version number in the version_change table to write to,
         if None this will create a new version_working entry
+    real_records: dict (default None), if not None, the Real records of this table already fetched by GetRealRecords(),
+        record_id -> record, so we dont query the Real record to compare against.  Records not in it dont exist.
   
   Returns: int or None, if creating a new record this returns the newly created record primary key (ex: `id`), otherwise None
   """
   Log('Set Version: %s: %s' % (table, data))
   
+  handler = DetermineHandlerModule(request)
+  
+  # Each working record is its own row, so the handler only needs to write this record's row
+  if not version_number and version_data is None and GetWorkingVersionStorage(request) == handler.WORKING_VERSION_STORAGE_RECORD:
+    return handler.SetWorkingRecord(request, table, data, real_records=real_records)
+  
   (schema, schema_table) = GetInfoSchemaAndTable(request, table)
   
   user = GetUser(request)
@@ -467,9 +847,12 @@ def SetVersion(request, table, data, commit_version=False, version_number=None,
       if version_number:
         raise Exception('Unable to get version data for version=%s' % version_number)
     
-    if version_working:
-      change = utility.path.LoadYamlFromString(version_working['data_yaml'])
-      delete_change = utility.path.LoadYamlFromString(version_working['delete_data_yaml'])
+    if version_working and not version_number:
+      (change, delete_change) = working_version_cache.LoadWorkingVersionData(request, version_working['user_id'], version_working['data_yaml'], version_working['delete_data_yaml'])
+    
+    elif version_working:
+      change = tools.LoadVersionData(version_working['data_yaml'])
+      delete_change = tools.LoadVersionData(version_working['delete_data_yaml'])
       
       if not change:
         change = {}
@@ -516,7 +899,10 @@ def SetVersion(request, table, data, commit_version=False, version_number=None,
  
 
   # Get the Real record (if it exists), so we only store fields that are different.  If all fields are the same, we store nothing
-  real_record = Get(request, table, data['id'], use_working_version=False)
+  if real_records != None:
+    real_record = real_records.get(data['id'])
+  else:
+    real_record = Get(request, table, data['id'], use_working_version=False)
   
   # If we have a Real record, then remove any matching fields
   if real_record:
@@ -539,10 +925,14 @@ def SetVersion(request, table, data, commit_version=False, version_number=None,
   # Save the change version_working
   if commit:
     # Put this change record back into the version_change table, so it's saved
-    version_working['data_yaml'] = utility.path.DumpYamlAsString(change)
-    version_working['delete_data_yaml'] = utility.path.DumpYamlAsString(delete_change)
+    version_working['data_yaml'] = tools.DumpVersionData(change)
+    version_working['delete_data_yaml'] = tools.DumpVersionData(delete_change)
     result_record = SetDirect(request, version_table, version_working)
     
+    # Cache what we wrote, so it doesnt need to be parsed again
+    if not version_number:
+      working_version_cache.StoreWorkingVersionData(request, version_working['user_id'], version_working['data_yaml'], version_working['delete_data_yaml'], change, delete_change)
+    
     return result_record
   else:
     return
@@ -610,11 +1000,22 @@ def SetFromUdnDict(request, data, version_number=None, use_working_version=True)
       del records[record_key]
   
   
+  # Get the Real records we are versioning with one query per table, instead of SetVersion() getting them one at a time
+  real_records = {}
+  if use_working_version:
+    real_records = GetRealRecords(request, records.keys())
+  
   import pprint
   print '\n\nSet UDN Records:\n%s\n' % pprint.pformat(records)
   print '\nSet UDN Delete Records:\n%s\n\n' % pprint.pformat(delete_records)
   
-  if use_working_version:
+  # Each working record is its own row, so every Set and Delete writes its own row, and there is no version data to pass down
+  handler = DetermineHandlerModule(request)
+  record_storage = use_working_version and version_number == None and GetWorkingVersionStorage(request) == handler.WORKING_VERSION_STORAGE_RECORD
+  
+  version_data = None
+  
+  if use_working_version and not record_storage:
     user = GetUser(request)
     #TODO(t): inner method to do this?
     version_working_list = Filter(request, 'version_working', {'user_id': user['id']})
@@ -622,12 +1023,7 @@ def SetFromUdnDict(request, data, version_number=None, use_working_version=True)
       version_working = version_working_list[0]
     else:
       version_working = {'data_yaml': '', 'delete_data_yaml': '', 'user_id': user['id']}
-    update_data = utility.path.LoadYamlFromString(version_working['data_yaml'])
-    delete_data = utility.path.LoadYamlFromString(version_working['delete_data_yaml'])
-    if update_data is None:
-      update_data = {}
-    if delete_data is None:
-      delete_data = {}
+    (update_data, delete_data) = working_version_cache.LoadWorkingVersionData(request, user['id'], version_working['data_yaml'], version_working['delete_data_yaml'])
 
     # We need to create a tuple to pass down to the lower layers to avoid needing to do serialization all the time
     version_data = (version_working, update_data, delete_data)
@@ -641,7 +1037,7 @@ def SetFromUdnDict(request, data, version_number=None, use_working_version=True)
       Set(request, table, record)
       
     else:
-      SetVersion(request, table, record, version_number=version_number, version_data=version_data, commit=False)
+      SetVersion(request, table, record, version_number=version_number, version_data=version_data, commit=record_storage, real_records=real_records[table])
   
   # Delete our specified data items
   for (table, record_id) in delete_records:
@@ -649,15 +1045,44 @@ def SetFromUdnDict(request, data, version_number=None, use_working_version=True)
       Delete(request, table, record_id)
       
     else:
-      DeleteVersion(request, table, record_id, version_number=version_number, version_data=version_data, commit=False)
+      DeleteVersion(request, table, record_id, version_number=version_number, version_data=version_data, commit=record_storage)
 
   # At the end, if we where working on working version, update the version_working
-  if use_working_version:
-    version_working['data_yaml'] = utility.path.DumpYamlAsString(update_data)
-    version_working['delete_data_yaml'] = utility.path.DumpYamlAsString(delete_data) 
+  if use_working_version and not record_storage:
+    version_working['data_yaml'] = tools.DumpVersionData(update_data)
+    version_working['delete_data_yaml'] = tools.DumpVersionData(delete_data) 
     Set(request, 'version_working', version_working)
+    
+    working_version_cache.StoreWorkingVersionData(request, user['id'], version_working['data_yaml'], version_working['delete_data_yaml'], update_data, delete_data)
 
-def Get(request, table, record_id, version_number=None, use_working_version=True):
+def GetRealRecords(request, record_keys):
+  """Returns dict of dicts, table -> record_id -> Real record (table data, without version data), for these records.
+  
+  Records are selected with one query per table (Filter() splits very large id lists).  Records that dont exist are not
+  in their table's dict, but every table is.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    record_keys: list of tuples, (table, record_id)
+  
+  Returns: dict of dicts
+  """
+  table_record_ids = {}
+  for (table, record_id) in record_keys:
+    table_record_ids.setdefault(table, set()).add(record_id)
+  
+  real_records = {}
+  
+  for (table, record_ids) in table_record_ids.items():
+    real_records[table] = {}
+    
+    for record in Filter(request, table, {'id': ('IN', sorted(record_ids))}, use_working_version=False):
+      real_records[table][record['id']] = record
+  
+  return real_records
+
+
+def Get(request, table, record_id, version_number=None, use_working_version=True, fields=None, use_cache=False):
   """Get (select single record) from this datasource.
   
   Can be a 'view', combining several lower level 'tables'.
@@ -670,12 +1095,17 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
         tables.  version_change is scanned before version_commit, as these are more likely to be requested.
     use_working_version: boolean (default True), if True and version_number==None this will also look at any
         version_working data and return it instead the head table data, if it exists for this user.
+    fields: list of strings (default None), if not None, only these fields are selected and returned.  Use this to
+        avoid reading large fields (ex: `data_yaml`) that are not needed.
+    use_cache: boolean (default False), if True use the query cache for the Real record, until its table is written
+        to.  Any version data is still applied over it.  Use for tables that rarely change.
     
   Returns: dict, single record key/values
   """
   handler = DetermineHandlerModule(request)
   
-  result = handler.Get(request, table, record_id, version_number=version_number, use_working_version=use_working_version)
+  result = handler.Get(request, table, record_id, version_number=version_number, use_working_version=use_working_version, fields=fields,
+                       use_cache=use_cache)
   
   return result
 
@@ -699,7 +1129,7 @@ def Query(request, sql, params=None):
   return result
 
 
-def Filter(request, table, data=None, use_working_version=False, order_list=None, groupby_list=None, order_ascending=True, version_number=None, limit=None, row_offset=None):
+def Filter(request, table, data=None, use_working_version=False, order_list=None, groupby_list=None, order_ascending=True, version_number=None, limit=None, row_offset=None, fields=None, row_format='dict', use_cache=False):
   """Get 0 or more records from the datasource, based on filtering rules.
   
   Can be a 'view', combining several lower level 'tables'.
@@ -714,26 +1144,152 @@ def Filter(request, table, data=None, use_working_version=False, order_list=None
         tables.  version_change is scanned before version_commit, as these are more likely to be requested.
     use_working_version: boolean (default True), if True and version_number==None this will also look at any
         version_working data and return it instead the head table data, if it exists for this user.
+    limit: int (default None), if not None, the maximum number of rows to return
+    row_offset: int (default None), if not None (and limit is set), the number of rows to skip first.  This still
+        reads all the skipped rows, so use FilterPages() to page through large results.
+    fields: list of strings (default None), if not None, only these fields are selected and returned.  Use this to
+        avoid reading large fields (ex: `data_yaml`) that are not needed.
+    row_format: string (default 'dict'), 'dict' for dict rows, or 'compact' for rows that share their column names
+        (tools.CompactRow), which use much less memory for large results.  Use row.ToDict() to get a dict.
+    use_cache: boolean (default False), if True use the query cache for the Real records, until the table is written
+        to.  Any version data is still applied over them.  Use for tables that rarely change.
   """
   handler = DetermineHandlerModule(request)
 
   result = handler.Filter(request, table, data=data, use_working_version=use_working_version, order_list=order_list, groupby_list=groupby_list,
-                          order_ascending=order_ascending, version_number=version_number, limit=limit, row_offset=row_offset)
+                          order_ascending=order_ascending, version_number=version_number, limit=limit, row_offset=row_offset, fields=fields,
+                          row_format=row_format, use_cache=use_cache)
+  
+  return result
+
+
+def Count(request, table, data=None, use_working_version=False):
+  """Returns int, the number of records matching the filtering rules, without fetching them.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value.  Same as Filter().
+    use_working_version: boolean (default False), if True this will also look at any version_working data for this user
+  
+  Returns: int
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.Count(request, table, data=data, use_working_version=use_working_version)
+  
+  return result
+
+
+def Exists(request, table, data=None, use_working_version=False):
+  """Returns boolean, True if any record matches the filtering rules, without fetching them.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value.  Same as Filter().
+    use_working_version: boolean (default False), if True this will also look at any version_working data for this user
+  
+  Returns: boolean
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.Exists(request, table, data=data, use_working_version=use_working_version)
+  
+  return result
+
+
+def Aggregate(request, table, data=None, group_by=None, aggregates=None):
+  """Returns list of dicts, one per group, with the group_by fields and the aggregates, computed in the datasource.
+  
+  Works on the Real records only, no version data is applied.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value.  Same as Filter().
+    group_by: list of strings (default None), fields to group by.  If None, there is a single group of all the records.
+    aggregates: dict, key is the result name, value is tuple (function, field).  Functions: count, count_distinct,
+        sum, min, max, avg.  ex: {'n': ('count', '*'), 'max_id': ('max', 'id')}
+  
+  Returns: list of dicts
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.Aggregate(request, table, data=data, group_by=group_by, aggregates=aggregates)
+  
+  return result
+
+
+def FilterPages(request, table, data=None, order_key='id', page_size=DEFAULT_PAGE_SIZE, cursor=None, use_working_version=False, fields=None, row_format='dict'):
+  """Get a page of records from the datasource, based on filtering rules, and a cursor to get the next page with.
+  
+  Pages with keyset pagination (WHERE order_key > last_seen), so each page costs the same from the first page
+  to the last, unlike Filter() with limit/row_offset.  Pass the returned cursor back in to get the next page.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value.  Same as Filter().
+    order_key: string (default 'id'), field to order and page on.  Must be unique.
+    page_size: int, number of table rows per page
+    cursor: string (default None), opaque cursor returned with the previous page.  If None, get the first page.
+    use_working_version: boolean (default False), if True this will also look at any version_working data for this user
+    fields: list of strings (default None), if not None, only these fields are returned.  Same as Filter().
+    row_format: string (default 'dict'), 'dict' or 'compact'.  Same as Filter().
+  
+  Returns: tuple (list of dicts, string or None), the page rows and the cursor for the next page.  The cursor is None on the last page.
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.FilterPages(request, table, data=data, order_key=order_key, page_size=page_size, cursor=cursor, use_working_version=use_working_version, fields=fields,
+                               row_format=row_format)
   
   return result
 
 
-def GetWorkingVersionData(request, username=None):
+def FilterIter(request, table, data=None, order_key='id', page_size=DEFAULT_PAGE_SIZE, use_working_version=False, fields=None, row_format='dict'):
+  """Yields every record matching the filtering rules, getting them a page at a time with FilterPages().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value.  Same as Filter().
+    order_key: string (default 'id'), field to order and page on.  Must be unique.
+    page_size: int, number of table rows per page
+    use_working_version: boolean (default False), if True this will also look at any version_working data for this user
+    fields: list of strings (default None), if not None, only these fields are returned.  Same as Filter().
+    row_format: string (default 'dict'), 'dict' or 'compact'.  Same as Filter().
+  
+  Yields: dict (or tools.CompactRow), single record key/values
+  """
+  cursor = None
+  
+  while True:
+    (rows, cursor) = FilterPages(request, table, data=data, order_key=order_key, page_size=page_size, cursor=cursor, use_working_version=use_working_version, fields=fields,
+                                  row_format=row_format)
+    
+    for row in rows:
+      yield row
+    
+    # No more pages
+    if cursor == None:
+      break
+
+
+def GetWorkingVersionData(request, username=None, shared=False):
   """Returns a dict or None, with the current working data (already parsed from `version_working.data_yaml`
   
   Args:
     request: Request Object, the connection spec data and user and auth info, etc
+    username: string (default None), user to get the working version of.  If None, the requesting user.
+    shared: boolean (default False), if True return the cached parsed data, which must not be changed
   
   Returns: tuple of (dict, list), with labels (update_data, delete_data) 
   """
   handler = DetermineHandlerModule(request)
 
-  result = handler.GetWorkingVersionData(request, username=username)
+  result = handler.GetWorkingVersionData(request, username=username, shared=shared)
   
   return result
 
@@ -751,7 +1307,7 @@ def GetWorkingVersionRecord(request, schema_id, schema_table_id, record_id, defa
   
   Returns: any, default_value if record does not existing in Working Version
   """
-  (update_data, delete_data) = GetWorkingVersionData(request, username=username)
+  (update_data, delete_data) = GetWorkingVersionData(request, username=username, shared=True)
   
   # Assume our default_value, if we cannot find something better
   result = default_value
@@ -761,6 +1317,10 @@ def GetWorkingVersionRecord(request, schema_id, schema_table_id, record_id, defa
     if schema_table_id in update_data[schema_id]:
       if record_id in update_data[schema_id][schema_table_id]:
         result = update_data[schema_id][schema_table_id][record_id]
+        
+        # The data is shared, so only give out a copy
+        if isinstance(result, dict):
+          result = dict(result)
   
   return result
 
@@ -794,6 +1354,62 @@ def SetWorkingVersionRecord(request, schema_id, schema_table_id, record_id, valu
   SetWorkingVersionData(request, update_data)
 
 
+def GetWorkingVersionStorage(request):
+  """Returns string, the working version storage mode of this datasource: 'document' (default, the whole working set
+  in the user's version_working row) or 'record' (each working record in its own version_working_record row).
+  
+  Set with `working_version_storage` in the connection spec datasource.
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.GetWorkingVersionStorage(request)
+  
+  return result
+
+
+def DiffVersions(request, from_version, to_version=None, tables=None):
+  """Yields the field level changes of records between two committed versions, or a committed version and HEAD.
+  
+  Streams the changes, a batch of records at a time, so large ranges of versions dont need to be held in memory.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    from_version: int, version_commit.id to diff from.  0 for before the first commit.
+    to_version: int (default None), version_commit.id to diff to.  If None, diff to HEAD.
+    tables: list of strings (default None), if not None, only diff records in these tables
+  
+  Yields: dicts, {'table': table name, 'id': record id, 'action': 'insert', 'update' or 'delete',
+      'fields': dict of field -> (before value, after value)}
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.DiffVersions(request, from_version, to_version=to_version, tables=tables)
+  
+  return result
+
+
+def CreateVersionIndexes(request):
+  """Create the indexes the version history lookups use, on the version tables, if they dont exist, or rebuild them if
+  their fields have changed.
+  
+  Returns: list of strings, the "table.index" names that were created or rebuilt
+  """
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.CreateVersionIndexes(request)
+  
+  return result
+
+
+def CreateWorkingRecordTable(request):
+  """Create the version_working_record table, used by the 'record' working version storage mode, if it doesnt exist."""
+  handler = DetermineHandlerModule(request)
+  
+  result = handler.CreateWorkingRecordTable(request)
+  
+  return result
+
+
 def SetWorkingVersionData(request, working_version, delete_version=None):
   """Returns a dict or None, with the current working data (already parsed from `version_working.data_yaml`
   
@@ -809,43 +1425,24 @@ def SetWorkingVersionData(request, working_version, delete_version=None):
   return result
 
 
-def AcquireLock(request, lock, timeout=None, sleep_interval=0.1):
-  """Spin loops until we can get this lock.
+def AcquireLock(request, lock, timeout=None, sleep_interval=lock_manager.DEFAULT_BACKOFF_INITIAL):
+  """Waits until we can get this lock.  Threads of this process wait in-process, and processes wait on the datasource.
   
   Args:
     request: Request Object, the connection spec data and user and auth info, etc
     lock: string, lock name.  Will be unique
     timeout: float (optional), time in seconds before timeout
-    sleep_interval: float, time to sleep between checking on the lock
+    sleep_interval: float, first time to sleep between checking on the lock, doubling each time (exponential backoff)
   
   Returns: boolean, did we get the lock?  True = yes. False = no.  This only matters if timeout is set, otherwise we will wait forever
   """
   Log('Acquire Lock: %s' % lock)
   
-  done = False
-  started = time.time()
+  handler = DetermineHandlerModule(request)
   
-  while not done:
-    duration = time.time() - started
-    
-    # try:
-    if 1:
-      Set(request, 'schema_lock', {'name':lock})
-      
-      # It worked, we are done
-      done = True
-    
-    # #TODO(g): Get the correct exception type here, so we only catch insertion failures
-    # except Exception, e:
-    #   print 'AcquireLock: Failed: %s: %s: %s' % (lock, duration, e)
-    #   
-    #   if timeout and duration > timeout:
-    #     return False
-    #   
-    #   # Sleep for the specified time
-    #   time.sleep(sleep_interval)
+  result = handler.AcquireLock(request, lock, timeout=timeout, sleep_interval=sleep_interval)
   
-  return True
+  return result
 
 
 def ReleaseLock(request, lock):
@@ -859,16 +1456,11 @@ def ReleaseLock(request, lock):
   """
   Log('Release Lock: %s' % lock)
   
-  lock_list = Filter(request, 'schema_lock', {'name': lock})
-  
-  if not lock_list:
-    return False
-  
-  lock_record = lock_list[0]
+  handler = DetermineHandlerModule(request)
   
-  Delete(request, 'schema_lock', lock_record['id'])
+  result = handler.ReleaseLock(request, lock)
   
-  return True
+  return result
 
 
 def GetSchemaTableRowLockKey(request, table, record_id, schema=None):
@@ -890,34 +1482,18 @@ def GetSchemaTableRowLockKey(request, table, record_id, schema=None):
 def GetNextNegativeNumber(request, table):
   """Returns the next negative number for a given table, from `schema_table.next_negative_id`
   
+  Handed out from a block of ids this process reserved for the table, so only every NEGATIVE_ID_BLOCK_SIZE-th call
+  goes to the database (see negative_id_allocator).
+  
   Args:
     request: Request Object, the connection spec data and user and auth info, etc
     table: string, name of table to operate on
   """
   (schema, schema_table) = GetInfoSchemaAndTable(request, table)
   
-  # Perform an internal lock, so we cant race on this
-  #TODO
-  
-  # Get the lock key for this schema table row
-  lock = GetSchemaTableRowLockKey(request, table, schema_table['name'], schema=schema)
-
-  try:
-    # Get the lock, so we dont collide on this
-    AcquireLock(request, lock)
-    
-    # Get the next negative from the current storage
-    next_negative_id = schema_table['next_negative_id']
-    
-    # Decrement the next negative ID, so we always get original ones, and they wont conflict
-    schema_table['next_negative_id'] -= 1
-    
-    # Save with the new decremented number
-    Set(request, 'schema_table', schema_table)
+  handler = DetermineHandlerModule(request)
   
-  finally:
-    # Release the lock
-    ReleaseLock(request, lock)
+  next_negative_id = negative_id_allocator.AllocateNegativeId(request, schema_table['id'], handler.ReserveNegativeIds)
   
   return next_negative_id
 
@@ -957,6 +1533,12 @@ def DeleteVersion(request, table, record_id, version_number=None, version_data=N
   
   Log('Delete Version: %s: %s' % (table, record_id))
   
+  handler = DetermineHandlerModule(request)
+  
+  # Each working record is its own row, so the handler only needs to write this record's row
+  if version_data is None and GetWorkingVersionStorage(request) == handler.WORKING_VERSION_STORAGE_RECORD:
+    return handler.DeleteWorkingRecord(request, table, record_id)
+  
   (schema, schema_table) = GetInfoSchemaAndTable(request, table)
 
   # Expand version data
@@ -979,14 +1561,7 @@ def DeleteVersion(request, table, record_id, version_number=None, version_data=N
   
     # If, we have a working version, so get the data
     if version_working:
-      update_data = utility.path.LoadYamlFromString(version_working['data_yaml'])
-      delete_data = utility.path.LoadYamlFromString(version_working['delete_data_yaml'])
-      
-      if not update_data:
-        update_data = {}
-      
-      if not delete_data:
-        delete_data = {}
+      (update_data, delete_data) = working_version_cache.LoadWorkingVersionData(request, user['id'], version_working['data_yaml'], version_working['delete_data_yaml'])
 
   
   # Check to see if this a Real record
@@ -1021,10 +1596,12 @@ def DeleteVersion(request, table, record_id, version_number=None, version_data=N
   
   if commit:
     # Add this to the working version record
-    version_working['data_yaml'] = utility.path.DumpYamlAsString(update_data)
-    version_working['delete_data_yaml'] = utility.path.DumpYamlAsString(delete_data)
+    version_working['data_yaml'] = tools.DumpVersionData(update_data)
+    version_working['delete_data_yaml'] = tools.DumpVersionData(delete_data)
     # Save the working version record
     Set(request, 'version_working', version_working)
+    
+    working_version_cache.StoreWorkingVersionData(request, version_working['user_id'], version_working['data_yaml'], version_working['delete_data_yaml'], update_data, delete_data)
   
 
 def DeleteFilter(request, table, data, version_number=None, use_working_version=False):
@@ -1048,11 +1625,11 @@ def DeleteFilter(request, table, data, version_number=None, use_working_version=
   return result
 
 
-def CommitVersionRecordToDatasource(request, version_commit_id, change_record, commit=True, table_dependencies=None):
+def CommitVersionRecordToDatasource(request, version_commit_id, change_record, commit=True, table_dependencies=None, for_update=False):
   """Pushes the contents of a version_commit row into the Real data source"""
   handler = DetermineHandlerModule(request)
   
-  result = handler.CommitVersionRecordToDatasource(request, version_commit_id, change_record, commit=commit, table_dependencies=table_dependencies)
+  result = handler.CommitVersionRecordToDatasource(request, version_commit_id, change_record, commit=commit, table_dependencies=table_dependencies, for_update=for_update)
   
   return result
 
@@ -1153,7 +1730,7 @@ def SortRows(rows, order_list):
   Returns: list of dict (rows)
   """
   comparers = [
-    ((i(col[1:].strip()), -1) if col.startswith('-') else (itemgetter(col.strip()), 1))
+    ((itemgetter(col[1:].strip()), -1) if col.startswith('-') else (itemgetter(col.strip()), 1))
     for col in order_list
   ]
   
@@ -0,0 +1,173 @@
+"""
+Lock Manager for SchemaMan
+
+Thread safe.  Named locks for critical sections, in two layers: threads of this process wait on an in-process lock,
+so only one thread at a time goes on to the datasource's cross-process lock (ex: MySQL GET_LOCK), which waits on the
+server instead of spinning.  Waits are retried with exponential backoff, and contention is counted in LOCK_METRICS.
+
+Lock names are usually per schema table, so there arent many of them, and the in-process locks are never purged.
+"""
+
+
+import random
+import thread
+import threading
+import time
+
+
+# Backoff between attempts to get a lock: starts at the initial interval, doubles each attempt, up to the max
+DEFAULT_BACKOFF_INITIAL = 0.001
+DEFAULT_BACKOFF_MAX = 0.1
+
+# In-process locks: key is lock name, value is threading.Lock.  Owners are the thread ident that holds each lock.
+LOCAL_LOCKS = {}
+LOCAL_LOCK_OWNERS = {}
+LOCAL_LOCKS_LOCK = threading.Lock()
+
+# Lock counters, for finding contention
+LOCK_METRICS = {}
+LOCK_METRICS_LOCK = threading.Lock()
+
+# Names of all the LOCK_METRICS counters
+LOCK_METRIC_NAMES = (
+  'acquired',             # Locks we got
+  'released',             # Locks we released
+  'release_not_held',     # Releases of locks we didnt hold
+  'local_contended',      # Acquires that had to wait for another thread of this process
+  'remote_contended',     # Acquires that had to wait for another process
+  'timeouts',             # Acquires that timed out
+  'wait_seconds',         # Total time spent waiting for locks
+  'max_wait_seconds',     # Longest wait for a lock
+)
+
+
+def GetLocalLock(lock):
+  """Returns threading.Lock, the in-process lock for this lock name.  Creates it if it doesnt exist."""
+  try:
+    LOCAL_LOCKS_LOCK.acquire()
+  
+    if lock not in LOCAL_LOCKS:
+      LOCAL_LOCKS[lock] = threading.Lock()
+  
+    return LOCAL_LOCKS[lock]
+  
+  finally:
+    LOCAL_LOCKS_LOCK.release()
+
+
+def AcquireLocalLock(lock, timeout=None, backoff_initial=DEFAULT_BACKOFF_INITIAL, backoff_max=DEFAULT_BACKOFF_MAX):
+  """Get the in-process lock for this lock name, waiting with exponential backoff if another thread has it.
+  
+  Args:
+    lock: string, lock name
+    timeout: float (default None), seconds to wait before giving up.  If None, wait forever.
+    backoff_initial: float, seconds to sleep after the first failed attempt
+    backoff_max: float, most seconds to sleep between attempts
+  
+  Returns: boolean, True if we got the lock, False if we timed out
+  """
+  local_lock = GetLocalLock(lock)
+  
+  # Fast path, no one has it
+  if local_lock.acquire(False):
+    LOCAL_LOCK_OWNERS[lock] = thread.get_ident()
+    return True
+  
+  IncrementLockMetric('local_contended')
+  
+  started = time.time()
+  attempt = 0
+  
+  while not local_lock.acquire(False):
+    remaining = None
+    if timeout != None:
+      remaining = timeout - (time.time() - started)
+  
+      if remaining <= 0:
+        return False
+  
+    sleep_time = GetBackoffInterval(attempt, backoff_initial, backoff_max)
+    if remaining != None:
+      sleep_time = min(sleep_time, remaining)
+  
+    time.sleep(sleep_time)
+    attempt += 1
+  
+  LOCAL_LOCK_OWNERS[lock] = thread.get_ident()
+  
+  return True
+
+
+def ReleaseLocalLock(lock):
+  """Release the in-process lock for this lock name, if this thread holds it.
+  
+  Returns: boolean, True if it was released, False if this thread didnt hold it
+  """
+  try:
+    LOCAL_LOCKS_LOCK.acquire()
+    
+    # Only the owner can release it, or we would let another thread in while the owner is still in its critical section
+    if lock not in LOCAL_LOCKS or LOCAL_LOCK_OWNERS.get(lock) != thread.get_ident():
+      return False
+    
+    del LOCAL_LOCK_OWNERS[lock]
+    LOCAL_LOCKS[lock].release()
+  
+  finally:
+    LOCAL_LOCKS_LOCK.release()
+  
+  return True
+
+
+def GetBackoffInterval(attempt, backoff_initial=DEFAULT_BACKOFF_INITIAL, backoff_max=DEFAULT_BACKOFF_MAX):
+  """Returns float, seconds to sleep before the next attempt.  Doubles each attempt (starting at 0), up to backoff_max,
+  with jitter, so waiters dont all wake up at the same time.
+  """
+  interval = min(backoff_initial * (2 ** min(attempt, 30)), backoff_max)
+  
+  return interval * random.uniform(0.5, 1.0)
+
+
+def IncrementLockMetric(name, value=1):
+  """Add value to a LOCK_METRICS counter"""
+  try:
+    LOCK_METRICS_LOCK.acquire()
+  
+    LOCK_METRICS[name] = LOCK_METRICS.get(name, 0) + value
+  
+  finally:
+    LOCK_METRICS_LOCK.release()
+
+
+def RecordLockWait(wait_seconds):
+  """Record the time a lock acquire waited, in the wait_seconds and max_wait_seconds LOCK_METRICS"""
+  try:
+    LOCK_METRICS_LOCK.acquire()
+  
+    LOCK_METRICS['wait_seconds'] = LOCK_METRICS.get('wait_seconds', 0) + wait_seconds
+    LOCK_METRICS['max_wait_seconds'] = max(LOCK_METRICS.get('max_wait_seconds', 0), wait_seconds)
+  
+  finally:
+    LOCK_METRICS_LOCK.release()
+
+
+def GetLockMetrics():
+  """Returns dict, a copy of all the LOCK_METRIC_NAMES counters"""
+  try:
+    LOCK_METRICS_LOCK.acquire()
+  
+    return dict([(name, LOCK_METRICS.get(name, 0)) for name in LOCK_METRIC_NAMES])
+  
+  finally:
+    LOCK_METRICS_LOCK.release()
+
+
+def ResetLockMetrics():
+  """Set all the LOCK_METRICS counters back to 0"""
+  try:
+    LOCK_METRICS_LOCK.acquire()
+  
+    LOCK_METRICS.clear()
+  
+  finally:
+    LOCK_METRICS_LOCK.release()
@@ -2,7 +2,11 @@
 Handle all SchemaMan datasource specific functions: MySQL
 """
 
+import hashlib
+import math
+import os
 import pprint
+import time
 
 import schemaman.datasource as datasource
 import schemaman.utility as utility
@@ -10,6 +14,11 @@ from schemaman.utility.log import Log
 import schemaman.utility.data_control as data_control
 
 import schemaman.datasource.cache as cache
+import schemaman.datasource.query_cache as query_cache
+import schemaman.datasource.tools as tools
+import schemaman.datasource.working_version_cache as working_version_cache
+import schemaman.datasource.version_commit_cache as version_commit_cache
+import schemaman.datasource.lock_manager as lock_manager
 
 from query import *
 
@@ -17,6 +26,67 @@ from query import *
 # Debugging information logged?
 SQL_DEBUG = True
 
+# Number of rows fetched per query when streaming table data (ExportData, etc)
+DEFAULT_BATCH_SIZE = 1000
+
+# Largest list of values put into a single IN (...) clause.  Filter() splits larger lists over several queries.
+MAX_IN_LIST_SIZE = 1000
+
+# Row formats Filter() can return: dicts, or tools.CompactRow which share their column names and use much less memory
+ROW_FORMATS = ('dict', 'compact')
+
+# Aggregate functions allowed by Aggregate(), and their SQL
+AGGREGATE_FUNCTIONS = {
+  'count': 'COUNT',
+  'count_distinct': 'COUNT(DISTINCT %s)',
+  'sum': 'SUM',
+  'min': 'MIN',
+  'max': 'MAX',
+  'avg': 'AVG',
+}
+
+# Filter directives which compare a field to a single value: ('>', 5)
+FILTER_COMPARISON_DIRECTIVES = ('=', '!=', '<>', '>', '>=', '<', '<=', 'LIKE', 'NOT LIKE')
+
+# innodb_autoinc_lock_mode where a multi-row INSERT may not get consecutive auto-increment ids
+AUTOINC_LOCK_MODE_INTERLEAVED = 2
+
+# Longest GET_LOCK() wait, in seconds, when waiting forever for a lock.  We wait again after each one.
+DATABASE_LOCK_WAIT = 10
+
+# Longest lock name GET_LOCK() allows.  Longer names are hashed.
+DATABASE_LOCK_NAME_MAX = 64
+
+# Working version storage modes, set with `working_version_storage` in the connection spec datasource.  'document' keeps
+#   a user's whole working set in their version_working row.  'record' keeps each working record in its own
+#   version_working_record row, so setting or deleting a record doesnt read and rewrite the whole working set.
+WORKING_VERSION_STORAGE_DOCUMENT = 'document'
+WORKING_VERSION_STORAGE_RECORD = 'record'
+WORKING_VERSION_STORAGE_MODES = (WORKING_VERSION_STORAGE_DOCUMENT, WORKING_VERSION_STORAGE_RECORD)
+
+# Table for the 'record' working version storage mode.  `data_yaml` is the record's changed fields, and is NULL for deletes.
+VERSION_WORKING_RECORD_DDL = """CREATE TABLE IF NOT EXISTS `version_working_record` (
+  `id` int(11) NOT NULL AUTO_INCREMENT,
+  `user_id` int(11) NOT NULL,
+  `schema_id` int(11) NOT NULL,
+  `schema_table_id` int(11) NOT NULL,
+  `record_id` int(11) NOT NULL,
+  `is_delete` tinyint(1) NOT NULL DEFAULT 0,
+  `data_yaml` mediumtext,
+  PRIMARY KEY (`id`),
+  UNIQUE KEY `user_record` (`user_id`, `schema_id`, `schema_table_id`, `record_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8"""
+
+
+# Indexes for the version history lookups, created by CreateVersionIndexes(): (table, index name, fields).  InnoDB
+#   secondary indexes also hold the primary key, so the log indexes cover RecordVersionsAvailable() without reading rows.
+VERSION_INDEXES = [
+  ('version_pending_log', 'record_version', ['schema_id', 'schema_table_id', 'record_id']),
+  ('version_commit_log', 'record_version', ['schema_id', 'schema_table_id', 'record_id', 'version_commit_id']),
+  ('version_commit_log', 'version_commit', ['version_commit_id', 'schema_id', 'schema_table_id', 'record_id']),
+  ('version_working', 'user', ['user_id']),
+]
+
 
 class InvalidArguments(Exception):
   """Something wasnt right with the args."""
@@ -138,26 +208,326 @@ def UpdateSchema(request):
   pass
 
 
-def ExportData(request):
-  """Export/dump data from this datasource, based on spec, or everything"""
-  raise Exception('TBD...')
-  pass
+def ExportData(request, path, compress=False, tables=None, batch_size=DEFAULT_BATCH_SIZE):
+  """Export/dump data from this datasource, based on spec, or everything.
+  
+  Every table is streamed into its own JSON Lines file in the path directory (see ExportTable()).
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    path: string, directory to write the table data files into.  Created if it doesnt exist.
+    compress: boolean (default False), if True the data files are gzip compressed
+    tables: list of strings (default None), table names to export.  If None, all tables are exported.
+    batch_size: int, number of rows to fetch per query
+  
+  Returns: dict, keyed on table name (string), values are the number of rows exported (int)
+  """
+  Log('MySQL: Export Data: %s: %s: %s' % (request.connection_data['alias'], request.request_number, path))
+  
+  # Ensure our output directory exists
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  
+  # If we werent told which tables to export, export all of them
+  if tables == None:
+    tables = ListTables(request)
+  
+  result = {}
+  
+  for table in tables:
+    file_path = tools.GetDataFilePath(path, table, compress=compress)
+    
+    result[table] = ExportTable(request, table, file_path, batch_size=batch_size)
+  
+  return result
+
+
+def ExportTable(request, table, path, batch_size=DEFAULT_BATCH_SIZE, start_after=None, end_at=None):
+  """Export a single table into a JSON Lines file (one row per line), streaming the rows in batches.
+  
+  Uses keyset pagination on `id` (see IterTableBatches()), so memory use is constant for any table size, and
+  each batch query costs the same no matter how far into the table we are.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    path: string, file path to write to.  Gzip compressed if it ends in ".gz"
+    batch_size: int, number of rows to fetch per query
+    start_after: int (default None), if not None, only export rows with `id` greater than this
+    end_at: int (default None), if not None, only export rows with `id` less than or equal to this
+  
+  Returns: int, number of rows exported
+  """
+  row_count = 0
+  
+  fp = tools.OpenDataFile(path, 'w')
+  
+  try:
+    # If this table has no `id` field we cant page on it, so we get it in a single query
+    if 'id' not in GetTableFieldNames(request, table):
+      Log('MySQL: Export Table: %s: No `id` field, cannot page, exporting in a single query' % table)
+      
+      connection = GetConnection(request)
+      batches = [connection.Query("SELECT * FROM `%s`" % table)]
+    
+    else:
+      batches = IterTableBatches(request, table, batch_size=batch_size, start_after=start_after, end_at=end_at)
+    
+    for rows in batches:
+      for row in rows:
+        fp.write(tools.FormatJsonLine(row))
+      
+      row_count += len(rows)
+  
+  finally:
+    fp.close()
+  
+  Log('MySQL: Export Table: %s: %s rows: %s' % (table, row_count, path))
+  
+  return row_count
+
+
+def ListTables(request):
+  """Returns list of strings, the names of all the tables in this datasource's database"""
+  connection = GetConnection(request)
+  
+  tables = connection.Query("SHOW TABLES")
+  
+  # Each row is a single field dict, with a key named after the database
+  table_names = [table.values()[0] for table in tables]
+  
+  return table_names
+
+
+def GetTableFieldNames(request, table):
+  """Returns list of strings, the field names for this table, in table order"""
+  connection = GetConnection(request)
+  
+  fields = connection.Query("DESC `%s`" % table)
+  
+  field_names = [item['Field'] for item in fields]
+  
+  return field_names
+
+
+def IterTableBatches(request, table, batch_size=DEFAULT_BATCH_SIZE, order_key='id', start_after=None, end_at=None):
+  """Yields lists of rows (dicts) from a table, in order_key order, batch_size rows at a time.
+  
+  Uses keyset pagination (WHERE order_key > last_seen ORDER BY order_key LIMIT batch_size) instead of OFFSET or
+  fetching everything, so each query uses the index to start where the last one ended.  order_key must be unique.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    batch_size: int, maximum number of rows per batch (and query)
+    order_key: string (default 'id'), unique field to order and page on
+    start_after: any (default None), if not None, only rows with order_key greater than this are returned
+    end_at: any (default None), if not None, only rows with order_key less than or equal to this are returned
+  
+  Yields: list of dicts (rows), never empty
+  """
+  # Get a connection
+  connection = GetConnection(request)
+  
+  last_seen = start_after
+  
+  while True:
+    where_list = []
+    values = []
+    
+    # Start after the last row we have seen
+    if last_seen != None:
+      where_list.append('`%s` > %%s' % order_key)
+      values.append(last_seen)
+    
+    # Stop at the end of our range
+    if end_at != None:
+      where_list.append('`%s` <= %%s' % order_key)
+      values.append(end_at)
+    
+    sql = "SELECT * FROM `%s`" % table
+    
+    if where_list:
+      sql += ' WHERE %s' % ' AND '.join(where_list)
+    
+    sql += ' ORDER BY `%s` LIMIT %d' % (order_key, int(batch_size))
+    
+    rows = connection.Query(sql, values)
+    
+    if not rows:
+      break
+    
+    yield rows
+    
+    # A short batch means there is nothing left to get
+    if len(rows) < batch_size:
+      break
+    
+    last_seen = rows[-1][order_key]
+
+
+def GetExportTableRanges(request, table, part_count, min_part_rows=DEFAULT_BATCH_SIZE):
+  """Returns list of tuples (start_after, end_at), `id` ranges that split a table into up to part_count parts.
+  
+  The ranges split the `id` space between MIN(id) and MAX(id) evenly.  These are index lookups, so we never scan
+  the table to count it, but gaps in the ids will make some parts smaller than others.  The first range has no
+  start and the last range has no end, so all rows are always covered.  See ExportTable() for the range args.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    part_count: int, maximum number of parts to split the table into
+    min_part_rows: int, parts will not be smaller than this many ids
+  
+  Returns: list of tuples (start_after, end_at), [(None, None)] if the table should not be split
+  """
+  # We can only split tables that we can page on
+  if part_count <= 1 or 'id' not in GetTableFieldNames(request, table):
+    return [(None, None)]
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  result = connection.Query("SELECT MIN(`id`) AS min_id, MAX(`id`) AS max_id FROM `%s`" % table)
+  
+  (min_id, max_id) = (result[0]['min_id'], result[0]['max_id'])
+  
+  # Empty table
+  if min_id == None:
+    return [(None, None)]
+  
+  # Dont split into parts smaller than our minimum
+  id_span = max_id - min_id + 1
+  part_count = min(part_count, id_span / min_part_rows)
+  
+  if part_count <= 1:
+    return [(None, None)]
+  
+  # Round up, so our parts cover the whole span
+  part_size = (id_span + part_count - 1) / part_count
+  
+  ranges = []
+  start_after = None
+  
+  for part in range(0, part_count):
+    # The last part is open ended, in case rows were added since we looked
+    if part == part_count - 1:
+      end_at = None
+    else:
+      end_at = min_id - 1 + part_size * (part + 1)
+    
+    ranges.append((start_after, end_at))
+    
+    start_after = end_at
+  
+  return ranges
 
 
-def ImportData(request, drop_first=False, transaction=False):
+def ImportData(request, path, drop_first=False, transaction=False, tables=None, batch_size=DEFAULT_BATCH_SIZE):
   """Import/load data to this datasource, based on spec, or everything.
   
+  Reads the table data files written by ExportData() from the path directory.  Tables are imported in dependency
+  order (see datasource.GetTableDependencyLevels()), so tables are loaded before the tables that reference them.
+  
   Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    path: string, directory to read the table data files from
     drop_first: boolean, optional: If true, all data is dropped/deleted before
         the import occurs, otherwise it is an update.  Defaults to false to
         preserve data.
     transaction: boolean, optional: If true, import is done as a single
         transaction.  Defaults to False to avoid extra memory and slowness.
+    tables: list of strings (default None), table names to import.  If None, all tables with data files are imported.
+    batch_size: int, number of rows to write per query
   
-  Returns: None
+  Returns: dict, keyed on table name (string), values are the number of rows imported (int)
   """
-  raise Exception('TBD...')
-  pass
+  Log('MySQL: Import Data: %s: %s: %s' % (request.connection_data['alias'], request.request_number, path))
+  
+  data_files = tools.ListDataFilePaths(path)
+  
+  # If we werent told which tables to import, import all of them
+  if tables == None:
+    tables = sorted(data_files.keys())
+  
+  # Get our tables in the order we need to import them
+  table_levels = datasource.GetTableDependencyLevels(request, tables)
+  
+  # If this is a single transaction, we dont commit until the end
+  commit = not transaction
+  
+  result = {}
+  
+  try:
+    # Delete in reverse dependency order, so we remove referencing records first
+    if drop_first:
+      for table_level in reversed(table_levels):
+        for table in table_level:
+          DeleteAll(request, table, commit=commit)
+    
+    for table_level in table_levels:
+      for table in table_level:
+        result[table] = ImportTable(request, table, data_files.get(table, []), batch_size=batch_size, commit=commit)
+    
+    if transaction:
+      Commit(request)
+  
+  except Exception, e:
+    # Dont leave a partial import in our transaction
+    if transaction:
+      AbandonCommit(request)
+    
+    raise
+  
+  return result
+
+
+def ImportTable(request, table, file_paths, batch_size=DEFAULT_BATCH_SIZE, commit=True):
+  """Import JSON Lines data files (see ExportTable()) into a table, writing batch_size rows per query.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    file_paths: list of strings, data file paths to read.  Gzip compressed if they end in ".gz"
+    batch_size: int, number of rows to write per query
+    commit: boolean (default True), if True any queries that could be commited will be (single query transaction), if False then a later Commit() will be required
+  
+  Returns: int, number of rows imported
+  """
+  row_count = 0
+  
+  for file_path in file_paths:
+    fp = tools.OpenDataFile(file_path)
+    
+    try:
+      rows = []
+      
+      for line in fp:
+        row = tools.ParseJsonLine(line)
+        
+        # Skip blank lines
+        if row == None:
+          continue
+        
+        rows.append(row)
+        
+        # Write a full batch
+        if len(rows) >= batch_size:
+          SetDirectBatch(request, table, rows, commit=commit)
+          row_count += len(rows)
+          rows = []
+      
+      # Write any remaining rows
+      if rows:
+        SetDirectBatch(request, table, rows, commit=commit)
+        row_count += len(rows)
+    
+    finally:
+      fp.close()
+  
+  Log('MySQL: Import Table: %s: %s rows' % (table, row_count))
+  
+  return row_count
 
 
 def GetUser(request, username=None, use_cache=True):
@@ -298,6 +668,84 @@ def GetInfoSchemaAndTableById(request, schema_table_id):
   return (schema, schema_table)
 
 
+def GetForeignKeyGraph(request):
+  """Returns dict, the references between the tables of this schema, for GetFieldReference().  Cached, like the other
+  schema info.
+  
+  References are the database's foreign keys (information_schema.KEY_COLUMN_USAGE).  Tables without any foreign keys
+  use the naming convention instead: `<table>_id` references <table> if it is one of our tables, and `parent_id`
+  references its own table (the `parent` value type).
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+  
+  Returns: dict, with keys: 'schema_id', 'tables' (table name -> schema_table.id) and 'foreign_keys'
+      ((schema_id, schema_table_id) -> dict of (field -> (schema_id, schema_table_id) it references)).  Tables that are
+      not in 'foreign_keys' use the naming convention.
+  """
+  database_name = request.connection_data['datasource']['database']
+  
+  # Get this cached result, and return it if available
+  cache_result = cache.Get('foreign_key_graph', database_name)
+  if cache_result != cache.NoCacheResultFound:
+    return cache_result
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  schema = GetInfoSchema(request)
+  
+  # All our tables, so references can be found with dict lookups
+  tables = {}
+  sql = "SELECT `id`, `name` FROM `schema_table` WHERE `schema_id` = %s"
+  for schema_table in connection.Query(sql, [schema['id']]):
+    tables[schema_table['name']] = schema_table['id']
+  
+  # Foreign keys declared in the database, between tables we know
+  foreign_keys = {}
+  sql = "SELECT `TABLE_NAME`, `COLUMN_NAME`, `REFERENCED_TABLE_NAME` FROM `information_schema`.`KEY_COLUMN_USAGE`" \
+        " WHERE `TABLE_SCHEMA` = %s AND `REFERENCED_TABLE_NAME` IS NOT NULL"
+  for item in connection.Query(sql, [database_name]):
+    if item['TABLE_NAME'] in tables and item['REFERENCED_TABLE_NAME'] in tables:
+      table_key = (schema['id'], tables[item['TABLE_NAME']])
+      foreign_keys.setdefault(table_key, {})[item['COLUMN_NAME']] = (schema['id'], tables[item['REFERENCED_TABLE_NAME']])
+  
+  graph = {'schema_id': schema['id'], 'tables': tables, 'foreign_keys': foreign_keys}
+  
+  # Save the cache result
+  cache.Set('foreign_key_graph', database_name, graph)
+  
+  return graph
+
+
+def GetFieldReference(foreign_key_graph, table_key, field):
+  """Returns tuple (schema_id, schema_table_id) of the table this field references, or None if it isnt a reference.
+  
+  Args:
+    foreign_key_graph: dict, from GetForeignKeyGraph()
+    table_key: tuple, (schema_id, schema_table_id) of the field's table
+    field: string, name of field
+  
+  Returns: tuple or None
+  """
+  # If the table has foreign keys, they are the only references
+  if table_key in foreign_key_graph['foreign_keys']:
+    return foreign_key_graph['foreign_keys'][table_key].get(field)
+  
+  if not field.endswith('_id'):
+    return None
+  
+  # Parent records are in the same table
+  if field == 'parent_id':
+    return table_key
+  
+  # The field name is the table name, plus '_id'
+  if field[:-3] in foreign_key_graph['tables']:
+    return (foreign_key_graph['schema_id'], foreign_key_graph['tables'][field[:-3]])
+  
+  return None
+
+
 def GetInfoSchemaTableField(request, schema_table, name):
   """Returns the record for this schema field data (schema_table_field)"""
   # Get a connection
@@ -313,67 +761,81 @@ def GetInfoSchemaTableField(request, schema_table, name):
   return schema_table
 
 
-def RecordVersionsAvailable(request, table, record_id, user=None):
+def RecordVersionsAvailable(request, table, record_id, user=None, limit=None, row_offset=None):
   """List all of the historical and currently available versions available for this record.
   
   Looks at 3 tables to figure this out: version_pending_log (un-commited changes),
       version_commit_log (commited changes), version_working (single user changes)
   
+  The logs are read with a single UNION query, on the indexes from CreateVersionIndexes().  The working version is
+  checked in the user's cached parsed working set, or with the 'record' storage mode, in the same query from the
+  version_working_record table.
+  
   Args:
     request: Request Object, the connection spec data and user and auth info, etc
     table: string, name of table to operate on
     record_id: int, primary key (ex: `id`) of the record in this table.  Use Filter() to use other field values
-    username: string (default None), if not None, this is a specific user to check versions.  Otherwise the
-        request.username is used.
+    user: dict, user record to check the working version of
+    limit: int (default None), if not None, the most versions to return, for paging through long histories
+    row_offset: int (default None), if not None, the number of versions to skip.  Requires limit.
     
-  Returns: list of dicts, dicts have 'id' and 'name' fields.
+  Returns: list of dicts, dicts have 'id' and 'name' fields.  Commits, then pending change lists, then the working version.
   """
   # Get a connection
   connection = GetConnection(request)
   
-  # Get the schema name from our request.datasource.database
-  database_name = request.connection_data['datasource']['database']
-  
   # Get the schema and table info
-  (schema, schema_table) = GetInfoSchemaAndTable(request, table)  
+  (schema, schema_table) = GetInfoSchemaAndTable(request, table)
+  
+  record_args = [schema['id'], schema_table['id'], record_id]
   
-  # version_pending_log
-  sql = "SELECT * FROM `version_pending_log` WHERE schema_id = %s AND schema_table_id = %s AND record_id = %s ORDER BY id"
-  result_changelist = connection.Query(sql, [schema['id'], schema_table['id'], record_id])
+  # version_commit_log and version_pending_log, with the source of each row, to order them and name them
+  sql = "SELECT 0 AS `source_order`, `id` FROM `version_commit_log` WHERE schema_id = %s AND schema_table_id = %s AND record_id = %s"
+  sql += " UNION ALL SELECT 1, `id` FROM `version_pending_log` WHERE schema_id = %s AND schema_table_id = %s AND record_id = %s"
+  args = record_args + record_args
   
-  # version_commit_log
-  sql = "SELECT * FROM `version_commit_log` WHERE schema_id = %s AND schema_table_id = %s AND record_id = %s ORDER BY id"
-  result_commit = connection.Query(sql, [schema['id'], schema_table['id'], record_id])
+  # version_working_record has this record's row, if the user is working on it
+  if GetWorkingVersionStorage(request) == WORKING_VERSION_STORAGE_RECORD:
+    sql += " UNION ALL SELECT 2, `id` FROM `version_working_record` WHERE user_id = %s AND schema_id = %s AND schema_table_id = %s AND record_id = %s AND is_delete = 0"
+    args += [user['id']] + record_args
   
-  # version_working
-  sql = "SELECT * FROM `version_working` WHERE user_id = %s"
-  result_working = connection.Query(sql, [user['id']])
+  # Else, look in the user's cached parsed working set, and add a row to the query if it's in there, so paging counts it
+  else:
+    (update_data, _) = GetWorkingVersionData(request, username=user['name'], shared=True)
+    
+    in_working = record_id in update_data.get(schema['id'], {}).get(schema_table['id'], {})
+    
+    sql += " UNION ALL SELECT 2, 0 FROM DUAL WHERE %s"
+    args.append(int(in_working))
   
+  sql += " ORDER BY `source_order`, `id`"
   
-  # Compile the final result list, from the found results
-  result = []
+  # Page through the versions
+  if limit != None:
+    if row_offset != None:
+      sql += ' LIMIT %d, %d' % (int(row_offset), int(limit))
+    else:
+      sql += ' LIMIT %d' % int(limit)
   
-  # Commited versions
-  for item in result_commit:
-    data = {'id': item['id'], 'name':'Commit Number: %s' % item['id']}
-    result.append(data)
+  result_versions = connection.Query(sql, args)
   
-  # Change List versions
-  for item in result_changelist:
-    data = {'id': item['id'], 'name':'Pending Change Number: %s' % item['id']}
-    result.append(data)
+  # Compile the final result list, from the found results
+  result = []
   
-  # Working set
-  if result_working:
-    working = result_working[0]
+  for item in result_versions:
+    # Commited versions
+    if item['source_order'] == 0:
+      data = {'id': item['id'], 'name':'Commit Number: %s' % item['id']}
     
-    data = utility.path.LoadYamlFromString(working['data_yaml'])
+    # Change List versions
+    elif item['source_order'] == 1:
+      data = {'id': item['id'], 'name':'Pending Change Number: %s' % item['id']}
+    
+    # Working set
+    else:
+      data = {'id':'working', 'name':'Working Version: %s' % user['name']}
     
-    if schema['id'] in data:
-      if schema_table['id'] in data[schema['id']]:
-        if record_id in data[schema['id']][schema_table['id']]:
-          item = {'id':'working', 'name':'Working Version: %s' % user['name']}
-          result.append(item)
+    result.append(data)
   
   return result
 
@@ -385,6 +847,46 @@ def CommitWorkingVersion(request):
   
   See also: CreateChangeList() and CreateChangeListFromWorkingSet() and CommitWorkingVersionSingleRecord()
   """
+  # Each working record is its own row, so put them together as a working version record
+  if GetWorkingVersionStorage(request) == WORKING_VERSION_STORAGE_RECORD:
+    # One transaction, with the working records we commit locked, so a concurrent save of them waits until we are done
+    began = Begin(request)
+    
+    try:
+      rows = QueryWorkingRecordRows(request, request.user['id'], for_update=True)
+      
+      if not rows:
+        raise datasource.VersionNotFound('No version working data exists for user: %s' % request.username)
+      
+      (update_data, delete_data) = LoadWorkingRecordRows(rows)
+      
+      working_version = {'user_id': request.user['id'], 'data_yaml': tools.DumpVersionData(update_data), 'delete_data_yaml': tools.DumpVersionData(delete_data)}
+      
+      version_number = CreateChangeList(request, working_version, commit=False)
+      
+      result = CommitChangeList(request, version_number)
+      
+      # Clean up only the working records we committed, any saved since we read them are kept for the next commit
+      connection = GetConnection(request)
+      
+      row_ids = [row['id'] for row in rows]
+      
+      for offset in range(0, len(row_ids), MAX_IN_LIST_SIZE):
+        chunk = row_ids[offset:offset + MAX_IN_LIST_SIZE]
+        
+        sql = "DELETE FROM `version_working_record` WHERE `id` IN (%s)" % ', '.join(['%s'] * len(chunk))
+        connection.Query(sql, chunk, commit=False)
+      
+      if began:
+        Commit(request)
+    
+    except Exception, e:
+      if began:
+        AbandonCommit(request)
+      raise
+    
+    return result
+  
   working_version = GetUserVersionWorkingRecord(request)
   
   # Make a single record entry in the version_pending table, do all the work as we normally would (increments the PKEY, etc)
@@ -446,32 +948,42 @@ def CommitChangeList(request, version_number):
   
   Returns: None
   """
-  # Get the specified change list record
-  record = Get(request, 'version_pending', version_number, use_working_version=False)
-  
-  # Create the new commit record to be inserted
-  data = {'user_id':request.user['id'], 'data_yaml':record['data_yaml']}
-  
-  # Insert into version_commit
-  version_commit_id = SetDirect(request, 'version_commit', data, commit=False)
-  
-  # Create the commit_log data
-  CreateVersionLogRecords(request, 'version_commit', version_commit_id, data, commit=False)
+  # Turn off auto-commit until we are done, so all of these writes are one transaction, and the FOR UPDATE locks hold
+  began = Begin(request)
   
-  # Remove the version_pending_log row
-  DeleteFilter(request, 'version_pending_log', {'version_pending_id':version_number}, commit=False)
-  
-  # Remove the version_pending row
-  Delete(request, 'version_pending', record['id'], commit=False)
-  
-  # Make the change to the tables that are effected
-  CommitVersionRecordToDatasource(request, version_commit_id, record, commit=False)
+  try:
+    # Get the specified change list record
+    record = Get(request, 'version_pending', version_number, use_working_version=False)
+    
+    # Create the new commit record to be inserted
+    data = {'user_id':request.user['id'], 'data_yaml':record['data_yaml'], 'delete_data_yaml':record['delete_data_yaml']}
+    
+    # Insert into version_commit
+    version_commit_id = SetDirect(request, 'version_commit', data, commit=False)
+    
+    # Create the commit_log data
+    CreateVersionLogRecords(request, 'version_commit', version_commit_id, data, commit=False)
+    
+    # Remove the version_pending_log row
+    DeleteFilter(request, 'version_pending_log', {'version_pending_id':version_number}, commit=False)
+    
+    # Remove the version_pending row
+    Delete(request, 'version_pending', record['id'], commit=False)
+    
+    # Make the change to the tables that are effected.  Lock the records we change, so their rollback data is what we overwrite.
+    CommitVersionRecordToDatasource(request, version_commit_id, record, commit=False, for_update=True)
+    
+    # Commit the request, if we are inside a caller's transaction it commits
+    if began:
+      Commit(request)
   
-  # Commit the request
-  Commit(request)
+  except Exception, e:
+    if began:
+      AbandonCommit(request)
+    raise
 
 
-def CommitVersionRecordToDatasource(request, version_commit_id, change_record, commit=True, table_dependencies=None):
+def CommitVersionRecordToDatasource(request, version_commit_id, change_record, commit=True, table_dependencies=None, for_update=False):
   """Commit a change from the version_commit table into the real (non-versioning) datasource tables.
   
   This should not be called from outside this library, mostly because there is no reason to and it
@@ -482,244 +994,373 @@ def CommitVersionRecordToDatasource(request, version_commit_id, change_record, c
     version_number: int, this is the version number in the version_pending.id
     change_record: dict, `version_commit` table row data
     commit: boolean (default True), if True any queries that could be commited will be (single query transaction), if False then a later Commit() will be required
+    table_dependencies: dict (default None), (schema_id, schema_table_id) -> (field, linking_schema_table_id), links
+        between tables that can't be found from the schema's foreign keys.  See GetRecordDependencies().
+    for_update: boolean (default False), if True the Real records are selected FOR UPDATE, so they stay locked until the
+        transaction is committed.  Only useful with commit=False, inside a transaction (see Begin()).
   
   Returns: None
   """
   # Parse the YAML for our cahnge data
-  update_data = utility.path.LoadYamlFromString(change_record['data_yaml'], {})
-  delete_data = utility.path.LoadYamlFromString(change_record['delete_data_yaml'], {})
-  admin_data = utility.path.LoadYamlFromString(change_record['admin_data_yaml'], {})
-  rollback_data = utility.path.LoadYamlFromString(change_record['rollback_data_yaml'], {})
+  update_data = tools.LoadVersionData(change_record['data_yaml'], {})
+  delete_data = tools.LoadVersionData(change_record['delete_data_yaml'], {})
+  admin_data = tools.LoadVersionData(change_record['admin_data_yaml'], {})
+  rollback_data = tools.LoadVersionData(change_record['rollback_data_yaml'], {})
   
   
   # Get all our items as a flat dict of our changes, as it's easier to iterate over
   update_items = data_control.NestedDictsToSingleDict(update_data, 3)
   
   
-  # Track dependencies here
-  dependencies = {}
-  dependency_results = {}
-  dependency_update = {}
-  
-  # We start out with deferred items being everything, then we remove them, as possible, and loop until they are clear
-  deferred_items = dict(update_items)
+  # Find which new records each record references, so we can insert them first, and use their inserted ids
+  (dependencies, dependency_update) = GetRecordDependencies(request, update_items, new_records_only=True, table_dependencies=table_dependencies)
   
-  # Create sorted record_keys list, we know these as they clear their dependencies, so automatically sorted
-  sorted_items = []
+  # Group the records into levels, so their dependencies are inserted in a level before them.  Raises tools.DependencyCycle for circular references.
+  record_levels = tools.PlanCommitLevels(sorted(update_items.keys()), dependencies)
   
-  # We will keep looping until we either have no deferred items, or we couldnt find any more dependencies (circular references)
-  change_occurred = True
-  while deferred_items and change_occurred:
-    # This must be set to True each time, or we will not loop again, and if there are still deferred items, we will error
-    change_occurred = False
-    
-    # Loop over our update_items and create a dependency structure
-    deferred_keys = deferred_items.keys()
-    for record_key in deferred_keys:
-      (schema_id, schema_table_id, record_id) = record_key
-      (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
-      record_data = deferred_items[record_key]
-      
-      # If we are a new record (id<0), add ourselves to the dependencies dict
-      if record_data.get('id', 0) < 0:
-        if schema_table['name'] not in dependencies:
-          dependencies[schema_table['name']] = {}
-        
-        # Create our entry in the dependencies, so we can be easily referenced against fields of dependent records
-        dependencies[schema_table['name']][record_data['id']] = record_key
-      
-      
-      # Test the fields for dependencies first
-      field_dependencies = {}
-
-      # In addition to looking for linking fields by name (and before we have schema in the DB to define it) we'll allow people to pass
-      # in a dict of (schema_id, table_id) -> (field_name, linking_table_id) to define the links between tables that are non-obvious
-      # The goal here is to let people pass in defined links, instead of us just figuring it out from the names of the fields
-      if table_dependencies and record_key[:2] in table_dependencies:
-        linking_field, linking_table_id = table_dependencies[record_key[:2]]
-        linking_table_schema, linking_table_schema_table = GetInfoSchemaAndTableById(request, linking_table_id)
-        for k in deferred_keys:
-          if k == record_key:
-            continue
-          if k[0] == record_key[0] and k[1] == linking_table_schema_table['id']:
-            field_dependencies[linking_table_schema_table['name']] = record_data[linking_field]
-            dependency_update[record_key] = {linking_field: {'table': linking_table_schema_table['name'], 'value': record_data[linking_field]}}
-
-
-      # Check if this has any field dependencies
-      for (field, field_value) in record_data.items():
-        if field.endswith('_id') and type(field_value) == int and field_value < 0:
-          # Get the table name (potentially), by stripping off the '_id' characters
-          table_name = field[:-3]
-          
-          # Ensure this is actually a table name we know about
-          try:
-            # If this doesnt throw an exception, this is a real table name, and so this is a join table, and we should add it as a dependency
-            field_schema, field_schema_table = GetInfoSchemaAndTable(request, table_name)
-          except Exception, e:
-            # This is not a table name, so we dont need to track it as a dependency, skip this field
-            continue
-          
-          #TODO(t): this should really look at foreign keys (or the equivalent)-- but we'll do this for now
-          # Loop over all remaining keys, if the table we are referencing is in the remaining list we 
-          # cannot go now, so we'll add the field dep
-          for k in deferred_keys:
-            if k == record_key:
-              continue
-            if field_schema['id'] == schema_id and k[1] == field_schema_table['id']:
-              field_dependencies[table_name] = field_value
-          
-          # Check to see if we already have the dependency we need listed
-          if table_name in dependencies and field_value in dependencies[table_name]:
-            # If we already have it, do nothing.  We will see this doesnt have any dependent fields (if it doesnt), and remove it from the deferred queue after this block
-            if record_key not in dependency_update:
-              dependency_update[record_key] = {}
-            
-            # Save what we want to collect once we are ready to be inserted, later (after our required records are inserted)
-            dependency_update[record_key][field] = {'table': table_name, 'value': field_value}
-            # print 'Recording lookup for later: %s: %s: %s: %s' % (record_key, field, table_name, field_value)
-          
-      
-      # If we dont have any field dependencies, then we can be removed from the deferred items, as we are set
-      if not field_dependencies:
-        # print 'No dependencies, so removing: %s' % str(record_key)
-        del deferred_items[record_key]
-        
-        # We modified the deferred items, so change has occurred
-        change_occurred = True
-        
-        # We can sort these items on the order they clear being deferred, this guarantees we know their dependencies already, so is perfect
-        sorted_items.append(record_key)
+  # Get the Real records of everything we update or delete, before we change anything, for the rollback data
+  delete_keys = []
+  for (schema_id, schema_data) in delete_data.items():
+    for (schema_table_id, record_ids) in schema_data.items():
+      for record_id in record_ids:
+        delete_keys.append((schema_id, schema_table_id, record_id))
   
+  real_records = GetRecordsByKey(request, update_items.keys() + delete_keys, for_update=for_update)
   
-  # print '\n\n::: Dependencies:\n%s\n\n' % pprint.pformat(dependencies)
-  # print '\n\n::: Dependency Updates:\n%s\n\n' % pprint.pformat(dependency_update)
-  # print '\n\n::: Sorted Items:\n%s\n\n' % pprint.pformat(sorted_items)
+  # Rollback: Save the real records, these are None if they dont exist, which is also what we want.  It works for the positive and the negative existance cases.
+  for record_key in update_items:
+    data_control.EnsureNestedDictsExist(rollback_data, list(record_key), real_records[record_key])
   
-  # If we had a circular reference, we still have deferred items, but we couldnt change anything in a pass, so we are stuck
-  if not change_occurred and deferred_items:
-    raise Exception('Circular reference found in deferred items, could not create dependency list: %s' % deferred_items)
-
+  # Write the records, a level at a time, getting the ids of New Records for the records that reference them
+  written_records = ApplyVersionRecords(request, record_levels, update_items, real_records, dependency_update, commit=commit)
   
-  # Process all our sorted items, which takes care of getting dependencies when needed
-  for record_key in sorted_items:
-    (schema_id, schema_table_id, record_id) = record_key
-    (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
-    record = update_items[record_key]
-
-    # If this is a New Record (id<0), remove the 'id' field, as we will auto_increment it into existance and uet the updated_record_id from that
-    if record.get('id', 0) < 0:
-      del record['id']
-    
-    # Rollback: Get the real record, this is None if it doesnt exist, which is also what we want.  It works for the positive and the negative existance cases.
-    real_record = Get(request, schema_table['name'], record_id)
-    data_control.EnsureNestedDictsExist(rollback_data, [schema_id, schema_table_id, record_id], real_record)
-    
-    # If this record requires any updates
-    if record_key in dependency_update:
-      for (field, field_data) in dependency_update[record_key].items():
-        # Get our dependency record_key, we have to look it up
-        dependency_record_key = dependencies[field_data['table']][field_data['value']]
-        
-        # Get our updated value
-        record[field] = dependency_results[dependency_record_key]
-    
-    # If we got a real record, then overly our changes onto it, so we can save them properly
-    if real_record:
-      new_record = dict(real_record)
-      new_record.update(record)
-      record = new_record
-    
-    # Directly save this into table it was intended to be in.  Update it's own ID, so we convert New Records into existing ones
-    # print '\nTODO: Set Direct: %s: %s\n' % (schema_table['name'], record)
-    record['id'] = SetDirect(request, schema_table['name'], record, commit=commit)
-    
-    # Save all the updated record IDs here, if we need them, we will come and get them
-    dependency_results[record_key] = record['id']
-    
-    # Put this record back into the update_data section, so that we keep the updated IDs, if they have been
+  # Put the records back into the update_data section, so that we keep the updated IDs, if they have been
+  for ((schema_id, schema_table_id, record_id), record) in written_records.items():
     update_data[schema_id][schema_table_id][record_id] = record
   
   # For deletions we also need to sort (as to avoid breaking foreign key constraints)
   # Delete the specified records as well
   # list of table_name, record_id
   delete_items = {}
-  for (schema_id, schema_data) in delete_data.items():
-    for (schema_table_id, schema_table_data) in schema_data.items():
-      (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
-      
-      for record_id in schema_table_data:
-        # Get the existing record, so we can store it for rollback
-        real_record = Get(request, schema_table['name'], record_id)
-        data_control.EnsureNestedDictsExist(rollback_data, [schema_id, schema_table_id, record_id], real_record)
-        delete_items[(schema_id, schema_table_id, record_id)] = real_record
-
-  deferred_items = dict(delete_items)
-  sorted_items = []
-  change_occurred = True
-  
-  #TODO(t): this is pretty ugly... but basically we want to make sure we do the exact OPPOSITE order of the insert
-  #TODO(t): have a unified method for determining order (we can just reverse it for insert/delete)
-  while deferred_items and change_occurred:
-    # This must be set to True each time, or we will not loop again, and if there are still deferred items, we will error
-    change_occurred = False
-    
-    # Loop over our update_items and create a dependency structure
-    deferred_keys = deferred_items.keys()
-    for record_key in deferred_keys:
-      record_data = deferred_items[record_key]
-      
-      # Test the fields for dependencies first
-      dep_remains = False
-
-      # Check if this has any field dependencies
-      for (field, field_value) in record_data.items():
-        # If we found a dep, we can just stop looking
-        if dep_remains:
-          break
-        if field.endswith('_id') and type(field_value) == int:
-          # Get the table name (potentially), by stripping off the '_id' characters
-          table_name = field[:-3]
-          
-          # Ensure this is actually a table name we know about
-          try:
-            # If this doesnt throw an exception, this is a real table name, and so this is a join table, and we should add it as a dependency
-            field_schema, field_schema_table = GetInfoSchemaAndTable(request, table_name)
-          except Exception, e:
-            # This is not a table name, so we dont need to track it as a dependency, skip this field
-            continue
-          
-          #TODO(t): this should really look at foreign keys (or the equivalent)-- but we'll do this for now
-          # Loop over all remaining keys, if the table we are referencing is in the remaining list we 
-          # cannot go now, so we'll add the field dep
-          for k in deferred_keys:
-            if k == record_key:
-              continue
-            if field_schema['id'] == schema_id and k[1] == field_schema_table['id']:
-              dep_remains = True
-          
-      # If we dont have any field dependencies, then we can be removed from the deferred items, as we are set
-      if not dep_remains:
-        # print 'No dependencies, so removing: %s' % str(record_key)
-        del deferred_items[record_key]
-        
-        # We modified the deferred items, so change has occurred
-        change_occurred = True
-        
-        # We can sort these items on the order they clear being deferred, this guarantees we know their dependencies already, so is perfect
-        sorted_items.insert(0, record_key)
+  for record_key in delete_keys:
+    # Store the existing record for rollback
+    real_record = real_records[record_key]
+    data_control.EnsureNestedDictsExist(rollback_data, list(record_key), real_record)
+    delete_items[record_key] = real_record
+
+  # Order the deletes so records are deleted before the records they reference, the opposite of inserting
+  (delete_dependencies, _) = GetRecordDependencies(request, delete_items)
+  sorted_items = tools.PlanDeleteOrder(sorted(delete_items.keys()), delete_dependencies)
   
   # Now that we have the order, do the actual delete
   for (schema_id, schema_table_id, record_id) in sorted_items:
     (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
-    Delete(request, schema_table['name'], record_id)
+    Delete(request, schema_table['name'], record_id, commit=commit)
   
   print '\n\n::: Roll Back data:\n%s\n\n' % pprint.pformat(rollback_data)
   
-  # Save the updated version_commit results back into the DB, with our rollback data and any updated fields from dependencies
-  change_record['data_yaml'] = utility.path.DumpYamlAsString(update_data)
-  change_record['rollback_data_yaml'] = utility.path.DumpYamlAsString(rollback_data)
-  SetDirect(request, 'version_commit', change_record)
+  # Save the updated version_commit results back into the DB, with our rollback data and any updated fields from dependencies.
+  #   The change_record may be the version_pending row, so only save its version data fields into our version_commit row.
+  commit_record = {'id': version_commit_id, 'data_yaml': tools.DumpVersionData(update_data), 'delete_data_yaml': change_record['delete_data_yaml'],
+                   'admin_data_yaml': change_record['admin_data_yaml'], 'rollback_data_yaml': tools.DumpVersionData(rollback_data)}
+  SetDirect(request, 'version_commit', commit_record, commit=commit)
+  
+  # Its data and rollback data have changed, so any cached parse of this commit is stale
+  version_commit_cache.Invalidate(request, version_commit_id)
+
+
+def ApplyVersionRecords(request, record_levels, update_items, real_records, dependency_update, commit=True):
+  """Write version update records into their tables, a dependency level at a time, with multi-row queries per table.
+  
+  Records that exist are overlaid onto their Real record and upserted with SetDirectBatch().  New Records (id<0) are
+  inserted with InsertBatch(), and their new ids are set into the fields of records in later levels that reference them.
+  If the database can't give a multi-row INSERT consecutive ids, New Records are inserted one row per INSERT, which
+  also fail on a conflicting row, instead of updating it.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    record_levels: list of lists of record_keys, from tools.PlanCommitLevels()
+    update_items: dict, record_key (schema_id, schema_table_id, record_id) -> record dict of changed fields
+    real_records: dict, record_key -> Real record or None, from GetRecordsByKey()
+    dependency_update: dict, record_key -> dict of (field -> New Record record_key), from GetRecordDependencies()
+    commit: boolean (default True), if True any queries that could be commited will be (single query transaction), if False then a later Commit() will be required
+  
+  Returns: dict, record_key -> record as written, with its `id`
+  """
+  # Ids of the records we wrote, for the records that reference them
+  dependency_results = {}
+  written_records = {}
+  
+  batch_inserts = GetAutoIncrementLockMode(request) != AUTOINC_LOCK_MODE_INTERLEAVED
+  
+  for level in record_levels:
+    # schema_table_id -> list of (record_key, record), for updates and inserts
+    update_tables = {}
+    insert_tables = {}
+    
+    for record_key in level:
+      (schema_id, schema_table_id, record_id) = record_key
+      record = dict(update_items[record_key])
+      
+      # If this record references any New Records, use their inserted ids.  They were written in an earlier level.
+      for (field, dependency_record_key) in dependency_update.get(record_key, {}).items():
+        record[field] = dependency_results[dependency_record_key]
+      
+      # If this is a New Record (id<0), remove the 'id' field, as we will auto_increment it into existance
+      if record_id < 0:
+        record.pop('id', None)
+        insert_tables.setdefault(schema_table_id, []).append((record_key, record))
+      
+      # Else, overlay our changes onto the Real record (if we have one), so we save the whole record
+      else:
+        if real_records.get(record_key):
+          new_record = dict(real_records[record_key])
+          new_record.update(record)
+          record = new_record
+        
+        record['id'] = record_id
+        update_tables.setdefault(schema_table_id, []).append((record_key, record))
+    
+    for (schema_table_id, table_items) in update_tables.items():
+      (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
+      
+      for offset in range(0, len(table_items), DEFAULT_BATCH_SIZE):
+        SetDirectBatch(request, schema_table['name'], [record for (_, record) in table_items[offset:offset + DEFAULT_BATCH_SIZE]], commit=commit)
+      
+      for (record_key, record) in table_items:
+        dependency_results[record_key] = record['id']
+        written_records[record_key] = record
+    
+    for (schema_table_id, table_items) in insert_tables.items():
+      (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
+      
+      records = [record for (_, record) in table_items]
+      
+      if batch_inserts:
+        record_ids = InsertBatch(request, schema_table['name'], records, commit=commit)
+      else:
+        record_ids = InsertBatch(request, schema_table['name'], records, commit=commit, batch_size=1)
+      
+      for ((record_key, record), record_id) in zip(table_items, record_ids):
+        record['id'] = record_id
+        dependency_results[record_key] = record_id
+        written_records[record_key] = record
+  
+  return written_records
+
+
+def GetAutoIncrementLockMode(request):
+  """Returns int, the database's innodb_autoinc_lock_mode.  Cached.
+  
+  In modes 0 (traditional) and 1 (consecutive) the rows of a multi-row INSERT get consecutive auto-increment ids.  In
+  mode 2 (interleaved) they may not, if other inserts are running at the same time.
+  """
+  database_name = request.connection_data['datasource']['database']
+  
+  # Get this cached result, and return it if available
+  cache_result = cache.Get('autoinc_lock_mode', database_name)
+  if cache_result != cache.NoCacheResultFound:
+    return cache_result
+  
+  connection = GetConnection(request)
+  
+  result = connection.Query("SELECT @@innodb_autoinc_lock_mode AS `lock_mode`")
+  lock_mode = int(result[0]['lock_mode'])
+  
+  # Save the cache result
+  cache.Set('autoinc_lock_mode', database_name, lock_mode)
+  
+  return lock_mode
+
+
+def GetAutoIncrementIncrement(request):
+  """Returns int, the database's auto_increment_increment, the step between auto-increment ids.  Cached.
+  
+  The rows of a multi-row INSERT get ids this far apart, ex: 2 for a master-master pair with odd and even ids.
+  """
+  database_name = request.connection_data['datasource']['database']
+  
+  # Get this cached result, and return it if available
+  cache_result = cache.Get('auto_increment_increment', database_name)
+  if cache_result != cache.NoCacheResultFound:
+    return cache_result
+  
+  connection = GetConnection(request)
+  
+  result = connection.Query("SELECT @@auto_increment_increment AS `increment`")
+  increment = int(result[0]['increment'])
+  
+  # Save the cache result
+  cache.Set('auto_increment_increment', database_name, increment)
+  
+  return increment
+
+
+def InsertBatch(request, table, rows, noop=False, commit=True, batch_size=DEFAULT_BATCH_SIZE):
+  """Insert many new records into a table with multi-row INSERT queries, and return their auto-increment ids.
+  
+  Rows with the same set of fields are inserted together, batch_size rows per query.  The ids come from the first id
+  of each query, as InnoDB gives the rows of a multi-row INSERT consecutive ids (auto_increment_increment apart), unless
+  innodb_autoinc_lock_mode is AUTOINC_LOCK_MODE_INTERLEAVED (see GetAutoIncrementLockMode()), where only a batch_size
+  of 1 gets the right ids.  Unlike SetDirectBatch(), rows that conflict with
+  an existing row fail, instead of updating it, so ids can never be mismatched.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    rows: list of dicts, new records, without their `id`
+    noop: boolean (default False), if True do not actually query the database, (no operation)
+    commit: boolean (default True), if True any queries that could be commited will be (single query transaction), if False then a later Commit() will be required
+    batch_size: int (default DEFAULT_BATCH_SIZE), most rows per INSERT query
+  
+  Returns: list of ints (or None for noop), the new ids of the rows, in the same order as rows
+  """
+  record_ids = [None] * len(rows)
+  
+  # Step between the ids of the rows of one INSERT.  Not needed for single row INSERTs.
+  increment = 1
+  if batch_size > 1 and not noop:
+    increment = GetAutoIncrementIncrement(request)
+  
+  # Every row in a multi-row INSERT must have the same fields, so group the rows (by position) by their fields
+  field_groups = {}
+  for (position, row) in enumerate(rows):
+    keys = row.keys()
+    keys.sort()
+    
+    field_groups.setdefault(tuple(keys), []).append(position)
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  for (keys, positions) in field_groups.items():
+    # Wrap all keys in backticks, so they cannot conflict with SQL keywords
+    keys_ticked = ['`%s`' % key for key in keys]
+    row_format = '(%s)' % ', '.join(['%s'] * len(keys))
+    
+    for offset in range(0, len(positions), batch_size):
+      batch_positions = positions[offset:offset + batch_size]
+      
+      values = []
+      for position in batch_positions:
+        values += [rows[position][key] for key in keys]
+      
+      sql = "INSERT INTO `%s` (%s) VALUES %s" % (table, ', '.join(keys_ticked), ', '.join([row_format] * len(batch_positions)))
+      
+      if noop:
+        Log('Insert Batch NO-OP: %s: %s rows' % (table, len(batch_positions)))
+        continue
+      
+      # Returns the id of the first row, the rest follow it
+      first_id = connection.Query(sql, values, commit=commit)
+      
+      for (count, position) in enumerate(batch_positions):
+        record_ids[position] = first_id + count * increment
+      
+      # Invalidate any cached results for this table
+      query_cache.InvalidateTable(request, table, commit=commit)
+  
+  return record_ids
+
+
+def GetRecordsByKey(request, record_keys, for_update=False):
+  """Returns dict, record_key -> Real record (dict), or None if it doesnt exist.  One query per table (per
+  MAX_IN_LIST_SIZE records), no version data.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    record_keys: list of tuples, (schema_id, schema_table_id, record_id)
+    for_update: boolean (default False), if True select the records FOR UPDATE, locking them until the transaction ends (see Begin())
+  
+  Returns: dict
+  """
+  connection = GetConnection(request)
+  
+  # New Records (id<0) dont exist yet
+  records = dict([(record_key, None) for record_key in record_keys])
+  
+  table_record_ids = {}
+  for (schema_id, schema_table_id, record_id) in records.keys():
+    if record_id >= 0:
+      table_record_ids.setdefault(schema_table_id, []).append(record_id)
+  
+  for (schema_table_id, record_ids) in table_record_ids.items():
+    (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
+    
+    record_ids.sort()
+    
+    for offset in range(0, len(record_ids), MAX_IN_LIST_SIZE):
+      chunk_ids = record_ids[offset:offset + MAX_IN_LIST_SIZE]
+      
+      sql = "SELECT * FROM `%s` WHERE `id` IN (%s)" % (schema_table['name'], ', '.join(['%s'] * len(chunk_ids)))
+      if for_update:
+        sql += ' FOR UPDATE'
+      
+      for record in connection.Query(sql, chunk_ids):
+        records[(schema['id'], schema_table_id, record['id'])] = record
+  
+  return records
+
+
+def GetRecordDependencies(request, items, new_records_only=False, table_dependencies=None):
+  """Returns the references between records, for ordering them with tools.PlanCommitOrder() or tools.PlanDeleteOrder().
+  
+  A record references another record with a field that references its table (see GetForeignKeyGraph()), if that
+  record is also in items.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    items: dict, record_key (schema_id, schema_table_id, record_id) -> record dict (or None, which has no references)
+    new_records_only: boolean (default False), if True only references to New Records (id<0) count, as only they
+        need to be inserted first
+    table_dependencies: dict (default None), (schema_id, schema_table_id) -> (field, linking_schema_table_id), links
+        between tables that can't be found from the field names
+  
+  Returns: tuple of (dict, dict), (dependencies, dependency_update).  dependencies is record_key -> dict of
+      (referenced record_key -> field).  dependency_update is record_key -> dict of (field -> referenced record_key),
+      for fields that reference New Records, which must be set to their inserted ids.
+  """
+  dependencies = {}
+  dependency_update = {}
+  
+  foreign_key_graph = GetForeignKeyGraph(request)
+  
+  for (record_key, record_data) in items.items():
+    if not record_data:
+      continue
+    
+    # (field, referenced record_key) for all of this record's references
+    references = []
+    
+    # Links that were given to us, instead of found from field names
+    if table_dependencies and record_key[:2] in table_dependencies:
+      (linking_field, linking_table_id) = table_dependencies[record_key[:2]]
+      references.append((linking_field, (record_key[0], linking_table_id, record_data.get(linking_field))))
+    
+    for (field, field_value) in record_data.items():
+      if type(field_value) not in (int, long):
+        continue
+      
+      if new_records_only and field_value >= 0:
+        continue
+      
+      reference_table_key = GetFieldReference(foreign_key_graph, record_key[:2], field)
+      
+      if reference_table_key != None:
+        references.append((field, reference_table_key + (field_value,)))
+    
+    for (field, reference_key) in references:
+      # Only records we are also changing need ordering
+      if reference_key == record_key or reference_key not in items:
+        continue
+      
+      dependencies.setdefault(record_key, {})[reference_key] = field
+      
+      # New Records get their id when inserted, so the reference needs to be updated then
+      if reference_key[2] < 0:
+        dependency_update.setdefault(record_key, {})[field] = reference_key
+  
+  return (dependencies, dependency_update)
 
 
 def CreateVersionLogRecords(request, version_table, version_id, data, commit=True):
@@ -744,31 +1385,34 @@ def CreateVersionLogRecords(request, version_table, version_id, data, commit=Tru
   
   Log('Change Log: %s' % data, logging.DEBUG)
   
-  change = utility.path.LoadYamlFromString(data['data_yaml'])
+  change = tools.LoadVersionData(data['data_yaml'], {})
+  delete_change = tools.LoadVersionData(data.get('delete_data_yaml'), {})
   
   Log('Writing version log records for: %s' % change, logging.DEBUG)
   
+  # Log every record that is updated or deleted, once
+  record_keys = set(data_control.NestedDictsToSingleDict(change, 3).keys())
+  for (schema_id, schema_tables) in delete_change.items():
+    for (schema_table_id, record_ids) in schema_tables.items():
+      for record_id in record_ids:
+        record_keys.add((schema_id, schema_table_id, record_id))
+  
   # Process all the schema table fields we need version logs for
-  for (schema_id, schema_tables) in change.items():
+  for (schema_id, schema_table_id, record_id) in sorted(record_keys):
+    # Create our reference field, based on the table name (ex: version_commit_id)
+    reference_field = '%s_id' % version_table
+    version_table_log = '%s_log' % version_table
     
-    Log('Change: %s : %s' % (schema_id, schema_tables))
+    # Create the log record data to insert
+    log_data = {reference_field: version_id, 'schema_id':schema_id, 'schema_table_id':schema_table_id, 'record_id':record_id}
     
-    for (schema_table_id, records) in schema_tables.items():
-      for record_id in records:
-        # Create our reference field, based on the table name (ex: version_commit_id)
-        reference_field = '%s_id' % version_table
-        version_table_log = '%s_log' % version_table
-        
-        # Create the log record data to insert
-        log_data = {reference_field: version_id, 'schema_id':schema_id, 'schema_table_id':schema_table_id, 'record_id':record_id}
-        
-        # Directly save this into the `version_*_log` table, with the commit flag specified
-        SetDirect(request, version_table_log, log_data, commit=commit)
+    # Directly save this into the `version_*_log` table, with the commit flag specified
+    SetDirect(request, version_table_log, log_data, commit=commit)
   
   return log_row_ids
 
 
-def CreateChangeList(request, data):
+def CreateChangeList(request, data, commit=True):
   """Create a change list from the given table and record_id from the Working Set.
   
   This ensures we always have at least something in a change list, so we dont end up with empty ones where we dont know what
@@ -780,6 +1424,7 @@ def CreateChangeList(request, data):
     request: Request Object, the connection spec data and user and auth info, etc
     table: string, name of table to operate on
     data: dict, record that we want to store in the table row
+    commit: boolean (default True), if True any queries that could be commited will be (single query transaction), if False then a later Commit() will be required
   
   Returns: int, version_number for this change list
   """
@@ -787,14 +1432,14 @@ def CreateChangeList(request, data):
   
   # data_yaml = utility.path.DumpYamlAsString(data)
   
-  # Create the changelist record
-  record = {'user_id':request.user['id'], 'data_yaml':data['data_yaml']}
+  # Create the changelist record, with the deletes too, so CommitChangeList() deletes and logs them
+  record = {'user_id':request.user['id'], 'data_yaml':data['data_yaml'], 'delete_data_yaml':data.get('delete_data_yaml')}
   
   # Create this version pending change, and get the version number
-  version_number = SetDirect(request, 'version_pending', record)
+  version_number = SetDirect(request, 'version_pending', record, commit=commit)
   
   # Create the version log for this pending change
-  CreateVersionLogRecords(request, 'version_pending', version_number, record)
+  CreateVersionLogRecords(request, 'version_pending', version_number, record, commit=commit)
   
   return version_number
 
@@ -826,6 +1471,17 @@ def AbandonWorkingVersion(request, table, record_id):
   
   Returns: boolean, True if there was a working version to abandon, False if there was no working version to abandon
   """
+  # Each working record is its own row, so remove this record's row
+  if GetWorkingVersionStorage(request) == WORKING_VERSION_STORAGE_RECORD:
+    (schema, schema_table) = GetInfoSchemaAndTable(request, table)
+    
+    if not QueryWorkingRecordRows(request, request.user['id'], schema['id'], schema_table['id'], record_id):
+      return False
+    
+    SaveWorkingRecordRow(request, request.user['id'], schema['id'], schema_table['id'], record_id)
+    
+    return True
+  
   # Get this user's working version record
   try:
     record = GetUserVersionWorkingRecord(request)
@@ -835,7 +1491,7 @@ def AbandonWorkingVersion(request, table, record_id):
   
   
   # Extract the data_yaml payload
-  change = utility.path.LoadYamlFromString(record['data_yaml'])
+  (change, delete_change) = working_version_cache.LoadWorkingVersionData(request, record['user_id'], record['data_yaml'], record['delete_data_yaml'])
 
   # Format record key
   #TODO(g): Do this properly with the above dynamic PKEY info.  Is this good enough because we take record_id?  Maybe this needs to already be turned into the data_key?  This definitely needs to be a First Class Citizen in schemaman
@@ -860,12 +1516,14 @@ def AbandonWorkingVersion(request, table, record_id):
   del change[schema['id']][schema_table['id']]
   
   # Put this change record back into the version_change table, so it's saved
-  record['data_yaml'] = utility.path.DumpYamlAsString(change)
+  record['data_yaml'] = tools.DumpVersionData(change)
 
   
   # Save the change record
   result_record = SetDirect(request, 'version_working', record)
   
+  working_version_cache.StoreWorkingVersionData(request, record['user_id'], record['data_yaml'], record['delete_data_yaml'], change, delete_change)
+  
   return True
 
 
@@ -915,7 +1573,7 @@ def GetRecordFromVersionRecord(request, version_record, table, record_id):
   Returns: dict, row record from the version record (stored in data_yaml field)
   """
   # Get the JSON payload from the version record
-  change = utility.path.LoadYamlFromString(version_record['data_yaml'])
+  change = tools.LoadVersionData(version_record['data_yaml'])
   
   Log('GetRecordFromVersionRecord: Change: %s' % change, logging.DEBUG)
   
@@ -941,6 +1599,19 @@ def GetRecordFromVersionRecord(request, version_record, table, record_id):
   return change[schema['id']][schema_table['id']][data_key]
   
 
+def Begin(request):
+  """Begin a datasource transaction, even if the request auto-commits.  It lasts until Commit() or AbandonCommit().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+  
+  Returns: boolean, True if a new transaction was begun, False if one was already in flight, which its beginner ends
+  """
+  connection = GetConnection(request)
+  
+  return connection.Begin()
+
+
 def Commit(request):
   """Commit a datasource transaction that is in the middle of a transaction.
   
@@ -952,6 +1623,9 @@ def Commit(request):
   connection = GetConnection(request)
   
   connection.Commit()
+  
+  # Any cached results read during the transaction may be stale now
+  query_cache.InvalidatePendingTables(request)
 
 
 def AbandonCommit(request):
@@ -965,6 +1639,9 @@ def AbandonCommit(request):
   connection = GetConnection(request)
   
   connection.AbandonCommit()
+  
+  # Any cached results read during the transaction may be stale now
+  query_cache.InvalidatePendingTables(request)
 
 
 def SetDirect(request, table, data, noop=False, update_returns_id=True, debug=SQL_DEBUG, commit=True):
@@ -1026,6 +1703,9 @@ def SetDirect(request, table, data, noop=False, update_returns_id=True, debug=SQ
     print sql
     result = connection.Query(sql, values, commit=commit)
     
+    # Invalidate any cached results for this table
+    query_cache.InvalidateTable(request, table, commit=commit)
+    
     # If we did an Update, we really want the 'id' field returned, like INSERT does (consistency and not having to do this all the time after an update)
     if result == 0 and update_returns_id:
       # If we have a primary 'id' key, use that
@@ -1045,7 +1725,64 @@ def SetDirect(request, table, data, noop=False, update_returns_id=True, debug=SQ
   return result
 
 
-def Get(request, table, record_id, version_number=None, use_working_version=True):
+def SetDirectBatch(request, table, rows, noop=False, commit=True):
+  """Put (insert/update) many records into this datasource, with multi-row INSERT queries.  Directly writes to database.
+  
+  Like SetDirect(), but a single query writes all the rows that have the same set of fields.  Callers should
+  limit the number of rows they pass in, to keep the query size reasonable.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    rows: list of dicts, records that we want to store in the table
+    noop: boolean (default False), if True do not actually query the database, (no operation)
+    commit: boolean (default True), if True any queries that could be commited will be (single query transaction), if False then a later Commit() will be required
+  
+  Returns: None
+  """
+  # INSERT values into a table, and if they already exist, perform an UPDATE on the fields
+  base_sql = "INSERT INTO `%s` (%s) VALUES %s ON DUPLICATE KEY UPDATE %s"
+  
+  # Every row in a multi-row INSERT must have the same fields, so group the rows by their fields
+  field_groups = {}
+  for row in rows:
+    keys = row.keys()
+    keys.sort()
+    keys = tuple(keys)
+    
+    if keys not in field_groups:
+      field_groups[keys] = []
+    
+    field_groups[keys].append(row)
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  for (keys, group_rows) in field_groups.items():
+    # Wrap all keys in backticks, so they cannot conflict with SQL keywords
+    keys_ticked = ['`%s`' % key for key in keys]
+    
+    # Update keys will reference the insert keys, so we dont have to specify the data twice (SQL does it)
+    update_sets = ['%s=VALUES(%s)' % (ticked_key, ticked_key) for ticked_key in keys_ticked]
+    
+    # One value format per row, and all the values in a single list
+    row_format = '(%s)' % ', '.join(['%s'] * len(keys))
+    values = []
+    for row in group_rows:
+      values += [row[key] for key in keys]
+    
+    sql = base_sql % (table, ', '.join(keys_ticked), ', '.join([row_format] * len(group_rows)), ', '.join(update_sets))
+    
+    if not noop:
+      connection.Query(sql, values, commit=commit)
+      
+      # Invalidate any cached results for this table
+      query_cache.InvalidateTable(request, table, commit=commit)
+    else:
+      Log('Set Direct Batch NO-OP: %s: %s rows' % (table, len(group_rows)))
+
+
+def Get(request, table, record_id, version_number=None, use_working_version=True, fields=None, use_cache=False):
   """Get (select single record) from this datasource.
   
   Can be a 'view', combining several lower level 'tables'.
@@ -1058,6 +1795,8 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
         tables.  version_change is scanned before version_commit, as these are more likely to be requested.
     use_working_version: boolean (default True), if True and version_number==None this will also look at any
         version_working data and return it instead the head table data, if it exists for this user.
+    fields: list of strings (default None), if not None, only these fields are selected and returned
+    use_cache: boolean (default False), if True use the query cache for the table record.  Version data is applied over it.
   
   Returns: dict, single record key/values
   """
@@ -1072,10 +1811,16 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
     (schema, schema_table) = GetInfoSchemaAndTable(request, table)
     
     try:
-      working_version = GetUserVersionWorkingRecord(request)
-
-      working_data = utility.path.LoadYamlFromString(working_version['data_yaml'])
-      delete_data = utility.path.LoadYamlFromString(working_version['delete_data_yaml'])
+      # Each working record is its own row, so we only need this record's
+      if GetWorkingVersionStorage(request) == WORKING_VERSION_STORAGE_RECORD:
+        rows = QueryWorkingRecordRows(request, request.user['id'], schema['id'], schema_table['id'], record_id)
+        (working_data, delete_data) = LoadWorkingRecordRows(rows)
+      
+      else:
+        working_version = GetUserVersionWorkingRecord(request)
+        
+        # Shared, so only the working record we find is copied
+        (working_data, delete_data) = working_version_cache.LoadWorkingVersionData(request, working_version['user_id'], working_version['data_yaml'], working_version['delete_data_yaml'], shared=True)
 
       # If the record was deleted, lets return None
       if delete_data and schema['id'] in delete_data:
@@ -1098,7 +1843,7 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
             # print '\n\nFound Working Record: %s\n\n' % table_data[record_id]
             
             # Update this data over the existing table data
-            found_version_record = table_data[record_id]
+            found_version_record = dict(table_data[record_id])
             
             # Ensure it has a record ID.  We remove this from the data, since it doesnt change, and it needs to be added back on these transition points
             found_version_record['id'] = record_id
@@ -1108,31 +1853,21 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
   
   # Else, if they want to retrieve a specified version number
   elif version_number:
-    # Look in the pending table first
-    version_record = Get(request, 'version_pending', version_number)
-    
-    print 'Found pending version: %s' % version_record
-    
-    # If we didnt find it in pending, check in committed
-    if not version_record:
-      version_record = Get(request, 'version_commit', version_number)
-      
-      print 'Found committed version: %s' % version_record
+    # Look in the pending table first, then in committed.  Committed version data is cached, and shared.
+    (version_data, is_pending) = GetVersionNumberData(request, version_number)
     
-      # If we didnt find it in commited, error
-      if not version_record:
-        raise RecordNotFound('Couldnt find version record: Table: %s:  Version: %s  Record ID: %s' % (table, version_number, record_id))
+    # If we didnt find it in either, error
+    if version_data == None:
+      raise RecordNotFound('Couldnt find version record: Table: %s:  Version: %s  Record ID: %s' % (table, version_number, record_id))
     
     
     # Get the schema and table info
     (schema, schema_table) = GetInfoSchemaAndTable(request, table)
     
-    rollback_record_data = utility.path.LoadYamlFromString(version_record['rollback_data_yaml'], {})
-    update_record_data = utility.path.LoadYamlFromString(version_record['data_yaml'], {})
-    delete_record_data = utility.path.LoadYamlFromString(version_record['delete_data_yaml'], {})
+    (update_record_data, delete_record_data, rollback_record_data) = version_data
     
-    # Layer the rollback data (if any), underneath the update data
-    record_data = rollback_record_data
+    # Layer the rollback data (if any), underneath the update data.  A new dict, as the version data may be shared.
+    record_data = dict(rollback_record_data)
     record_data.update(update_record_data)
     
     # If the record was deleted, lets return None
@@ -1153,8 +1888,8 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
 
         # If we have this record_id, in this table, in this database, then return the working record
         if record_id in table_data:
-          # Update this data over the existing table data
-          found_version_record = table_data[record_id]
+          # Update this data over the existing table data.  Copied, as the version data may be shared.
+          found_version_record = dict(table_data[record_id])
           
           # Ensure it has a record ID.  We remove this from the data, since it doesnt change, and it needs to be added back on these transition points
           found_version_record['id'] = record_id
@@ -1171,8 +1906,22 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
   
   #TODO(g): Confirm this is the primary key name, not just "id" all the time.  Can look this up in our schema_data_paths from connection_data...
   #TODO(g): Allow multiple fields for primary key, and do the right thing with them
-  sql = "SELECT * FROM `%s` WHERE id = %s" % (table, int(record_id))
-  result = connection.Query(sql)
+  sql = "SELECT %s FROM `%s` WHERE id = %s" % (GetSelectFields(fields, ['id']), table, int(record_id))
+  
+  # Get the record from the cache, if we want to and have it
+  use_cache = use_cache and CanUseQueryCache(request, table)
+  
+  result = query_cache.NoCacheResultFound
+  if use_cache:
+    cache_key = query_cache.GetCacheKey(request, table, 'get', int(record_id), fields)
+    result = query_cache.Get(request, table, cache_key)
+  
+  if result == query_cache.NoCacheResultFound:
+    generations = query_cache.GetTableGeneration(request, table)
+    result = connection.Query(sql)
+    
+    if use_cache:
+      query_cache.Set(request, table, cache_key, result, generations)
   
   if result:
     record = result[0]
@@ -1191,6 +1940,10 @@ def Get(request, table, record_id, version_number=None, use_working_version=True
       record = found_version_record
    
       # print 'Couldnt find Real Record, but Found Version Record:  Returning: %s (%s): %s' % (record_id, type(record_id), record)
+  
+  # Only return the fields that were asked for
+  if record and fields != None:
+    record = ProjectRows([record], fields)[0]
  
   return record
 
@@ -1215,11 +1968,42 @@ def Query(request, sql, params=None):
   # Query
   result = connection.Query(sql, params)
   
+  # We dont know what tables a raw write changed, so invalidate cached results for all of them
+  if not sql.strip().upper().startswith(('SELECT', 'SHOW', 'DESC')):
+    query_cache.InvalidateTable(request, None)
+  
   return result
 
 
-def Filter(request, table, data=None, use_working_version=False, order_list=None, groupby_list=None, order_ascending=True, version_number=None, limit=None, row_offset=None):
+def CanUseQueryCache(request, table):
+  """Returns boolean, True if this request can get and set cached results for this table in the query cache.
+  
+  Inside a transaction a request can read rows it hasnt committed yet, which other requests must never be given (they
+  may be abandoned), and cached rows would not have its own uncommitted writes.
+  """
+  if table in request.cache_pending_tables:
+    return False
+  
+  connection = GetConnection(request)
+  
+  if connection.in_transaction or not request.auto_commit:
+    return False
+  
+  return True
+
+
+def Filter(request, table, data=None, use_working_version=False, order_list=None, groupby_list=None, order_ascending=True, version_number=None, limit=None, row_offset=None, fields=None, row_format='dict', use_cache=False):
   """Get 0 or more records from the datasource, based on filtering rules.  Works against a single table.
+  
+  IN lists longer than MAX_IN_LIST_SIZE are split over several queries, and the results are merged.
+  
+  If fields is not None, only those fields are returned.  The id, filter and order fields are also selected, as the
+  version overlay needs them, and are removed again before returning.
+  
+  If row_format is 'compact', rows are tools.CompactRow instead of dicts.  See ROW_FORMATS.
+  
+  If use_cache is True, the table rows are kept in the query cache until the table is written to.  Version data is
+  always applied over the cached rows, so working version reads can use the cache too.
   """
   
   # print '\nFilter: %s: %s' % (table, data)
@@ -1227,14 +2011,87 @@ def Filter(request, table, data=None, use_working_version=False, order_list=None
   if not data:
     data = {}
   
-  base_sql = "SELECT * FROM `%s` WHERE %s %s %s"
+  if row_format not in ROW_FORMATS:
+    raise InvalidArguments('Filter: Unknown row format: %s  Allowed: %s' % (row_format, ', '.join(ROW_FORMATS)))
   
-  keys = data.keys()
-  keys.sort()
+  compact = (row_format == 'compact')
   
-  keys_ticked = []
-  where_list = []
-  values = []
+  # Get the rows from the cache, if we want to and have them
+  use_cache = use_cache and CanUseQueryCache(request, table)
+  
+  rows = query_cache.NoCacheResultFound
+  if use_cache:
+    cache_key = query_cache.GetCacheKey(request, table, 'filter', data, order_list, groupby_list, order_ascending, limit, row_offset, fields, compact)
+    rows = query_cache.Get(request, table, cache_key)
+  
+  if rows == query_cache.NoCacheResultFound:
+    generations = query_cache.GetTableGeneration(request, table)
+    
+    # If we have a large IN list, split it over several queries, so we dont make huge statements
+    chunk_key = GetFilterChunkKey(data)
+    
+    if chunk_key == None:
+      rows = QueryFilter(request, table, data, order_list=order_list, groupby_list=groupby_list, order_ascending=order_ascending, limit=limit, row_offset=row_offset, fields=fields, compact=compact)
+    
+    else:
+      rows = QueryFilterChunked(request, table, data, chunk_key, order_list=order_list, groupby_list=groupby_list, order_ascending=order_ascending, limit=limit, row_offset=row_offset, fields=fields, compact=compact)
+    
+    if use_cache:
+      query_cache.Set(request, table, cache_key, rows, generations)
+  
+  
+  # Assume we have no version data
+  (update_version, delete_version) = (None, None)
+  
+  # If we want to use the working version, and we havent specified a version number (we dont want to mix both, too confusing.  Version Number is more explicit, it wins)
+  #TODO(g): Move this section to generic_handler.py, because it can be generalized to all DB Handlers.
+  if use_working_version and version_number == None:
+    # Get the working version data for this user
+    (update_version, delete_version) = GetWorkingVersionTableData(request, table)
+    
+    # print 'Version Record: Working: %s: \nUpdate: %s\nDelete: %s\n' % (is_pending, update_version, delete_version)
+
+
+  # If we have specified an explicit version number, get it and see if it 
+  if version_number:
+    (version_data, is_pending) = GetVersionNumberData(request, version_number)
+    (update_version, delete_version, _) = version_data
+    
+    print 'Version Record: Pending: %s: \nUpdate: %s\nDelete: %s\n' % (is_pending, update_version, delete_version)
+  
+  
+  # If we have either update or deletes, from working, pending or committed versions.  We handle them all the same way.
+  if update_version or delete_version:
+    rows = ApplyVersionOverlay(request, table, rows, data, update_version, delete_version, order_list=order_list, order_ascending=order_ascending)
+  
+  # Only return the fields that were asked for, in the format asked for
+  rows = FormatRows(rows, fields=fields, row_format=row_format)
+  
+  return rows
+
+
+def QueryFilter(request, table, data, order_list=None, groupby_list=None, order_ascending=True, limit=None, row_offset=None, fields=None, compact=False):
+  """Returns list of dicts, the table rows matching the filter data.  No version data is applied, see Filter().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value or directive tuple (see GetFilterWhere())
+    order_list: list of strings, fields to order by
+    groupby_list: list of strings, fields to group by
+    order_ascending: boolean (default True), if False order descending
+    limit: int (default None), if not None, the maximum number of rows to return
+    row_offset: int (default None), if not None (and limit is set), the number of rows to skip first
+    fields: list of strings (default None), if not None, only select these fields, and the id, filter and order fields
+    compact: boolean (default False), if True return tools.CompactRow rows instead of dicts
+  
+  Returns: list of dicts (or tools.CompactRow)
+  """
+  # GROUP BY must come before ORDER BY
+  base_sql = "SELECT %s FROM `%s` WHERE %s %s %s"
+  
+  # Select the fields we want, and any the version overlay needs to match and order these rows
+  select_fields = GetSelectFields(fields, ['id'] + sorted(data.keys()) + list(order_list or []) + list(groupby_list or []))
   
   # Order By
   if order_list:
@@ -1248,20 +2105,521 @@ def Filter(request, table, data=None, use_working_version=False, order_list=None
   
   # Group By
   if groupby_list:
-    group_by = ' GROUP BY %s' % ', '.join(groupby_list)
+    group_by = ' GROUP BY %s' % ', '.join(('`'+item+'`' for item in groupby_list))
   else:
     group_by = ''
   
   
-  # Get our backticked wrapped insert keys, our value list, and our update setting
-  for count in range(0, len(keys)):
-    # Skip any fields that are NULL.  They are not helping us here, and cause problems with "=" vs "IS", because SQL implements NULL testing stupidly
-    if data[keys[count]] == None:
+  # Get our WHERE clauses and their values
+  (where_list, values) = GetFilterWhere(data)
+  
+  # Build out strings to insert into our base_sql
+  where_sql = ' AND '.join(where_list)
+  
+  # Create our final SQL, if we had WHERE list items
+  if where_list:
+    sql = base_sql % (select_fields, table, where_sql, group_by, order_by)
+  
+  # Else, get all the records
+  else:
+    sql = "SELECT %s FROM `%s` %s %s" % (select_fields, table, group_by, order_by)
+  
+  
+  # If limit rows
+  if limit:
+    # If we have a row offset, allow that too.  MySQL takes the offset and then the row count.
+    if row_offset:
+      sql  += ' LIMIT %d, %d' % (int(row_offset), int(limit))
+    else:
+      sql  += ' LIMIT %d' % int(limit)
+  
+  # Log('\n\nGetFromData: %s: %s\nSQL:%s\nValues:%s\n' % (table, data, sql, values))
+  
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  # Query
+  rows = connection.Query(sql, values, compact=compact)
+  
+  return rows
+
+
+def QueryFilterChunked(request, table, data, chunk_key, order_list=None, groupby_list=None, order_ascending=True, limit=None, row_offset=None, fields=None, compact=False):
+  """Returns list of dicts, like QueryFilter(), but splits the IN list of chunk_key over several queries and merges the rows.
+  
+  Each query has at most MAX_IN_LIST_SIZE values in its IN list.  Ordering, limit and row_offset are applied again
+  to the merged rows.  Grouping cant be merged, so it is not allowed.
+  
+  Returns: list of dicts
+  """
+  if groupby_list:
+    raise InvalidArguments('Filter: Cannot group by with an IN list longer than %s values: %s' % (MAX_IN_LIST_SIZE, chunk_key))
+  
+  # Each chunk only needs enough rows to get past the offset and fill the limit
+  if limit:
+    chunk_limit = (row_offset or 0) + limit
+  else:
+    chunk_limit = None
+  
+  rows = []
+  
+  for chunk_data in GetFilterChunks(data, chunk_key):
+    rows += list(QueryFilter(request, table, chunk_data, order_list=order_list, order_ascending=order_ascending, limit=chunk_limit, fields=fields, compact=compact))
+  
+  # Order the merged rows again
+  if order_list:
+    if order_ascending:
+      rows = datasource.SortRows(rows, order_list)
+    else:
+      rows = datasource.SortRows(rows, ['-%s' % item for item in order_list])
+  
+  # Apply our limit to the merged rows
+  if limit:
+    rows = rows[(row_offset or 0):(row_offset or 0) + limit]
+  
+  return rows
+
+
+def GetFilterChunkKey(data):
+  """Returns string or None, the field with the largest IN list in the filter data, if it is longer than MAX_IN_LIST_SIZE"""
+  chunk_key = None
+  chunk_size = MAX_IN_LIST_SIZE
+  
+  for (key, value) in data.items():
+    if type(value) in (tuple, list) and value[0].upper() == 'IN' and len(value[1]) > chunk_size:
+      chunk_key = key
+      chunk_size = len(value[1])
+  
+  return chunk_key
+
+
+def GetFilterChunks(data, chunk_key):
+  """Returns list of dicts, copies of the filter data, each with up to MAX_IN_LIST_SIZE of the chunk_key IN list values.
+  
+  Duplicate values are removed, so no row can match in more than one chunk.
+  """
+  match_list = []
+  match_set = set()
+  for value in data[chunk_key][1]:
+    if value not in match_set:
+      match_set.add(value)
+      match_list.append(value)
+  
+  chunks = []
+  
+  for start in range(0, len(match_list), MAX_IN_LIST_SIZE):
+    chunk_data = dict(data)
+    chunk_data[chunk_key] = ('IN', match_list[start:start + MAX_IN_LIST_SIZE])
+    chunks.append(chunk_data)
+  
+  return chunks
+
+
+def Count(request, table, data=None, use_working_version=False):
+  """Returns int, the number of records matching the filtering rules.  The rows are counted in the database, not fetched.
+  
+  With use_working_version, only the records in this user's working version are fetched, to count them as they
+  would be returned by Filter(use_working_version=True).
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value or directive tuple.  Same as Filter().
+    use_working_version: boolean (default False), if True this will also look at any version_working data for this user
+  
+  Returns: int
+  """
+  return QueryVersionCount(request, table, data, use_working_version, exists=False)
+
+
+def Exists(request, table, data=None, use_working_version=False):
+  """Returns boolean, True if any record matches the filtering rules.  Only tests for a single row in the database.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value or directive tuple.  Same as Filter().
+    use_working_version: boolean (default False), if True this will also look at any version_working data for this user
+  
+  Returns: boolean
+  """
+  return QueryVersionCount(request, table, data, use_working_version, exists=True) > 0
+
+
+def QueryVersionCount(request, table, data, use_working_version, exists=False):
+  """Returns int, the number of records matching the filter data, with the working version applied if use_working_version.
+  
+  Records changed in the working version are excluded from the database count, and tested against the filter data
+  here, with their version data applied.  If exists, stop counting at 1.
+  """
+  if not data:
+    data = {}
+  
+  count = 0
+  changed_ids = []
+  
+  if use_working_version:
+    (update_version, delete_version) = GetWorkingVersionTableData(request, table)
+    (update_table, delete_table) = GetVersionTableData(request, table, update_version, delete_version)
+    
+    changed_ids = sorted(set(update_table.keys()) | set(delete_table))
+    
+    if changed_ids:
+      filter_matches = tools.CompileFilter(data)
+      
+      # Get the real records for our changed records, to put the version data over
+      real_records = {}
+      for row in Filter(request, table, {'id': ('IN', changed_ids)}):
+        real_records[row['id']] = row
+      
+      for record_id in changed_ids:
+        # Deleted records dont count, and neither do records with no data
+        if record_id in delete_table or (record_id not in real_records and record_id not in update_table):
+          continue
+        
+        record = dict(real_records.get(record_id, {}))
+        record.update(update_table.get(record_id, {}))
+        record['id'] = record_id
+        
+        if filter_matches(record):
+          count += 1
+          
+          if exists:
+            return count
+  
+  count += QueryCount(request, table, data, exclude_ids=changed_ids, exists=exists)
+  
+  return count
+
+
+def QueryCount(request, table, data, exclude_ids=None, exists=False):
+  """Returns int, the number of table rows matching the filter data.  No version data is applied, see Count().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value or directive tuple (see GetFilterWhere())
+    exclude_ids: list of ints (default None), record ids not to count
+    exists: boolean (default False), if True only test for a single row, and return 0 or 1
+  
+  Returns: int
+  """
+  # If we have a large IN list, count each chunk.  Chunks never match the same rows, so we can add them up.
+  chunk_key = GetFilterChunkKey(data)
+  
+  if chunk_key != None:
+    count = 0
+    
+    for chunk_data in GetFilterChunks(data, chunk_key):
+      count += QueryCount(request, table, chunk_data, exclude_ids=exclude_ids, exists=exists)
+      
+      if exists and count:
+        break
+    
+    return count
+  
+  
+  # Get our WHERE clauses and their values
+  (where_list, values) = GetFilterWhere(data)
+  
+  if exclude_ids:
+    where_list.append('`id` NOT IN (%s)' % ', '.join(['%s'] * len(exclude_ids)))
+    values += list(exclude_ids)
+  
+  if exists:
+    sql = "SELECT 1 AS `row_exists` FROM `%s`" % table
+  else:
+    sql = "SELECT COUNT(*) AS `row_count` FROM `%s`" % table
+  
+  if where_list:
+    sql += ' WHERE %s' % ' AND '.join(where_list)
+  
+  if exists:
+    sql += ' LIMIT 1'
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  result = connection.Query(sql, values)
+  
+  if exists:
+    return len(result)
+  else:
+    return int(result[0]['row_count'])
+
+
+def Aggregate(request, table, data=None, group_by=None, aggregates=None):
+  """Returns list of dicts, one per group, with the group_by fields and the aggregates, from a single grouped SELECT.
+  
+  Works on the table data only, no version data is applied.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value or directive tuple.  Same as Filter().
+    group_by: list of strings (default None), fields to group by.  If None, there is a single group of all the rows.
+    aggregates: dict, key is the result name, value is tuple (function, field).  function is one of
+        AGGREGATE_FUNCTIONS, and field can be '*' for count.  ex: {'n': ('count', '*'), 'max_id': ('max', 'id')}
+  
+  Returns: list of dicts, ordered by the group_by fields
+  """
+  if not data:
+    data = {}
+  if not group_by:
+    group_by = []
+  
+  if not aggregates:
+    raise InvalidArguments('Aggregate requires at least one aggregate')
+  
+  if GetFilterChunkKey(data) != None:
+    raise InvalidArguments('Aggregate: Cannot aggregate with an IN list longer than %s values' % MAX_IN_LIST_SIZE)
+  
+  select_list = ['`%s`' % field for field in group_by]
+  
+  for (name, (function, field)) in sorted(aggregates.items()):
+    if function not in AGGREGATE_FUNCTIONS:
+      raise InvalidArguments('Aggregate: Unknown function: %s  Allowed: %s' % (function, ', '.join(sorted(AGGREGATE_FUNCTIONS))))
+    
+    if '`' in name or '`' in field:
+      raise InvalidArguments('Aggregate: Invalid name or field: %s: %s' % (name, field))
+    
+    # Only count can take all fields
+    if field == '*':
+      if function != 'count':
+        raise InvalidArguments('Aggregate: Only count can use field "*": %s' % name)
+      ticked_field = '*'
+    else:
+      ticked_field = '`%s`' % field
+    
+    # Functions are either a name to call on the field, or a format string for the field
+    if '%s' in AGGREGATE_FUNCTIONS[function]:
+      select_list.append('%s AS `%s`' % (AGGREGATE_FUNCTIONS[function] % ticked_field, name))
+    else:
+      select_list.append('%s(%s) AS `%s`' % (AGGREGATE_FUNCTIONS[function], ticked_field, name))
+  
+  sql = "SELECT %s FROM `%s`" % (', '.join(select_list), table)
+  
+  # Get our WHERE clauses and their values
+  (where_list, values) = GetFilterWhere(data)
+  
+  if where_list:
+    sql += ' WHERE %s' % ' AND '.join(where_list)
+  
+  if group_by:
+    ticked_group_by = ', '.join(['`%s`' % field for field in group_by])
+    sql += ' GROUP BY %s ORDER BY %s' % (ticked_group_by, ticked_group_by)
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  rows = connection.Query(sql, values)
+  
+  return list(rows)
+
+
+def GetVersionTableData(request, table, update_version, delete_version):
+  """Returns tuple (dict, list), the update records (keyed by record id) and the deleted record ids, for this table.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    update_version: dict, version update data, nested: schema_id, schema_table_id, record_id
+    delete_version: dict, version delete data, nested: schema_id, schema_table_id, list of record_ids
+  
+  Returns: tuple (dict, list), (update_table, delete_table)
+  """
+  (schema, schema_table) = GetInfoSchemaAndTable(request, table)
+  
+  update_table = (update_version or {}).get(schema['id'], {}).get(schema_table['id'], {})
+  delete_table = (delete_version or {}).get(schema['id'], {}).get(schema_table['id'], [])
+  
+  return (update_table, delete_table)
+
+
+def GetSelectFields(fields, required_fields=None):
+  """Returns string, the SELECT field list SQL: '*' if fields is None, or the backticked fields and required_fields.
+  
+  Args:
+    fields: list of strings, or None for all fields
+    required_fields: list of strings (default None), fields that must also be selected, to match or order rows by
+  
+  Returns: string
+  """
+  if fields == None:
+    return '*'
+  
+  select_list = []
+  
+  for field in list(fields) + list(required_fields or []):
+    if field not in select_list:
+      select_list.append(field)
+  
+  return ', '.join(['`%s`' % field for field in select_list])
+
+
+def FormatRows(rows, fields=None, row_format='dict'):
+  """Returns list, the rows with only the fields listed in fields (if not None), as dicts or tools.CompactRow (row_format)"""
+  if row_format == 'compact':
+    if fields != None:
+      return tools.ProjectCompactRows(rows, fields)
+    else:
+      # Version records added to the rows are dicts
+      return tools.ConvertToCompactRows(rows)
+  
+  if fields != None:
+    return ProjectRows(rows, fields)
+  
+  return rows
+
+
+def ProjectRows(rows, fields):
+  """Returns list of dicts, the rows with only the fields listed in fields (which they have)"""
+  projected_rows = []
+  
+  for row in rows:
+    projected_rows.append(dict([(field, row[field]) for field in fields if field in row]))
+  
+  return projected_rows
+
+
+def FilterPages(request, table, data=None, order_key='id', page_size=DEFAULT_BATCH_SIZE, cursor=None, use_working_version=False, fields=None, row_format='dict'):
+  """Get a page of records from the datasource, based on filtering rules, and a cursor to get the next page with.
+  
+  Pages with keyset pagination (WHERE order_key > last_seen ORDER BY order_key LIMIT page_size), so every page
+  costs the same, from the first to the last.  Filter() with limit/row_offset must read and skip all the earlier rows.
+  
+  With use_working_version, the working version is overlaid onto each page.  Working version records that are not
+  in the table are returned in the page their order_key falls in.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, key is fields, value is the equality value.  Same as Filter().
+    order_key: string (default 'id'), field to order and page on.  Must be unique.
+    page_size: int, number of table rows per page.  Working version records may add or remove rows from a page.
+    cursor: string (default None), the cursor returned with the previous page.  If None, get the first page.
+    use_working_version: boolean (default False), if True this will also look at any version_working data for this user
+    fields: list of strings (default None), if not None, only these fields are returned.  Same as Filter().
+    row_format: string (default 'dict'), 'dict' or 'compact' for tools.CompactRow rows.  Same as Filter().
+  
+  Returns: tuple (list of dicts, string or None), the page rows and the cursor for the next page.  The cursor is None on the last page.
+  """
+  if not data:
+    data = {}
+  
+  if row_format not in ROW_FORMATS:
+    raise InvalidArguments('FilterPages: Unknown row format: %s  Allowed: %s' % (row_format, ', '.join(ROW_FORMATS)))
+  
+  # Get where our last page ended
+  if cursor != None:
+    last_seen = tools.ParsePageCursor(cursor, order_key)
+  else:
+    last_seen = None
+  
+  # Get our WHERE clauses and their values, and start after the last row we have seen
+  (where_list, values) = GetFilterWhere(data)
+  
+  if last_seen != None:
+    where_list.append('`%s` > %%s' % order_key)
+    values.append(last_seen)
+  
+  sql = "SELECT %s FROM `%s`" % (GetSelectFields(fields, ['id', order_key] + sorted(data.keys())), table)
+  
+  if where_list:
+    sql += ' WHERE %s' % ' AND '.join(where_list)
+  
+  sql += ' ORDER BY `%s` LIMIT %d' % (order_key, int(page_size))
+  
+  # Get a connection
+  connection = GetConnection(request)
+  
+  rows = connection.Query(sql, values, compact=(row_format == 'compact'))
+  
+  # If we got a full page, there may be more, so this page ends at our last row.  Otherwise this is the last page.
+  if len(rows) == page_size:
+    page_end = rows[-1][order_key]
+    next_cursor = tools.FormatPageCursor(order_key, page_end)
+  else:
+    page_end = None
+    next_cursor = None
+  
+  # Overlay the working version onto this page
+  if use_working_version:
+    (update_version, delete_version) = GetWorkingVersionTableData(request, table)
+    
+    if update_version or delete_version:
+      rows = ApplyVersionOverlay(request, table, rows, data, update_version, delete_version, order_list=[order_key], key_range=(order_key, last_seen, page_end))
+  
+  # Only return the fields that were asked for, in the format asked for
+  rows = FormatRows(rows, fields=fields, row_format=row_format)
+  
+  return (rows, next_cursor)
+
+
+def ApplyVersionOverlay(request, table, rows, data, update_version, delete_version, order_list=None, key_range=None, order_ascending=True):
+  """Returns list of dicts, the rows with the version data (working, pending or committed) overlaid onto them.
+  
+  Updates are applied over the matching rows (which are removed if they no longer match the filter data), version
+  records that are not in the rows are added if they match the filter data, and rows that are deleted in the version
+  are removed.  See tools.OverlayVersionRows().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    rows: list of dicts, the rows from the table
+    data: dict, the filter data the rows were selected with
+    update_version: dict, version update data, nested: schema_id, schema_table_id, record_id
+    delete_version: dict, version delete data, nested: schema_id, schema_table_id, list of record_ids
+    order_list: list of strings (default None), fields to re-sort the rows by, once version records are added
+    key_range: tuple (default None), (order_key, after, upto), only add version records with order_key greater than
+        after and less than or equal to upto.  None for after or upto is unbounded.  Used for pages of rows.
+    order_ascending: boolean (default True), if False re-sort the rows descending
+  
+  Returns: list of dicts
+  """
+  (update_table, delete_table) = GetVersionTableData(request, table, update_version, delete_version)
+  
+  # Compile our filter data once, to test any version records against
+  filter_matches = tools.CompileFilter(data)
+  
+  rows = tools.OverlayVersionRows(rows, update_table, delete_table, filter_matches, key_range=key_range)
+  
+  # If we want these ordered, and updates could have added rows or changed the order, we need to sort them again
+  if order_list and update_table:
+    if order_ascending:
+      rows = datasource.SortRows(rows, order_list)
+    else:
+      rows = datasource.SortRows(rows, ['-%s' % item for item in order_list])
+  
+  return rows
+
+
+def GetFilterWhere(data):
+  """Returns tuple (list of strings, list), the WHERE clauses (to be joined with AND) and their values, from Filter() data.
+  
+  Args:
+    data: dict, key is fields, value is the equality value, or a tuple with a directive: ('IN', [...]),
+        ('NOT IN', [...]), ('IS', 'NULL'), ('BETWEEN', low, high), or a comparison: ('>', value), ('>=', value),
+        ('<', value), ('<=', value), ('!=', value), ('LIKE', pattern).
+        IN lists are bound as parameters, one per value.  Use Filter() for lists over MAX_IN_LIST_SIZE, which splits them.
+  
+  Returns: tuple (list of strings, list), (where_list, values)
+  """
+  keys = data.keys()
+  keys.sort()
+  
+  where_list = []
+  values = []
+  
+  # Get our backticked wrapped insert keys, our value list, and our update setting
+  for count in range(0, len(keys)):
+    # Skip any fields that are NULL.  They are not helping us here, and cause problems with "=" vs "IS", because SQL implements NULL testing stupidly
+    if data[keys[count]] == None:
       continue
     
     # Back tick column names
     ticked_key = '`%s`' % keys[count]
-    keys_ticked.append(ticked_key)
     
     # If this is a normal value.  All non-normal tests should be wrapped in tuple (not other sequences) for the proper magic to occur.
     if type(data[keys[count]]) not in (tuple, list):
@@ -1274,19 +2632,36 @@ def Filter(request, table, data=None, use_working_version=False, order_list=None
     
     # Else, we want to do something being 
     else:
-      #TODO(g): Do other op-codes too, so we can do many kinds of queries easily in this way
-      pass
+      directive = data[keys[count]][0].upper()
+      
+      # If the field is 'IN' or 'NOT IN' a list of values
+      if directive in ('IN', 'NOT IN'):
+        match_list = list(data[keys[count]][1])
+        
+        # An empty list is invalid SQL.  IN an empty list matches nothing, NOT IN an empty list matches any non-NULL value.
+        if not match_list:
+          if directive == 'IN':
+            where_list.append('0 = 1')
+          else:
+            where_list.append('%s IS NOT NULL' % ticked_key)
+        
+        # Values are passed in separate than the SQL string, so they are quoted properly and the statement can be reused
+        else:
+          where_list.append('%s %s (%s)' % (ticked_key, directive, ', '.join(['%s'] * len(match_list))))
+          values += match_list
+      
+      # If the field is compared to a single value: ('>', 5), ('!=', 'name'), ('LIKE', 'web%')
+      elif directive in FILTER_COMPARISON_DIRECTIVES:
+        where_list.append('%s %s %%s' % (ticked_key, directive))
+        values.append(data[keys[count]][1])
+      
+      # If the field is BETWEEN 2 values (inclusive): ('BETWEEN', 10, 20)
+      elif directive == 'BETWEEN':
+        where_list.append('%s BETWEEN %%s AND %%s' % ticked_key)
+        values += [data[keys[count]][1], data[keys[count]][2]]
       
-      # If the field is 'IN' a list of values
-      if data[keys[count]][0].upper() == 'IN':
-        match_list = data[keys[count]][1]
-        where_in_str = '(%s)' % ', '.join(str(x) for x in match_list)
-
-        # Set the full statement here, which means we have to handle quoting the strings ourselves, if VARCHAR-like type
-        where_list.append('%s IN %s' % (ticked_key, where_in_str))
-
       # If the field is 'IS' a list of values
-      elif data[keys[count]][0].upper() == 'IS':
+      elif directive == 'IS':
         # Just join all the terms: IS NULL, IS NOT NULL, IS IN, IS NOT IN, it doesnt matter as they all work out
         where_in_str = ' '.join(data[keys[count]])
         where_list.append('%s %s' % (ticked_key, where_in_str))
@@ -1295,191 +2670,245 @@ def Filter(request, table, data=None, use_working_version=False, order_list=None
       else:
         raise Exception('Filter: Unknown WHERE directive: %s' % data[keys[count]])
   
+  return (where_list, values)
+
+
+def GetInfoVersionNumber(request, version_number):
+  """Returns the version_* record information, for the specified version_number.
+  
+  First checks in version_pending, then checks version_commit.  It will only be in one or the other.
   
-  # Build out strings to insert into our base_sql
-  where_sql = ' AND '.join(where_list)
+  Returns: tuple (dict (or None), boolean), if found, the (record, is_pending), else (None, is_pending)
+  """
+  record = Get(request, 'version_pending', version_number)
+  is_pending = True
   
-  # Create our final SQL, if we had WHERE list items
-  if where_list:
-    sql = base_sql % (table, where_sql, order_by, group_by)
+  # If it wasn't in pending, get it in committed (if it exists)
+  if record == None:
+    record = Get(request, 'version_commit', version_number)
+    is_pending = False
   
-  # Else, get all the records
-  else:
-    sql = "SELECT * FROM `%s` %s %s" % (table, order_by, group_by)
+  return (record, is_pending)
+
+
+def GetVersionNumberData(request, version_number):
+  """Returns the parsed version data for the specified version_number, for reading only.
   
+  Like GetInfoVersionNumber(), first checks in version_pending, then checks version_commit.  Committed version data
+  never changes, so it is parsed once and cached (see version_commit_cache), and is shared by all readers.
   
-  # If limit rows
-  if limit:
-    # If we have a row offset, allow that too
-    if row_offset:
-      sql  += ' LIMIT %s,%s' % (row_offset, row_offset + limit)
-    else:
-      sql  += ' LIMIT %s' % limit
+  Returns: tuple ((dict, dict, dict) (or None), boolean), if found, ((update_data, delete_data, rollback_data), is_pending),
+      else (None, is_pending)
+  """
+  record = Get(request, 'version_pending', version_number, use_working_version=False)
   
-  # Log('\n\nGetFromData: %s: %s\nSQL:%s\nValues:%s\n' % (table, data, sql, values))
+  # Pending versions can still change, so they are always parsed
+  if record != None:
+    version_data = (tools.LoadVersionData(record['data_yaml'], {}), tools.LoadVersionData(record['delete_data_yaml'], {}),
+                    tools.LoadVersionData(record['rollback_data_yaml'], {}))
+    
+    return (version_data, True)
   
+  # Get the cached committed version data, if we have it
+  version_data = version_commit_cache.Get(request, version_number)
+  if version_data != None:
+    return (version_data, False)
   
-  # Get a connection
-  connection = GetConnection(request)
+  record = Get(request, 'version_commit', version_number, use_working_version=False)
+  if record == None:
+    return (None, False)
   
-  # Query
-  rows = connection.Query(sql, values)
+  version_data = (tools.LoadVersionData(record['data_yaml'], {}), tools.LoadVersionData(record['delete_data_yaml'], {}),
+                  tools.LoadVersionData(record['rollback_data_yaml'], {}))
   
+  version_commit_cache.Set(request, version_number, version_data)
   
-  # Assume we have no version data
-  (update_version, delete_version) = (None, None)
+  return (version_data, False)
+
+
+def GetVersionCommitDataBatch(request, version_commit_ids):
+  """Returns dict, version_commit_id -> parsed (update_data, delete_data, rollback_data), for reading only.  Commits that
+  dont exist are not in it.
   
-  # If we want to use the working version, and we havent specified a version number (we dont want to mix both, too confusing.  Version Number is more explicit, it wins)
-  #TODO(g): Move this section to generic_handler.py, because it can be generalized to all DB Handlers.
-  if use_working_version and version_number == None:
-    # Get the working version data for this user
-    (update_version, delete_version) = GetWorkingVersionData(request)
+  Like GetVersionNumberData(), but for many commits: the cached ones are shared from version_commit_cache, and the rest
+  are fetched with one query per MAX_IN_LIST_SIZE commits, and cached.
+  """
+  connection = GetConnection(request)
+  
+  result = {}
+  missing_ids = []
+  
+  for version_commit_id in sorted(set(version_commit_ids)):
+    version_data = version_commit_cache.Get(request, version_commit_id)
     
-    # print 'Version Record: Working: %s: \nUpdate: %s\nDelete: %s\n' % (is_pending, update_version, delete_version)
+    if version_data != None:
+      result[version_commit_id] = version_data
+    else:
+      missing_ids.append(version_commit_id)
+  
+  for offset in range(0, len(missing_ids), MAX_IN_LIST_SIZE):
+    chunk_ids = missing_ids[offset:offset + MAX_IN_LIST_SIZE]
+    
+    sql = "SELECT `id`, `data_yaml`, `delete_data_yaml`, `rollback_data_yaml` FROM `version_commit` WHERE `id` IN (%s)" % ', '.join(['%s'] * len(chunk_ids))
+    
+    for record in connection.Query(sql, chunk_ids):
+      version_data = (tools.LoadVersionData(record['data_yaml'], {}), tools.LoadVersionData(record['delete_data_yaml'], {}),
+                      tools.LoadVersionData(record['rollback_data_yaml'], {}))
+      
+      version_commit_cache.Set(request, record['id'], version_data)
+      
+      result[record['id']] = version_data
+  
+  return result
 
 
-  # If we have specified an explicit version number, get it and see if it 
-  if version_number:
-    (version_record, is_pending) = GetInfoVersionNumber(request, version_number)
-    update_version = utility.path.LoadYamlFromString(version_record['data_yaml'], {})
-    delete_version = utility.path.LoadYamlFromString(version_record['delete_data_yaml'], {})
-    
-    print 'Version Record: Pending: %s: \nUpdate: %s\nDelete: %s\n' % (is_pending, update_version, delete_version)
+def DiffVersions(request, from_version, to_version=None, tables=None, batch_size=DEFAULT_BATCH_SIZE):
+  """Yields the field level changes of records between two committed versions, or a committed version and HEAD.
   
+  The records changed by the commits after from_version, up to to_version, are found with the version_commit_log
+  indexes (see CreateVersionIndexes()), a batch_size range of commits per query.  A record's image in a version is
+  the rollback data of the next commit that changed it, or its HEAD record if no later commit changed it.  Only these
+  images are loaded, a batch of records at a time, so large ranges are streamed.
   
-  # If we have either update or deletes, from working, pending or committed versions.  We handle them all the same way.
-  if update_version or delete_version:
-    (schema, schema_table) = GetInfoSchemaAndTable(request, table)
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    from_version: int, version_commit.id to diff from.  Its changes are already in the "before" images.  0 for before
+        the first commit.
+    to_version: int (default None), version_commit.id to diff to.  If None, diff to HEAD.
+    tables: list of strings (default None), if not None, only diff records in these tables
+    batch_size: int (default DEFAULT_BATCH_SIZE), the commits per log query, and records per batch of images
+  
+  Yields: dicts, ordered by (schema_table_id, id): {'table': table name, 'id': record id, 'action': 'insert',
+      'update' or 'delete' (see tools.DiffRecordImages()), 'fields': dict of field -> (before value, after value)}
+  """
+  connection = GetConnection(request)
+  
+  # Only look at the logs of these tables
+  table_sql = ''
+  table_args = []
+  if tables != None:
+    schema_table_ids = [GetInfoSchemaAndTable(request, table)[1]['id'] for table in tables]
     
-    # Ensure rows is a list (mutable)
-    if type(rows) == tuple:
-      rows = list(rows)
+    # No tables, no changes
+    if not schema_table_ids:
+      return
     
-    # Look to see if we have an Updates from our Working Version data, to make changes to the rows
-    if schema['id'] in update_version:
-      update_schema = update_version[schema['id']]
-      
-      if schema_table['id'] in update_schema:
-        update_table = update_schema[schema_table['id']]
-        
-        # Get a list of all the row IDs, so we can see if we need to add any
-        row_id_list = []
-        
-        # Loop over our row results
-        for row in rows:
-          # Add the row ID, so we know them all
-          row_id_list.append(row['id'])
-          
-          # If the row we got from Filter() exists in our update_table, update those contents over the row
-          if row['id'] in update_table:
-            row.update(update_table[row['id']])
-        
-        # Loop over the update_table, and see if we have any entries we dont have in the rows, but that meet the requirement
-        for (item_key, item) in update_table.items():
-          # Set the ID field.  We remove it when putting it into the working table, because it doesnt change, so we have to add it back when creating records from that that table
-          item['id'] = item_key
-          
-          # If this is a potential match
-          if item['id'] not in row_id_list:
-            
-            # print 'Found potential match: %s' % item
-            
-            #TODO(t): this shouldn't live right here-- as I imagine we'll need to call this from multiple places
-            def check_filter(item, filter_key, filter_value):
-              """Return whether the item's filter_key matches the value definition of filter_value
-              """
-              if filter_key not in item:
-                return False
-              # If this is just a normal value, then we just need to compare
-              if type(filter_value) not in (tuple, list):
-                return item[filter_key] == filter_value
-              else:
-                # If the field is 'IN' a list of values
-                if filter_value[0].upper() == 'IN':
-                  match_list = filter_value[1]
-                  return item[filter_key] in match_list
-                else:
-                  #TODO(t): this should implement the other checks (such as IS)
-                  raise NotImplementedError('Filter does not support filter_value of %s' % filter_value)
-              return True
-            
-            # Check if any of the filter key-values dont match, we only want to add it if they all match
-            filter_data_matched = True
-            for (filter_key, filter_value) in data.items():
-              if not check_filter(item, filter_key, filter_value):
-                filter_data_matched = False
-                # print '  Not matched: %s != %s' % (item.get(filter_key, '*KEY NOT FOUND*'), filter_value)
-                break
-            
-            # If all the conditions are met
-            if filter_data_matched:
-              # Add this record to the rows.
-              rows.append(item)
-              
-              #TODO(g): Sort these.  Order By, Group By, etc.
-              pass
-        
-        #TODO(g): Order by, group by, etc.  We can control ALL the data so it's perfectly integrated, and looks like its part of the query
-        pass
+    table_sql = ' AND `schema_table_id` IN (%s)' % ', '.join(['%s'] * len(schema_table_ids))
+    table_args = schema_table_ids
+  
+  # The last commit, if we are diffing to HEAD
+  last_version = to_version
+  if last_version == None:
+    result = connection.Query("SELECT MAX(`id`) AS `last_version` FROM `version_commit`")
+    last_version = result[0]['last_version'] or 0
+  
+  # record_key -> (version_commit_id, logged record_id), the first commit that changed it after from_version.  New
+  #   Records are logged with their negative version id, so keep that to find them in the commit's data.
+  first_changes = {}
+  
+  sql = "SELECT `version_commit_id`, `schema_id`, `schema_table_id`, `record_id` FROM `version_commit_log` WHERE `version_commit_id` > %s AND `version_commit_id` <= %s" + table_sql
+  
+  for window_start in range(from_version, last_version, batch_size):
+    window_end = min(window_start + batch_size, last_version)
+    
+    for log in connection.Query(sql, [window_start, window_end] + table_args):
+      record_key = (log['schema_id'], log['schema_table_id'], log['record_id'])
       
-    # If we want these ordered, we need to sort them again
-    if order_list:
-      # Sort the rows by the order_list, so we have an ordered return set again
-      rows = datasource.SortRows(rows, order_list)
+      if record_key not in first_changes or log['version_commit_id'] < first_changes[record_key][0]:
+        first_changes[record_key] = (log['version_commit_id'], log['record_id'])
+  
+  # Find the ids that New Records were inserted as, in the data of the commit that inserted them
+  new_records = [(record_key, change) for (record_key, change) in first_changes.items() if record_key[2] < 0]
+  if new_records:
+    commit_data = GetVersionCommitDataBatch(request, [version_commit_id for (_, (version_commit_id, _)) in new_records])
+  
+  for ((schema_id, schema_table_id, record_id), change) in new_records:
+    del first_changes[(schema_id, schema_table_id, record_id)]
     
+    # Commits from before their records ids were saved cant be matched to a record
+    inserted_record = commit_data.get(change[0], ({}, {}, {}))[0].get(schema_id, {}).get(schema_table_id, {}).get(record_id)
+    if not inserted_record or inserted_record.get('id', -1) < 0:
+      Log('Diff Versions: Skipping New Record without an inserted id: Commit: %s: %s' % (change[0], (schema_id, schema_table_id, record_id)))
+      continue
     
-    # print '\n\n+++ Delete version: %s' % delete_version
+    record_key = (schema_id, schema_table_id, inserted_record['id'])
+    if record_key not in first_changes or change[0] < first_changes[record_key][0]:
+      first_changes[record_key] = change
+  
+  record_keys = sorted(first_changes.keys())
+  
+  for offset in range(0, len(record_keys), batch_size):
+    batch_keys = record_keys[offset:offset + batch_size]
     
-    # If we have any entries that we might need to delete, in our working version (delete versions)
-    if schema['id'] in delete_version:
-      delete_schema = delete_version[schema['id']]
+    # record_key -> (version_commit_id, logged record_id), the first commit that changed it after to_version, if any
+    next_changes = {}
+    if to_version != None:
+      table_record_ids = {}
+      for (schema_id, schema_table_id, record_id) in batch_keys:
+        table_record_ids.setdefault((schema_id, schema_table_id), []).append(record_id)
       
-      if schema_table['id'] in delete_schema:
-        delete_table = delete_schema[schema_table['id']]
-        
-        # print '\n\n-*- Found entry in Delete Version table while in Filter: %s' % delete_table
+      for ((schema_id, schema_table_id), record_ids) in sorted(table_record_ids.items()):
+        sql = "SELECT `record_id`, MIN(`version_commit_id`) AS `version_commit_id` FROM `version_commit_log` WHERE `schema_id` = %s AND `schema_table_id` = %s"
+        sql += " AND `record_id` IN (%s) AND `version_commit_id` > %%s GROUP BY `record_id`" % ', '.join(['%s'] * len(record_ids))
         
-        delete_rows = []
-        
-        # Add any rows matching our delete entry to the delete list
-        for row in rows:
-          if row['id'] in delete_table:
-            # print 'Matched delete row: %s' % row
-            delete_rows.append(row)
-        
-        # Remove any rows marked for deletion
-        for row in delete_rows:
-          # print 'Removing row: %s' % row
-          rows.remove(row)
-
-
-
-  return rows
+        for log in connection.Query(sql, [schema_id, schema_table_id] + record_ids + [to_version]):
+          next_changes[(schema_id, schema_table_id, log['record_id'])] = (log['version_commit_id'], log['record_id'])
+    
+    # Load the commits with our images, and the HEAD records of the records that havent changed since to_version
+    commit_ids = [first_changes[record_key][0] for record_key in batch_keys] + [version_commit_id for (version_commit_id, _) in next_changes.values()]
+    commit_data = GetVersionCommitDataBatch(request, commit_ids)
+    
+    head_records = GetRecordsByKey(request, [record_key for record_key in batch_keys if record_key not in next_changes])
+    
+    for record_key in batch_keys:
+      (schema_id, schema_table_id, record_id) = record_key
+      
+      before = GetRollbackImage(commit_data, record_key, first_changes[record_key])
+      
+      if record_key in next_changes:
+        after = GetRollbackImage(commit_data, record_key, next_changes[record_key])
+      else:
+        after = head_records[record_key]
+      
+      diff = tools.DiffRecordImages(before, after)
+      if diff == None:
+        continue
+      
+      (schema, schema_table) = GetInfoSchemaAndTableById(request, schema_table_id)
+      
+      yield {'table': schema_table['name'], 'id': record_id, 'action': diff[0], 'fields': diff[1]}
 
 
-def GetInfoVersionNumber(request, version_number):
-  """Returns the version_* record information, for the specified version_number.
+def GetRollbackImage(commit_data, record_key, change):
+  """Returns dict or None, a record's image before a commit changed it: the commit's rollback data of it.
   
-  First checks in version_pending, then checks version_commit.  It will only be in one or the other.
+  Args:
+    commit_data: dict, version_commit_id -> parsed (update_data, delete_data, rollback_data)
+    record_key: tuple, (schema_id, schema_table_id, record_id)
+    change: tuple, (version_commit_id, record_id the commit logged the record with)
   
-  Returns: tuple (dict (or None), boolean), if found, the (record, is_pending), else (None, is_pending)
+  Returns: dict or None, a copy of the record, None if it didnt exist before the commit
   """
-  record = Get(request, 'version_pending', version_number)
-  is_pending = True
+  (schema_id, schema_table_id, record_id) = record_key
+  (version_commit_id, logged_record_id) = change
   
-  # If it wasn't in pending, get it in committed (if it exists)
+  (_, _, rollback_data) = commit_data.get(version_commit_id, ({}, {}, {}))
+  
+  record = rollback_data.get(schema_id, {}).get(schema_table_id, {}).get(logged_record_id)
   if record == None:
-    record = Get(request, 'version_commit', version_number)
-    is_pending = False
+    return None
   
-  return (record, is_pending)
+  return dict(record)
 
 
-def GetWorkingVersionData(request, username=None):
+def GetWorkingVersionData(request, username=None, shared=False):
   """Returns the version_working record's data_yaml, already parsed to Python data dict
   
   Args:
     request: Request Object, the connection spec data and user and auth info, etc
+    username: string (default None), user to get the working version of.  If None, the requesting user.
+    shared: boolean (default False), if True return the cached parsed data, which must not be changed.  Only for callers
+        that read the data.  If False a copy is returned.
   
   Returns: tuple of (dict, dict), which is (update_version, delete_version), respectively
   """
@@ -1493,19 +2922,17 @@ def GetWorkingVersionData(request, username=None):
   if not user:
     return ({}, {})
   
+  # Each working record is its own row
+  if GetWorkingVersionStorage(request) == WORKING_VERSION_STORAGE_RECORD:
+    return LoadWorkingRecordRows(QueryWorkingRecordRows(request, user['id']))
+  
   try:
     
-    version_working_list = Filter(request, 'version_working', {'user_id': user['id']})
+    version_working_list = Filter(request, 'version_working', {'user_id': user['id']}, fields=['data_yaml', 'delete_data_yaml'])
     version_working = version_working_list[0]
     
-    update_version = utility.path.LoadYamlFromString(version_working['data_yaml'])
-    delete_version = utility.path.LoadYamlFromString(version_working['delete_data_yaml'])
-  
-    # Ensure they are properly initialized
-    if update_version == None:
-      update_version = {}
-    if delete_version == None:
-      delete_version = {}
+    # Only parsed again if the data has changed since we last parsed it.  Empty data is {}.
+    (update_version, delete_version) = working_version_cache.LoadWorkingVersionData(request, user['id'], version_working['data_yaml'], version_working['delete_data_yaml'], shared=shared)
     
     return (update_version, delete_version)
   
@@ -1524,6 +2951,11 @@ def SetWorkingVersionData(request, working_version, delete_version=None):
   """
   user = GetUser(request)
   
+  # Each working record is its own row, so replace all of them
+  if GetWorkingVersionStorage(request) == WORKING_VERSION_STORAGE_RECORD:
+    SetWorkingRecordData(request, user['id'], working_version, delete_version)
+    return
+  
   # Get the current working record directly, if we have it
   working_list = Filter(request, 'version_working', {'user_id': user['id']})
   if working_list:
@@ -1533,14 +2965,299 @@ def SetWorkingVersionData(request, working_version, delete_version=None):
   
   
   # Convert to YAML, for storage
-  record['data_yaml'] = utility.path.DumpYamlAsString(working_version)
+  record['data_yaml'] = tools.DumpVersionData(working_version)
   
   # If we specified delete, update that too
   if delete_version != None:
-    record['delete_data_yaml'] = utility.path.DumpYamlAsString(delete_version)
+    record['delete_data_yaml'] = tools.DumpVersionData(delete_version)
   
   # Update the working record
   SetDirect(request, 'version_working', record)
+  
+  # Cache what we wrote, so it doesnt need to be parsed again
+  if delete_version == None:
+    delete_version = tools.LoadVersionData(record['delete_data_yaml'], {})
+  working_version_cache.StoreWorkingVersionData(request, user['id'], record['data_yaml'], record['delete_data_yaml'], working_version, delete_version)
+
+
+def GetWorkingVersionTableData(request, table):
+  """Returns the requesting user's working version data, for reading only.  It may only contain this table.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table that will be read from the version data
+  
+  Returns: tuple of (dict, dict), which is (update_version, delete_version), respectively
+  """
+  if GetWorkingVersionStorage(request) != WORKING_VERSION_STORAGE_RECORD:
+    return GetWorkingVersionData(request, shared=True)
+  
+  (schema, schema_table) = GetInfoSchemaAndTable(request, table)
+  
+  user = GetUser(request)
+  
+  if not user:
+    return ({}, {})
+  
+  return LoadWorkingRecordRows(QueryWorkingRecordRows(request, user['id'], schema['id'], schema_table['id']))
+
+
+def SetWorkingRecordData(request, user_id, update_data, delete_data=None):
+  """Replace all of a user's version_working_record rows with this version data, in a single transaction.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    user_id: int, user.id
+    update_data: dict, version update data, nested: schema_id, schema_table_id, record_id
+    delete_data: dict (default None), version delete data, nested: schema_id, schema_table_id, list of record_ids.  If
+        None, the current working deletes are kept.
+  """
+  connection = GetConnection(request)
+  
+  # Turn off auto-commit until we are done, so if a save fails the DELETE is rolled back, instead of wiping the working set
+  began = connection.Begin()
+  
+  try:
+    # Keep the current deletes, like the version_working delete_data_yaml is kept
+    if delete_data == None:
+      (_, delete_data) = LoadWorkingRecordRows(QueryWorkingRecordRows(request, user_id, for_update=True))
+    
+    connection.Query("DELETE FROM `version_working_record` WHERE `user_id` = %s", [user_id], commit=False)
+    
+    for (schema_id, schema_data) in update_data.items():
+      for (schema_table_id, table_data) in schema_data.items():
+        for (record_id, record) in table_data.items():
+          SaveWorkingRecordRow(request, user_id, schema_id, schema_table_id, record_id, record, commit=False)
+    
+    for (schema_id, schema_data) in delete_data.items():
+      for (schema_table_id, record_ids) in schema_data.items():
+        for record_id in record_ids:
+          SaveWorkingRecordRow(request, user_id, schema_id, schema_table_id, record_id, is_delete=True, commit=False)
+    
+    # If we are inside a caller's transaction, it commits
+    if began:
+      connection.Commit()
+  
+  except Exception, e:
+    if began:
+      connection.AbandonCommit()
+    raise
+
+
+def GetWorkingVersionStorage(request):
+  """Returns string, the working version storage mode of this datasource: WORKING_VERSION_STORAGE_DOCUMENT (default) or
+  WORKING_VERSION_STORAGE_RECORD.
+  """
+  storage = request.connection_data['datasource'].get('working_version_storage', WORKING_VERSION_STORAGE_DOCUMENT)
+  
+  if storage not in WORKING_VERSION_STORAGE_MODES:
+    raise InvalidArguments('Unknown working_version_storage: %s  Allowed: %s' % (storage, ', '.join(WORKING_VERSION_STORAGE_MODES)))
+  
+  return storage
+
+
+def CreateWorkingRecordTable(request):
+  """Create the version_working_record table, used by the 'record' working version storage mode, if it doesnt exist."""
+  connection = GetConnection(request)
+  
+  connection.Query(VERSION_WORKING_RECORD_DDL)
+
+
+def CreateVersionIndexes(request):
+  """Create the VERSION_INDEXES on the version tables, if they dont exist.  An index with the same name but different
+  fields (ex: from an older VERSION_INDEXES) is rebuilt with the current fields.
+  
+  Returns: list of strings, the "table.index" names that were created or rebuilt
+  """
+  connection = GetConnection(request)
+  
+  created = []
+  
+  for (table, index_name, fields) in VERSION_INDEXES:
+    # MySQL has no CREATE INDEX IF NOT EXISTS, so look for it first
+    result = connection.Query("SHOW INDEX FROM `%s` WHERE Key_name = %%s" % table, [index_name])
+    
+    existing_fields = [row['Column_name'] for row in sorted(result, key=lambda row: row['Seq_in_index'])]
+    if existing_fields == fields:
+      continue
+    
+    fields_ticked = ['`%s`' % field for field in fields]
+    
+    # Drop and add in one ALTER, so the table is never without the index
+    if existing_fields:
+      sql = "ALTER TABLE `%s` DROP INDEX `%s`, ADD INDEX `%s` (%s)" % (table, index_name, index_name, ', '.join(fields_ticked))
+    else:
+      sql = "ALTER TABLE `%s` ADD INDEX `%s` (%s)" % (table, index_name, ', '.join(fields_ticked))
+    
+    connection.Query(sql)
+    
+    created.append('%s.%s' % (table, index_name))
+  
+  return created
+
+
+def QueryWorkingRecordRows(request, user_id, schema_id=None, schema_table_id=None, record_id=None, for_update=False):
+  """Returns list of dicts, a user's version_working_record rows.  Optionally only for a schema, table or record.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    user_id: int, user.id
+    schema_id: int (default None), if not None, only rows for this schema
+    schema_table_id: int (default None), if not None, only rows for this schema_table (requires schema_id)
+    record_id: int (default None), if not None, only the row for this record (requires schema_table_id)
+    for_update: boolean (default False), if True lock the rows until the transaction ends (see Connection.Begin())
+  
+  Returns: list of dicts
+  """
+  connection = GetConnection(request)
+  
+  where = ['`user_id` = %s']
+  params = [user_id]
+  
+  # Each field narrows the prefix of the user_record index
+  for (field, value) in (('schema_id', schema_id), ('schema_table_id', schema_table_id), ('record_id', record_id)):
+    if value == None:
+      break
+    
+    where.append('`%s` = %%s' % field)
+    params.append(value)
+  
+  sql = "SELECT * FROM `version_working_record` WHERE %s" % ' AND '.join(where)
+  
+  if for_update:
+    sql += ' FOR UPDATE'
+  
+  return connection.Query(sql, params)
+
+
+def LoadWorkingRecordRows(rows):
+  """Returns tuple of (dict, dict), (update_data, delete_data) nested like version data, from version_working_record rows"""
+  update_data = {}
+  delete_data = {}
+  
+  for row in rows:
+    if row['is_delete']:
+      delete_data.setdefault(row['schema_id'], {}).setdefault(row['schema_table_id'], []).append(row['record_id'])
+    else:
+      record = tools.LoadVersionData(row['data_yaml'], {}, int_key_levels=0)
+      update_data.setdefault(row['schema_id'], {}).setdefault(row['schema_table_id'], {})[row['record_id']] = record
+  
+  return (update_data, delete_data)
+
+
+def SaveWorkingRecordRow(request, user_id, schema_id, schema_table_id, record_id, record=None, is_delete=False, commit=True):
+  """Insert or update a single version_working_record row.  If it is not a delete, and record is empty, the row is removed.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    user_id: int, user.id
+    schema_id: int, schema.id
+    schema_table_id: int, schema_table.id
+    record_id: int, primary key of the record
+    record: dict (default None), the record's changed fields
+    is_delete: boolean (default False), if True the record is deleted in the working version
+    commit: boolean (default True), if True commit immediately
+  """
+  connection = GetConnection(request)
+  
+  key_params = [user_id, schema_id, schema_table_id, record_id]
+  
+  # Nothing left to change, so there is no working record
+  if not is_delete and not record:
+    sql = "DELETE FROM `version_working_record` WHERE `user_id` = %s AND `schema_id` = %s AND `schema_table_id` = %s AND `record_id` = %s"
+    connection.Query(sql, key_params, commit=commit)
+    return
+  
+  if is_delete:
+    data_yaml = None
+  else:
+    data_yaml = tools.DumpVersionData(record)
+  
+  sql = "INSERT INTO `version_working_record` (`user_id`, `schema_id`, `schema_table_id`, `record_id`, `is_delete`, `data_yaml`)" \
+        " VALUES (%s, %s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE `is_delete` = VALUES(`is_delete`), `data_yaml` = VALUES(`data_yaml`)"
+  connection.Query(sql, key_params + [int(bool(is_delete)), data_yaml], commit=commit)
+
+
+def SetWorkingRecord(request, table, data, real_records=None):
+  """Set a record into this user's working version, in the 'record' working version storage mode.
+  
+  Same rules as datasource.SetVersion(): fields are merged into the working record, fields that are the same as the
+  Real record are not stored, and setting a record undoes a working delete.  Only this record's row is read and written.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    data: dict, record to set, must have its `id`
+    real_records: dict (default None), if not None, this table's Real records already fetched, record_id -> record.
+        Records not in it dont exist.
+  """
+  (schema, schema_table) = GetInfoSchemaAndTable(request, table)
+  
+  user = GetUser(request)
+  
+  record_id = data['id']
+  
+  # Get the Real record (if it exists), so we only store fields that are different
+  if real_records != None:
+    real_record = real_records.get(record_id)
+  else:
+    real_record = Get(request, table, record_id, use_working_version=False)
+  
+  connection = GetConnection(request)
+  
+  # Read and save this record's working row in one transaction, so its FOR UPDATE lock is held until the save, and
+  #   concurrent sets of this record wait for each other instead of losing each other's fields
+  began = connection.Begin()
+  
+  try:
+    rows = QueryWorkingRecordRows(request, user['id'], schema['id'], schema_table['id'], record_id, for_update=True)
+    
+    record = {}
+    if rows and not rows[0]['is_delete']:
+      record = tools.LoadVersionData(rows[0]['data_yaml'], {}, int_key_levels=0)
+    
+    record.update(data)
+    
+    # Remove any fields that match the Real record, compared as strings like datasource.SetVersion()
+    if real_record:
+      for (real_key, real_value) in real_record.items():
+        if real_key in record:
+          if str(real_value) == str(record[real_key]) or (real_value == None and record[real_key] == ''):
+            del record[real_key]
+    
+    SaveWorkingRecordRow(request, user['id'], schema['id'], schema_table['id'], record_id, record, commit=False)
+    
+    # If we are inside a caller's transaction, it commits
+    if began:
+      connection.Commit()
+  
+  except Exception, e:
+    if began:
+      connection.AbandonCommit()
+    raise
+
+
+def DeleteWorkingRecord(request, table, record_id):
+  """Delete a record in this user's working version, in the 'record' working version storage mode.
+  
+  Same rules as datasource.DeleteVersion(): Real records are marked deleted, and any working changes to the record are
+  removed.  Only this record's row is written.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    record_id: int, primary key of the record
+  """
+  (schema, schema_table) = GetInfoSchemaAndTable(request, table)
+  
+  user = GetUser(request)
+  
+  real_record = Get(request, table, record_id, use_working_version=False)
+  
+  # Only Real records can be deleted, new (negative id) records just lose their working changes
+  is_delete = bool(real_record) and record_id >= 0
+  
+  SaveWorkingRecordRow(request, user['id'], schema['id'], schema_table['id'], record_id, is_delete=is_delete)
 
 
 def Delete(request, table, record_id, noop=False, commit=True):
@@ -1566,10 +3283,40 @@ def Delete(request, table, record_id, noop=False, commit=True):
   # Delete the record
   if not noop:
     connection.Query(sql, [record_id], commit=commit)
+    
+    # Invalidate any cached results for this table
+    query_cache.InvalidateTable(request, table, commit=commit)
   else:
     Log('Delete NO-OP: %s: %s' % (table, record_id))
 
 
+def DeleteAll(request, table, noop=False, commit=True):
+  """Delete all the records in a table.
+  
+  DeleteFilter() will not truncate a table, so this is the explicit way to do it, for things like ImportData(drop_first=True).
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table to operate on
+    noop: boolean (default False), if True do not actually query the database, (no operation)
+    commit: boolean (default True), if True any queries that could be commited will be (single query transaction), if False then a later Commit() will be required
+  
+  Returns: None
+  """
+  # Get a connection
+  connection = GetConnection(request)
+  
+  sql = "DELETE FROM `%s`" % table
+  
+  if not noop:
+    connection.Query(sql, commit=commit)
+    
+    # Invalidate any cached results for this table
+    query_cache.InvalidateTable(request, table, commit=commit)
+  else:
+    Log('Delete All NO-OP: %s' % table)
+
+
 def DeleteFilter(request, table, data, noop=False, commit=True):
   """Delete 0 or more records from the datasource, based on filtering rules.
   
@@ -1622,6 +3369,169 @@ def DeleteFilter(request, table, data, noop=False, commit=True):
   if not noop:
     connection.Query(sql, values, commit=commit)
     
+    # Invalidate any cached results for this table
+    query_cache.InvalidateTable(request, table, commit=commit)
+    
   else:
     Log('Delete Filter NO-OP: %s: %s' % (sql, values))
 
+
+def AcquireLock(request, lock, timeout=None, sleep_interval=lock_manager.DEFAULT_BACKOFF_INITIAL):
+  """Get a named lock, shared by all threads and processes using this database.
+  
+  Threads of this process wait on an in-process lock first, so only one at a time waits on the database's GET_LOCK(),
+  which waits on the server.  Held until ReleaseLock(), or until the request releases its connections (Request.Release()),
+  which releases any locks it still holds, so they dont stay with the pooled connection.
+  
+  GET_LOCK() locks belong to the connection, so release the lock with the same request.  Before MySQL 5.7 a
+  connection can only hold one of them, and getting another releases the first.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    lock: string, lock name
+    timeout: float (default None), seconds to wait before giving up.  If None, wait forever.
+    sleep_interval: float, first backoff interval (seconds) between attempts, doubling each attempt
+  
+  Returns: boolean, True if we got the lock, False if we timed out
+  """
+  started = time.time()
+  
+  if not lock_manager.AcquireLocalLock(lock, timeout=timeout, backoff_initial=sleep_interval):
+    lock_manager.IncrementLockMetric('timeouts')
+    return False
+  
+  try:
+    if timeout != None:
+      timeout = max(timeout - (time.time() - started), 0)
+    
+    acquired = AcquireDatabaseLock(request, lock, timeout=timeout, sleep_interval=sleep_interval)
+  
+  except Exception, e:
+    lock_manager.ReleaseLocalLock(lock)
+    raise
+  
+  if not acquired:
+    lock_manager.ReleaseLocalLock(lock)
+    lock_manager.IncrementLockMetric('timeouts')
+    return False
+  
+  lock_manager.IncrementLockMetric('acquired')
+  lock_manager.RecordLockWait(time.time() - started)
+  
+  return True
+
+
+def AcquireDatabaseLock(request, lock, timeout=None, sleep_interval=lock_manager.DEFAULT_BACKOFF_INITIAL):
+  """Get a named lock with GET_LOCK(), for this request's connection.  Use AcquireLock(), which waits in-process first.
+  
+  Returns: boolean, True if we got the lock, False if we timed out
+  """
+  connection = GetConnection(request)
+  
+  lock_name = GetDatabaseLockName(request, lock)
+  
+  started = time.time()
+  attempt = 0
+  
+  while True:
+    # Try without waiting first, so we know if another process has it
+    if attempt == 0:
+      wait = 0
+    elif timeout == None:
+      wait = DATABASE_LOCK_WAIT
+    else:
+      remaining = timeout - (time.time() - started)
+      if remaining <= 0:
+        return False
+      
+      # Older servers only take whole seconds
+      wait = int(math.ceil(remaining))
+    
+    result = connection.Query("SELECT GET_LOCK(%s, %s) AS `acquired`", [lock_name, wait])
+    acquired = result[0]['acquired']
+    
+    # Track it on the connection, so releasing the connection releases it
+    if acquired == 1:
+      connection.database_locks[lock_name] = lock
+      return True
+    
+    if attempt == 0:
+      lock_manager.IncrementLockMetric('remote_contended')
+    
+    # NULL is an error (ex: the wait was killed), so back off before trying again
+    elif acquired == None:
+      time.sleep(lock_manager.GetBackoffInterval(attempt - 1, backoff_initial=sleep_interval))
+    
+    elif timeout == None:
+      Log('Acquire Lock: Still waiting: %s: %0.1f seconds' % (lock, time.time() - started))
+    
+    attempt += 1
+
+
+def ReleaseLock(request, lock):
+  """Release a named lock from AcquireLock().
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    lock: string, lock name
+  
+  Returns: boolean, True if we released the lock, False if we didnt hold it (which can indicate a problem)
+  """
+  connection = GetConnection(request)
+  
+  lock_name = GetDatabaseLockName(request, lock)
+  
+  try:
+    result = connection.Query("SELECT RELEASE_LOCK(%s) AS `released`", [lock_name])
+    released = result[0]['released'] == 1
+  
+  # Always release the in-process lock, so other threads can try
+  finally:
+    connection.database_locks.pop(lock_name, None)
+    
+    lock_manager.ReleaseLocalLock(lock)
+  
+  if released:
+    lock_manager.IncrementLockMetric('released')
+  else:
+    lock_manager.IncrementLockMetric('release_not_held')
+  
+  return released
+
+
+def GetDatabaseLockName(request, lock):
+  """Returns string, the GET_LOCK() name for a lock.  Prefixed with our database name, as lock names are server wide."""
+  database_name = request.connection_data['datasource']['database']
+  
+  lock_name = '%s.%s' % (database_name, lock)
+  
+  if len(lock_name) > DATABASE_LOCK_NAME_MAX:
+    lock_name = '%s.%s' % (database_name[:DATABASE_LOCK_NAME_MAX - 41], hashlib.sha1(lock).hexdigest())
+  
+  return lock_name
+
+
+def ReserveNegativeIds(request, schema_table_id, count):
+  """Reserve a block of negative ids for New Records in a table, from `schema_table.next_negative_id`.
+  
+  A single atomic UPDATE, so no lock is needed: LAST_INSERT_ID(expr) returns the new value with the UPDATE's result,
+  so another process cant change it in between.  LAST_INSERT_ID() is unsigned, so it is given the new value negated.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    schema_table_id: int, schema_table.id of the table
+    count: int, number of ids to reserve
+  
+  Returns: int, the first (highest) reserved id.  The ids are first, first - 1, ... first - count + 1.
+  """
+  connection = GetConnection(request)
+  
+  sql = "UPDATE `schema_table` SET `next_negative_id` = -LAST_INSERT_ID(%s - `next_negative_id`) WHERE `id` = %s"
+  (row_count, last_insert_id) = connection.Query(sql, [int(count), schema_table_id], status=True)
+  
+  # Without our update, the last insert id isnt ours, and the ids arent reserved
+  if row_count != 1:
+    raise RecordNotFound('Could not reserve negative ids, schema_table not updated: %s: %s rows' % (schema_table_id, row_count))
+  
+  # The next id after our block, so our block starts just above it
+  return -int(last_insert_id) + int(count)
@@ -21,6 +21,8 @@ except ImportError, e:
   MYSQL = 'PUREPYTHON'
 
 from schemaman.utility.log import Log
+import schemaman.datasource.tools as tools
+import schemaman.datasource.lock_manager as lock_manager
 
 
 # Default connection pool size.  Override with connection_data
@@ -71,6 +73,13 @@ class Connection:
     self.connection = None
     self.cursor = None
     
+    # True while a transaction started with Begin() is in flight, which turns off auto-commit until it ends
+    self.in_transaction = False
+    
+    # GET_LOCK() locks held on this connection: database lock name -> lock name.  They belong to the connection, not the
+    #   request, so Release() releases any the request didnt.
+    self.database_locks = {}
+    
     # Connect
     self.Connect()
   
@@ -109,9 +118,29 @@ class Connection:
     if self.request_lock.locked and self.request == None:
       print '\n\nERROR: Request Connection was not locked, but had a request: %s' % self.request
     
-    self.request = None
+    # Release any locks the request still holds, or the next request to use this connection would hold them
+    try:
+      self.ReleaseDatabaseLocks()
     
-    self.request_lock.release()
+    finally:
+      self.request = None
+      
+      self.request_lock.release()
+
+
+  def ReleaseDatabaseLocks(self):
+    """Release all the GET_LOCK() locks held on this connection, and their in-process locks."""
+    for (lock_name, lock) in self.database_locks.items():
+      Log('Releasing held lock: MySQL: %s: %s' % (self.server_key, lock_name))
+      
+      try:
+        self.Query("SELECT RELEASE_LOCK(%s) AS `released`", [lock_name])
+      
+      finally:
+        del self.database_locks[lock_name]
+        
+        lock_manager.ReleaseLocalLock(lock)
+        lock_manager.IncrementLockMetric('released')
 
 
   def Acquire(self, request):
@@ -130,9 +159,13 @@ class Connection:
       self.connection.rollback()
     except pymysql.OperationalError, e:
       self.Connect()
+      
+      # A new connection holds no locks
+      self.database_locks = {}
     
     # Set the auto-commit based on the request specification
     self.connection.autocommit(self.request.auto_commit)
+    self.in_transaction = False
     
 
   
@@ -259,8 +292,22 @@ class Connection:
       #   pass
 
 
-  def Query(self, sql, params=None, commit=True):
-    """Query the database via our connection."""
+  def GetTupleCursor(self):
+    """Returns a new cursor, which fetches rows as tuples instead of dicts.  Close it when done."""
+    if MYSQL == 'ORACLE':
+      return self.connection.cursor()
+    
+    else:
+      return self.connection.cursor(pymysql.cursors.Cursor)
+
+
+  def Query(self, sql, params=None, commit=True, compact=False, status=False):
+    """Query the database via our connection.
+    
+    If compact, SELECT rows are returned as a list of tools.CompactRow, which share their column names, instead of dicts.
+    
+    If status, returns tuple (int, int) of the cursor's (rows affected, last insert id) instead, ex: to check an UPDATE.
+    """
     set_request_lock = None
     set_single_threaded_lock = None
     
@@ -282,7 +329,24 @@ class Connection:
           else:
             Log('Query: %s -- %s' % (sql, params))
           
-          result = Query(self.connection, self.cursor, sql, params=params, commit=commit)
+          if not compact:
+            result = Query(self.connection, self.cursor, sql, params=params, commit=commit)
+            
+            # Read the status while we hold the query lock, so no other query can change it
+            if status:
+              result = (self.cursor.rowcount, self.cursor.lastrowid)
+          
+          # Fetch tuples, and put them in compact rows with our column names
+          else:
+            cursor = self.GetTupleCursor()
+            try:
+              result = Query(self.connection, cursor, sql, params=params, commit=commit)
+              
+              if cursor.description:
+                result = tools.GetCompactRows([column[0] for column in cursor.description], result)
+            finally:
+              cursor.close()
+          
           done = True
         
         # Handle DB connection problems
@@ -308,10 +372,34 @@ class Connection:
     return result
   
   
+  def Begin(self):
+    """Begin a transaction, even if the request auto-commits.  Queries with commit=False are held (and SELECT ... FOR
+    UPDATE locks kept) until Commit() or AbandonCommit(), which turn auto-commit back to the request's setting.
+    
+    Returns: boolean, True if a new transaction was begun, False if one was already in flight, which its beginner ends
+    """
+    if self.in_transaction:
+      return False
+    
+    self.connection.autocommit(False)
+    self.in_transaction = True
+    
+    return True
+  
+  
+  def EndTransaction(self):
+    """If a transaction was begun with Begin(), turn auto-commit back to the request's setting"""
+    if self.in_transaction:
+      self.in_transaction = False
+      self.connection.autocommit(self.request.auto_commit)
+  
+  
   def Commit(self):
     """Commit a transaction in flight."""
     result = self.connection.commit()
     
+    self.EndTransaction()
+    
     return result
   
   
@@ -319,6 +407,8 @@ class Connection:
     """Abandon Commit a transaction in flight."""
     result = self.connection.rollback()
     
+    self.EndTransaction()
+    
     return result
 
 
@@ -383,12 +473,19 @@ def GetConnection(request, server_id=None):
 
   # Look through current connection pool, to see if we have any available connections in this server, that we can use
   if server_key in CONNECTION_POOL_POOL:
-    for connection in CONNECTION_POOL_POOL[server_key]:
-      # If this connection is available (not being used in a request)
-      if connection.IsAvailable():
-        # This request has now acquired this connection
-        connection.Acquire(request)
-        return connection
+    # Lock while we look, so requests in other threads cant acquire the same available connection
+    try:
+      CONNECTION_POOL_POOL_LOCK.acquire()
+      
+      for connection in CONNECTION_POOL_POOL[server_key]:
+        # If this connection is available (not being used in a request)
+        if connection.IsAvailable():
+          # This request has now acquired this connection
+          connection.Acquire(request)
+          return connection
+    
+    finally:
+      CONNECTION_POOL_POOL_LOCK.release()
 
   
   # Create the connection
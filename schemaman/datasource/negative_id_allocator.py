@@ -0,0 +1,86 @@
+"""
+Negative ID Allocator for SchemaMan
+
+Thread safe.  New Records get negative placeholder ids (until they are committed, and get their real ids) from
+`schema_table.next_negative_id`.  Instead of a database update per id, each process reserves a block of ids per table
+with a single atomic update, and hands them out from memory.
+
+Ids left in a block when the process exits are never used, which is fine, they only have to be unique.
+"""
+
+
+import threading
+
+
+# Negative ids reserved per table, per database update
+NEGATIVE_ID_BLOCK_SIZE = 1000
+
+# Reserved ids not handed out yet: key is (datasource alias, schema_table_id), value is [next id, last id].  Ids count
+#   down, so the block is used up when next id < last id.
+NEGATIVE_ID_BLOCKS = {}
+
+# Locks per table key, so only one thread reserves a new block for a table, and others wait for it
+NEGATIVE_ID_LOCKS = {}
+NEGATIVE_ID_LOCKS_LOCK = threading.Lock()
+
+
+def AllocateNegativeId(request, schema_table_id, reserve_function, block_size=NEGATIVE_ID_BLOCK_SIZE):
+  """Returns int, the next negative id for a table, from this process's reserved block.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    schema_table_id: int, schema_table.id of the table
+    reserve_function: function, reserve_function(request, schema_table_id, count) -> int, reserves count ids
+        and returns the first (highest) one.  The ids are first, first - 1, ... first - count + 1.
+    block_size: int (default NEGATIVE_ID_BLOCK_SIZE), number of ids to reserve when the block is used up
+  
+  Returns: int
+  """
+  block_key = (request.connection_data['alias'], schema_table_id)
+  
+  block_lock = GetBlockLock(block_key)
+  
+  try:
+    block_lock.acquire()
+  
+    block = NEGATIVE_ID_BLOCKS.get(block_key)
+  
+    # Reserve a new block, if we dont have one, or it's used up
+    if block == None or block[0] < block[1]:
+      first_id = reserve_function(request, schema_table_id, block_size)
+  
+      block = [first_id, first_id - block_size + 1]
+      NEGATIVE_ID_BLOCKS[block_key] = block
+  
+    negative_id = block[0]
+    block[0] -= 1
+  
+  finally:
+    block_lock.release()
+  
+  return negative_id
+
+
+def GetBlockLock(block_key):
+  """Returns threading.Lock, the lock for a table's block.  Creates it if it doesnt exist."""
+  try:
+    NEGATIVE_ID_LOCKS_LOCK.acquire()
+  
+    if block_key not in NEGATIVE_ID_LOCKS:
+      NEGATIVE_ID_LOCKS[block_key] = threading.Lock()
+  
+    return NEGATIVE_ID_LOCKS[block_key]
+  
+  finally:
+    NEGATIVE_ID_LOCKS_LOCK.release()
+
+
+def Clear():
+  """Forget all reserved blocks.  Their ids are never used."""
+  try:
+    NEGATIVE_ID_LOCKS_LOCK.acquire()
+  
+    NEGATIVE_ID_BLOCKS.clear()
+  
+  finally:
+    NEGATIVE_ID_LOCKS_LOCK.release()
@@ -0,0 +1,175 @@
+"""
+Query Result Cache for SchemaMan
+
+Thread safe.  Caches the table rows of Filter() and Get() queries, for callers that ask for it with use_cache=True.
+
+Every table has a generation counter, which is bumped by every write to the table (SetDirect, Delete, etc).  Cached
+results are stored with the generation they were read at, so any write to a table invalidates all of its cached
+results at once, without having to find them.  Raw SQL writes (Query()) bump the generation of every table in their
+datasource.
+
+Writes that are not committed yet bump their table again when the transaction is committed or abandoned, so results
+read by other requests during the transaction are not kept.  Requests inside a transaction dont use the cache at all,
+as they can read rows they havent committed, which may be abandoned.
+
+Unlike the cache module, this cache holds a bounded number of results, and evicts the least recently used.
+"""
+
+
+import collections
+import threading
+
+from cache import NoCacheResultFound
+import tools
+
+
+# Maximum number of query results we keep.  The least recently used results are evicted first.
+DEFAULT_MAX_RESULTS = 1000
+
+# Generation counters, key is (datasource alias, table), and (datasource alias, None) for the whole datasource
+TABLE_GENERATIONS = {}
+
+# Cached results, in least recently used order: key is (datasource alias, table, query key), value is (generations, rows)
+QUERY_CACHE = collections.OrderedDict()
+QUERY_CACHE_LOCK = threading.Lock()
+QUERY_CACHE_MAX_RESULTS = DEFAULT_MAX_RESULTS
+
+
+def GetCacheKey(request, table, *query_args):
+  """Returns tuple, hashable cache key for this table and query arguments (filter data, order, fields, etc)"""
+  return (request.connection_data['alias'], table, NormalizeCacheKeyValue(query_args))
+
+
+def NormalizeCacheKeyValue(value):
+  """Returns a hashable version of value: dicts become sorted tuples of items, lists and sets become tuples"""
+  if type(value) == dict:
+    return tuple([(key, NormalizeCacheKeyValue(item)) for (key, item) in sorted(value.items())])
+  
+  elif type(value) in (list, tuple):
+    return tuple([NormalizeCacheKeyValue(item) for item in value])
+  
+  elif type(value) in (set, frozenset):
+    return tuple(sorted(value))
+  
+  return value
+
+
+def GetTableGeneration(request, table):
+  """Returns tuple (int, int), the datasource and table generations.  Get this before querying, to Set() the result with."""
+  alias = request.connection_data['alias']
+  
+  return (TABLE_GENERATIONS.get((alias, None), 0), TABLE_GENERATIONS.get((alias, table), 0))
+
+
+def InvalidateTable(request, table, commit=True):
+  """Invalidate all cached results for this table, because it is being written to.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table, or None for every table in the datasource
+    commit: boolean (default True), if False the write is in a transaction, so invalidate again once it is committed
+  """
+  BumpGeneration((request.connection_data['alias'], table))
+  
+  if not commit:
+    request.cache_pending_tables.add(table)
+
+
+def InvalidatePendingTables(request):
+  """Invalidate the tables written to in this request's transaction, after it has been committed or abandoned."""
+  pending_tables = list(request.cache_pending_tables)
+  request.cache_pending_tables.clear()
+  
+  for table in pending_tables:
+    BumpGeneration((request.connection_data['alias'], table))
+
+
+def BumpGeneration(generation_key):
+  """Increment the generation counter for generation_key"""
+  try:
+    QUERY_CACHE_LOCK.acquire()
+  
+    TABLE_GENERATIONS[generation_key] = TABLE_GENERATIONS.get(generation_key, 0) + 1
+  
+  finally:
+    QUERY_CACHE_LOCK.release()
+
+
+def Get(request, table, cache_key):
+  """Returns a copy of the cached rows (or record) for cache_key, or NoCacheResultFound if not cached or not current"""
+  generations = GetTableGeneration(request, table)
+  
+  try:
+    QUERY_CACHE_LOCK.acquire()
+  
+    if cache_key not in QUERY_CACHE:
+      return NoCacheResultFound
+  
+    (cached_generations, rows) = QUERY_CACHE.pop(cache_key)
+  
+    # If the table has been written to since this was cached, its gone
+    if cached_generations != generations:
+      return NoCacheResultFound
+  
+    # Put it back as the most recently used
+    QUERY_CACHE[cache_key] = (cached_generations, rows)
+  
+  finally:
+    QUERY_CACHE_LOCK.release()
+  
+  return CopyRows(rows)
+
+
+def Set(request, table, cache_key, rows, generations):
+  """Cache a copy of the rows (or record), if the table is still at the generations they were read at.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    table: string, name of table the rows are from
+    cache_key: tuple, from GetCacheKey()
+    rows: list of dicts (or tools.CompactRow), or a single dict, or None
+    generations: tuple, from GetTableGeneration(), before the rows were queried
+  """
+  # If the table was written to while we were querying, these rows may already be stale
+  if GetTableGeneration(request, table) != generations:
+    return
+  
+  rows = CopyRows(rows)
+  
+  try:
+    QUERY_CACHE_LOCK.acquire()
+  
+    QUERY_CACHE.pop(cache_key, None)
+    QUERY_CACHE[cache_key] = (generations, rows)
+  
+    # Evict the least recently used results
+    while len(QUERY_CACHE) > QUERY_CACHE_MAX_RESULTS:
+      QUERY_CACHE.popitem(last=False)
+  
+  finally:
+    QUERY_CACHE_LOCK.release()
+
+
+def Clear():
+  """Remove all cached results"""
+  try:
+    QUERY_CACHE_LOCK.acquire()
+  
+    QUERY_CACHE.clear()
+  
+  finally:
+    QUERY_CACHE_LOCK.release()
+
+
+def CopyRows(rows):
+  """Returns a copy of the rows (or a single record), so callers can change them without changing the cache"""
+  if rows == None:
+    return None
+  
+  elif isinstance(rows, dict):
+    return dict(rows)
+  
+  elif isinstance(rows, tools.CompactRow):
+    return tools.CompactRow(rows.columns, tuple(rows.row_values))
+  
+  return [CopyRows(row) for row in rows]
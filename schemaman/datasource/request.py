@@ -68,6 +68,9 @@ class Request:
     # Track whether we have released this yet
     self.is_released = False
     
+    # Tables written to in our current transaction, so their cached query results can be invalidated again on commit
+    self.cache_pending_tables = set()
+    
     
     # Get the user record
     #TODO(g): Where we get the user records needs to be configurable, and currently isnt.  Fix later, same with VMCM
@@ -93,6 +96,17 @@ class Request:
     self.ReleaseConnections()
 
   
+  def Clone(self):
+    """Returns a new Request for the same connection spec and user, which will get its own connections.
+    
+    Used to work in parallel (each thread needs its own Request), or to commit separately from this request's transaction.
+    """
+    request = Request(self.connection_data, self.username, self.authentication, server_id=self.server_id,
+                      use_version_management=self.use_version_management, auto_commit=self.auto_commit, trace=self.trace)
+    
+    return request
+  
+  
   def Log(self, text, data):
     """Log any data we want to about this request."""
     self.log.append((text, data))
@@ -3,3 +3,9 @@ Bring in all our utility modules into this module space.  They are in different
 """
 
 from data_format import *
+from compact_row import *
+from filter_match import *
+from version_overlay import *
+from version_codec import *
+from commit_planner import *
+from version_diff import *
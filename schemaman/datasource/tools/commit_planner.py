@@ -0,0 +1,150 @@
+"""
+Plan the order to commit version records in, so records are inserted after the records they reference, and deleted
+before them.
+
+The dependency graph is built once by the caller (record_key -> the record_keys it references), and ordered with
+Kahn's algorithm, a level at a time, so planning is about linear in the number of records and references.  If records
+reference each other in a cycle there is no order, and the cycle is reported with the fields that make it up.
+"""
+
+
+class DependencyCycle(Exception):
+  """Records reference each other in a cycle, so there is no order to commit them in."""
+  
+  def __init__(self, message, cycle=None, blocked=None):
+    Exception.__init__(self, message)
+  
+    # List of (record_key, field) in the cycle, each referencing the next, and the last referencing the first
+    self.cycle = cycle
+  
+    # List of record_keys that could not be ordered, because they are in or depend on a cycle
+    self.blocked = blocked
+
+
+def PlanCommitOrder(record_keys, dependencies):
+  """Returns list of record_keys, ordered so every record comes after the records it depends on.
+  
+  Records come a dependency level at a time (see PlanCommitLevels()), and keep their order from record_keys within it.
+  
+  Args:
+    record_keys: list of record_keys (any hashable, usually (schema_id, schema_table_id, record_id)) to order
+    dependencies: dict, record_key -> dict of (dependency record_key -> field name), the records that must come first,
+        and the field that references them.  Dependencies that are not in record_keys are ignored.
+  
+  Returns: list of record_keys
+  
+  Raises: DependencyCycle, if there is no order because records depend on each other in a cycle
+  """
+  order = []
+  
+  for level in PlanCommitLevels(record_keys, dependencies):
+    order += level
+  
+  return order
+
+
+def PlanCommitLevels(record_keys, dependencies):
+  """Returns list of lists of record_keys, the dependency levels.  Records only depend on records in earlier levels, so
+  all the records of a level can be written together.
+  
+  The first level is the records with no dependencies, and each level after is the records whose dependencies are all
+  in the levels before it.  Records keep their order from record_keys within their level.
+  
+  Args:
+    record_keys: list of record_keys (any hashable, usually (schema_id, schema_table_id, record_id)) to order
+    dependencies: dict, record_key -> dict of (dependency record_key -> field name), the records that must come first,
+        and the field that references them.  Dependencies that are not in record_keys are ignored.
+  
+  Returns: list of lists of record_keys
+  
+  Raises: DependencyCycle, if there is no order because records depend on each other in a cycle
+  """
+  record_set = set(record_keys)
+  
+  # Count the dependencies each record is waiting on, and reverse them, so clearing a record finds its dependents
+  waiting = dict([(record_key, 0) for record_key in record_keys])
+  dependents = {}
+  
+  for record_key in record_keys:
+    for dependency_key in dependencies.get(record_key, {}):
+      if dependency_key in record_set and dependency_key != record_key:
+        waiting[record_key] += 1
+        dependents.setdefault(dependency_key, []).append(record_key)
+  
+  # Position of each record, to keep their order within a level
+  positions = dict([(record_key, position) for (position, record_key) in enumerate(record_keys)])
+  
+  levels = []
+  level = [record_key for record_key in record_keys if waiting[record_key] == 0]
+  ordered_count = 0
+  
+  while level:
+    levels.append(level)
+    ordered_count += len(level)
+    
+    next_level = []
+    
+    for record_key in level:
+      for dependent_key in dependents.get(record_key, []):
+        waiting[dependent_key] -= 1
+        
+        if waiting[dependent_key] == 0:
+          next_level.append(dependent_key)
+    
+    level = sorted(next_level, key=positions.get)
+  
+  # Anything still waiting is in a cycle, or depends on one
+  if ordered_count != len(waiting):
+    blocked = [record_key for record_key in record_keys if waiting[record_key] > 0]
+    cycle = FindDependencyCycle(blocked, dependencies)
+    
+    raise DependencyCycle('Circular reference found in records, could not create dependency order: %s  (%d records blocked)' % \
+        (FormatDependencyCycle(cycle), len(blocked)), cycle=cycle, blocked=blocked)
+  
+  return levels
+
+
+def PlanDeleteOrder(record_keys, dependencies):
+  """Returns list of record_keys, ordered so every record comes before the records it depends on.  The reverse of
+  PlanCommitOrder(), so records are deleted before the records they reference.
+  """
+  order = PlanCommitOrder(record_keys, dependencies)
+  order.reverse()
+  
+  return order
+
+
+def FindDependencyCycle(blocked, dependencies):
+  """Returns list of (record_key, field), a cycle of blocked records, each referencing the next with field.
+  
+  Every blocked record is waiting on another blocked record, so following those references must loop back.
+  """
+  blocked_set = set(blocked)
+  
+  path = []
+  path_index = {}
+  record_key = blocked[0]
+  
+  while record_key not in path_index:
+    path_index[record_key] = len(path)
+  
+    # Follow a reference that is still blocked, in a stable order
+    (field, next_key) = sorted([(field, dependency_key) for (dependency_key, field) in dependencies[record_key].items() \
+        if dependency_key in blocked_set and dependency_key != record_key])[0]
+  
+    path.append((record_key, field))
+    record_key = next_key
+  
+  # The path may have started on a record that only leads into the cycle
+  return path[path_index[record_key]:]
+
+
+def FormatDependencyCycle(cycle):
+  """Returns string, the cycle as: record_key.field -> record_key.field -> (first record_key)"""
+  if not cycle:
+    return ''
+  
+  parts = ['%s.%s' % (str(record_key), field) for (record_key, field) in cycle]
+  parts.append(str(cycle[0][0]))
+  
+  return ' -> '.join(parts)
@@ -0,0 +1,156 @@
+"""
+Compact rows for large result sets.
+
+A dict per row repeats every column name, and keeps a hash table per row.  A CompactRow keeps only its values (the
+tuple the database cursor returned), and shares one RowColumns index (column name -> position) with every other row
+from the same result.  It can be used like a read-mostly dict: row['field'], get(), keys(), items(), `in`, and
+ToDict() for a real dict.
+"""
+
+
+class RowColumns(object):
+  """Column names of a result, and their positions, shared by all of its rows."""
+  
+  __slots__ = ('names', 'index', 'extended')
+  
+  def __init__(self, names):
+    self.names = tuple(names)
+    self.index = dict([(name, position) for (position, name) in enumerate(self.names)])
+  
+    # Columns with one more name, for rows that have a field set that is not in the result.  Shared, like we are.
+    self.extended = {}
+  
+  
+  def Extend(self, name):
+    """Returns RowColumns, these columns with name added at the end"""
+    if name not in self.extended:
+      self.extended[name] = RowColumns(self.names + (name,))
+  
+    return self.extended[name]
+
+
+class CompactRow(object):
+  """A row of values, with a shared RowColumns index for field access.  Values are a tuple until the row is changed."""
+  
+  __slots__ = ('columns', 'row_values')
+  
+  def __init__(self, columns, row_values):
+    self.columns = columns
+    self.row_values = row_values
+  
+  
+  def __getitem__(self, key):
+    return self.row_values[self.columns.index[key]]
+  
+  
+  def __setitem__(self, key, value):
+    # Only copy our values when we change them, so unchanged rows can keep the cursor's tuple
+    if type(self.row_values) != list:
+      self.row_values = list(self.row_values)
+  
+    if key in self.columns.index:
+      self.row_values[self.columns.index[key]] = value
+    else:
+      self.columns = self.columns.Extend(key)
+      self.row_values.append(value)
+  
+  
+  def __contains__(self, key):
+    return key in self.columns.index
+  
+  
+  def __iter__(self):
+    return iter(self.columns.names)
+  
+  
+  def __len__(self):
+    return len(self.columns.names)
+  
+  
+  def __eq__(self, other):
+    if isinstance(other, CompactRow):
+      other = other.ToDict()
+  
+    return self.ToDict() == other
+  
+  
+  def __ne__(self, other):
+    return not self.__eq__(other)
+  
+  
+  def __repr__(self):
+    return repr(self.ToDict())
+  
+  
+  def get(self, key, default=None):
+    if key in self.columns.index:
+      return self.row_values[self.columns.index[key]]
+    else:
+      return default
+  
+  
+  def keys(self):
+    return list(self.columns.names)
+  
+  
+  def values(self):
+    return list(self.row_values)
+  
+  
+  def items(self):
+    return zip(self.columns.names, self.row_values)
+  
+  
+  def update(self, data):
+    for (key, value) in data.items():
+      self[key] = value
+  
+  
+  def ToDict(self):
+    """Returns dict, of our fields and values"""
+    return dict(zip(self.columns.names, self.row_values))
+
+
+def GetCompactRows(column_names, value_rows):
+  """Returns list of CompactRow, for the value_rows (sequences of values), sharing a single RowColumns of column_names"""
+  columns = RowColumns(column_names)
+  
+  return [CompactRow(columns, row_values) for row_values in value_rows]
+
+
+def ConvertToCompactRows(rows, columns=None):
+  """Returns list of CompactRow, the rows with any dicts converted to CompactRow.
+  
+  Args:
+    rows: list of dicts and CompactRows
+    columns: RowColumns (default None), columns to use for converted dicts which have exactly these fields.  If None,
+        the columns of the first CompactRow in rows are used.
+  
+  Returns: list of CompactRow
+  """
+  if columns == None:
+    for row in rows:
+      if isinstance(row, CompactRow):
+        columns = row.columns
+        break
+  
+  compact_rows = []
+  
+  for row in rows:
+    if not isinstance(row, CompactRow):
+      # Share the columns if the dict has the same fields, otherwise it gets its own
+      if columns != None and len(row) == len(columns.names) and all([name in row for name in columns.names]):
+        row = CompactRow(columns, tuple([row[name] for name in columns.names]))
+      else:
+        row = GetCompactRows(row.keys(), [row.values()])[0]
+  
+    compact_rows.append(row)
+  
+  return compact_rows
+
+
+def ProjectCompactRows(rows, fields):
+  """Returns list of CompactRow, with only the fields listed in fields, sharing a single RowColumns.  Missing fields are None."""
+  columns = RowColumns(fields)
+  
+  return [CompactRow(columns, tuple([row.get(field) for field in fields])) for row in rows]
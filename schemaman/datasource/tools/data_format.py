@@ -3,6 +3,27 @@ Format data for various data source operations.  Pre-query or post-query.
 """
 
 
+import base64
+import datetime
+import decimal
+import gzip
+import json
+import os
+
+
+# File extension for exported table data: one JSON encoded row per line (JSON Lines)
+DATA_FILE_EXTENSION = 'jsonl'
+
+# Added after DATA_FILE_EXTENSION when the data file is gzip compressed
+DATA_FILE_COMPRESSED_EXTENSION = 'gz'
+
+# Tables exported in several parts have their part number after this: table.part0001.jsonl
+DATA_FILE_PART_PREFIX = 'part'
+
+# Binary (not UTF-8) string values are written as an object with only this key, and their base64 encoded value
+JSON_BINARY_TAG = '$binary'
+
+
 def FormatStringOrNullFromDict(data, key, strict=False):
   """Returns a quoted and escaped string from the data[key] value, or NULL to insert into a field column
   
@@ -78,3 +99,158 @@ def ConvertListToDictList(list_data, key_field):
   
   return data
 
+
+def GetDataFilePath(path, table, compress=False, part=None):
+  """Returns string, the path to the data file for this table, inside the directory path.
+  
+  Large tables can be exported in several parts (id ranges), each part is given its own file.
+  """
+  if part == None:
+    file_path = '%s/%s.%s' % (path, table, DATA_FILE_EXTENSION)
+  else:
+    file_path = '%s/%s.%s%04d.%s' % (path, table, DATA_FILE_PART_PREFIX, part, DATA_FILE_EXTENSION)
+  
+  if compress:
+    file_path += '.%s' % DATA_FILE_COMPRESSED_EXTENSION
+  
+  return file_path
+
+
+def ListDataFilePaths(path):
+  """Returns dict, keyed on table name (string), values are sorted lists of the data file paths for that table.
+  
+  Finds all data files (whole or in parts, compressed or not) written by GetDataFilePath() in the directory path.
+  """
+  data = {}
+  
+  for filename in sorted(os.listdir(path)):
+    name = filename
+    
+    # Strip the compressed extension, if any, then we must have our data file extension
+    if name.endswith('.%s' % DATA_FILE_COMPRESSED_EXTENSION):
+      name = name[:-len(DATA_FILE_COMPRESSED_EXTENSION) - 1]
+    
+    if not name.endswith('.%s' % DATA_FILE_EXTENSION):
+      continue
+    
+    table = name[:-len(DATA_FILE_EXTENSION) - 1]
+    
+    # If this is a part file, strip the part off to get the table name
+    if '.' in table:
+      (table_name, part) = table.rsplit('.', 1)
+      if part.startswith(DATA_FILE_PART_PREFIX) and part[len(DATA_FILE_PART_PREFIX):].isdigit():
+        table = table_name
+    
+    if table not in data:
+      data[table] = []
+    
+    data[table].append('%s/%s' % (path, filename))
+  
+  return data
+
+
+def OpenDataFile(path, mode='r'):
+  """Returns a file object for a data file.  Paths ending in the compressed extension are read/written with gzip."""
+  if path.endswith('.%s' % DATA_FILE_COMPRESSED_EXTENSION):
+    return gzip.open(path, mode + 'b')
+  else:
+    return open(path, mode)
+
+
+def FormatJsonValue(value):
+  """JSON default handler for the DB value types json cannot encode natively.  Formats them the way MySQL will accept them back."""
+  # str() of a timedelta is like '1 day, 2:00:00', which MySQL TIME columns dont accept
+  if isinstance(value, datetime.timedelta):
+    return FormatTimedelta(value)
+  
+  if isinstance(value, (datetime.datetime, datetime.date, datetime.time, decimal.Decimal)):
+    return str(value)
+  
+  raise TypeError('Cannot format value as JSON: %s (%s)' % (value, type(value)))
+
+
+def FormatTimedelta(value):
+  """Returns string, a timedelta (MySQL TIME value) as '[-]HH:MM:SS[.ffffff]', with the total hours"""
+  if value < datetime.timedelta(0):
+    sign = '-'
+    value = -value
+  else:
+    sign = ''
+  
+  hours = value.days * 24 + value.seconds // 3600
+  
+  text = '%s%02d:%02d:%02d' % (sign, hours, (value.seconds // 60) % 60, value.seconds % 60)
+  
+  if value.microseconds:
+    text += '.%06d' % value.microseconds
+  
+  return text
+
+
+def FormatBinaryValue(value):
+  """Returns value, or a JSON_BINARY_TAG object of it base64 encoded, if it is a binary (not UTF-8) string, ex: from a
+  BLOB column, which json cannot encode.
+  """
+  if isinstance(value, str):
+    try:
+      value.decode('utf-8')
+    
+    except UnicodeDecodeError, e:
+      return {JSON_BINARY_TAG: base64.b64encode(value)}
+  
+  return value
+
+
+def ParseBinaryValue(value):
+  """Returns value, or the binary string of a JSON_BINARY_TAG object from FormatBinaryValue()"""
+  if isinstance(value, dict) and value.keys() == [JSON_BINARY_TAG]:
+    return base64.b64decode(value[JSON_BINARY_TAG])
+  
+  return value
+
+
+def FormatJsonLine(row):
+  """Returns string, a single row (dict) encoded as a JSON Lines line, with the trailing newline"""
+  row = dict([(key, FormatBinaryValue(value)) for (key, value) in row.items()])
+  
+  return json.dumps(row, sort_keys=True, default=FormatJsonValue) + '\n'
+
+
+def ParseJsonLine(line):
+  """Returns dict (row) or None, from a JSON Lines line.  Blank lines return None."""
+  line = line.strip()
+  
+  if not line:
+    return None
+  
+  row = json.loads(line)
+  
+  return dict([(key, ParseBinaryValue(value)) for (key, value) in row.items()])
+
+
+class InvalidPageCursor(Exception):
+  """A page cursor could not be parsed, or was made for a different order key."""
+
+
+def FormatPageCursor(order_key, last_seen):
+  """Returns string, an opaque cursor for the next page of a keyset paginated query (see FilterPages())"""
+  text = json.dumps({'order_key': order_key, 'last_seen': last_seen}, default=FormatJsonValue)
+  
+  return base64.urlsafe_b64encode(text)
+
+
+def ParsePageCursor(cursor, order_key):
+  """Returns the last seen order_key value stored in a cursor from FormatPageCursor().
+  
+  Raises InvalidPageCursor if the cursor cant be parsed or was made for paging on a different order_key.
+  """
+  try:
+    data = json.loads(base64.urlsafe_b64decode(str(cursor)))
+  
+  except (TypeError, ValueError), e:
+    raise InvalidPageCursor('Could not parse page cursor: %s: %s' % (cursor, e))
+  
+  if data.get('order_key') != order_key:
+    raise InvalidPageCursor('Page cursor is for order key %s, not %s' % (data.get('order_key'), order_key))
+  
+  return data['last_seen']
@@ -0,0 +1,146 @@
+"""
+Match records against Filter() data in Python.
+
+Version records (working, pending or committed) are not in the database, so the filters that are compiled into SQL
+for the table rows must also be evaluated against them.  Compile the filter data once, and test every record with it.
+
+Comparisons follow SQL: a NULL (None) field value never matches anything but IS NULL, and LIKE is case-insensitive,
+as it is with MySQL's default collations.
+"""
+
+import re
+
+
+# Filter directives which compare a field to a single value, and how to test them
+COMPARISON_TESTS = {
+  '=': lambda a, b: a == b,
+  '!=': lambda a, b: a != b,
+  '<>': lambda a, b: a != b,
+  '>': lambda a, b: a > b,
+  '>=': lambda a, b: a >= b,
+  '<': lambda a, b: a < b,
+  '<=': lambda a, b: a <= b,
+}
+
+
+class UnknownFilterDirective(Exception):
+  """A filter value is a tuple with a directive we dont know how to match."""
+
+
+def CompileFilter(data):
+  """Returns a function, which takes a record (dict) and returns boolean, True if it matches all of the filter data.
+  
+  Uses the same filter data as Filter(): a value is an equality test, or a tuple with a directive: ('IN', [...]),
+  ('NOT IN', [...]), ('IS', 'NULL'), ('IS', 'NOT', 'NULL'), ('BETWEEN', low, high), or a comparison: ('>', value),
+  ('>=', value), ('<', value), ('<=', value), ('!=', value), ('LIKE', pattern).  Fields with a None value are skipped,
+  as they are in the SQL.
+  
+  Args:
+    data: dict, key is fields, value is the equality value or directive tuple
+  
+  Returns: function, matches(record) -> boolean
+  """
+  if not data:
+    return lambda record: True
+  
+  tests = []
+  
+  for (key, value) in sorted(data.items()):
+    # NULL values are skipped in the SQL, so skip them here too
+    if value == None:
+      continue
+  
+    tests.append((key, CompileFilterValue(value)))
+  
+  
+  def Matches(record):
+    """Returns boolean, True if the record matches all of the compiled tests"""
+    for (key, test) in tests:
+      if key not in record or not test(record[key]):
+        return False
+  
+    return True
+  
+  
+  return Matches
+
+
+def CompileFilterValue(value):
+  """Returns a function, which takes a field value and returns boolean, True if it matches this filter value."""
+  # If this is just a normal value, then we just need to compare
+  if type(value) not in (tuple, list):
+    return lambda field_value: field_value == value
+  
+  directive = value[0].upper()
+  
+  # If the field is 'IN' a list of values.  Use a set, so each test is constant time no matter the list size.
+  if directive == 'IN':
+    match_set = GetMatchSet(value[1])
+    return lambda field_value: field_value in match_set
+  
+  elif directive == 'NOT IN':
+    match_set = GetMatchSet(value[1])
+    return lambda field_value: field_value != None and field_value not in match_set
+  
+  # Comparisons to a single value
+  elif directive in COMPARISON_TESTS:
+    compare = COMPARISON_TESTS[directive]
+    compare_value = value[1]
+    return lambda field_value: field_value != None and compare(field_value, compare_value)
+  
+  # BETWEEN is inclusive on both ends
+  elif directive == 'BETWEEN':
+    (low, high) = (value[1], value[2])
+    return lambda field_value: field_value != None and low <= field_value <= high
+  
+  elif directive in ('LIKE', 'NOT LIKE'):
+    pattern = CompileLikePattern(value[1])
+    
+    if directive == 'LIKE':
+      return lambda field_value: field_value != None and pattern.match(unicode(field_value)) != None
+    else:
+      return lambda field_value: field_value != None and pattern.match(unicode(field_value)) == None
+  
+  # IS NULL, IS NOT NULL
+  elif directive == 'IS':
+    terms = ' '.join(value[1:]).upper().split()
+  
+    if terms == ['NULL']:
+      return lambda field_value: field_value == None
+    elif terms == ['NOT', 'NULL']:
+      return lambda field_value: field_value != None
+  
+  raise UnknownFilterDirective('Filter does not support filter value: %s' % str(value))
+
+
+def GetMatchSet(match_list):
+  """Returns a set (or list, if the values cant be hashed) of the values in match_list, for fast membership tests"""
+  try:
+    return frozenset(match_list)
+  
+  except TypeError, e:
+    return list(match_list)
+
+
+def CompileLikePattern(like_pattern):
+  """Returns compiled regex, which matches the same strings as the SQL LIKE pattern.
+  
+  '%' matches any number of characters, '_' matches a single character, and a backslash escapes the next character.
+  """
+  regex = ''
+  escaped = False
+  
+  for character in unicode(like_pattern):
+    if escaped:
+      regex += re.escape(character)
+      escaped = False
+    elif character == '\\':
+      escaped = True
+    elif character == '%':
+      regex += '.*'
+    elif character == '_':
+      regex += '.'
+    else:
+      regex += re.escape(character)
+  
+  return re.compile(regex + '$', re.IGNORECASE | re.DOTALL | re.UNICODE)
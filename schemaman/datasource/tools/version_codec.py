@@ -0,0 +1,227 @@
+"""
+Encode and decode version data (the `data_yaml`, `delete_data_yaml`, `admin_data_yaml` and `rollback_data_yaml`
+fields of version_working, version_pending and version_commit).
+
+Encoded data starts with a codec prefix (ex: "json1:"), so the format can change without migrating stored rows.
+Text without a known prefix is YAML, which is how all version data was stored before, and can always be read.
+New data is written with DEFAULT_VERSION_CODEC.
+
+JSON only has string keys, but version data is keyed by ints (schema_id, schema_table_id, record_id), so keys of those
+levels that are ints are restored on load.  Values JSON cant store (datetimes, timedeltas, decimals, binary strings)
+are tagged, and restored on load.
+"""
+
+
+import base64
+import datetime
+import decimal
+import re
+
+# Use simplejson if we have it, its C speedups are faster than the standard json module
+try:
+  import simplejson as json
+except ImportError, e:
+  import json
+
+import schemaman.utility as utility
+
+
+# Codec used to write new version data
+DEFAULT_VERSION_CODEC = 'json1'
+
+# Separates the codec name from the encoded data
+VERSION_CODEC_SEPARATOR = ':'
+
+# Keys that were ints before they were encoded as JSON object keys
+INT_KEY_REGEX = re.compile(r'^-?[0-9]+$')
+
+# Levels of version data keyed by ints: schema_id, schema_table_id, record_id.  Keys inside records are left alone.
+VERSION_DATA_INT_KEY_LEVELS = 3
+
+# Tagged values, which JSON cant store directly, are a JSON object with a single tag key
+TAG_DATETIME = '$datetime'
+TAG_DATE = '$date'
+TAG_TIMEDELTA = '$timedelta'
+TAG_DECIMAL = '$decimal'
+TAG_BINARY = '$binary'
+
+TAGS = (TAG_DATETIME, TAG_DATE, TAG_TIMEDELTA, TAG_DECIMAL, TAG_BINARY)
+
+# Formats to parse tagged datetime values.  They are written without strftime(), which fails before 1900 in python 2.
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+DATE_FORMAT = '%Y-%m-%d'
+
+
+class UnknownVersionCodec(Exception):
+  """The version codec is not one we know how to encode."""
+
+
+def LoadVersionData(text, default_value=None, int_key_levels=VERSION_DATA_INT_KEY_LEVELS):
+  """Returns the decoded version data, or default_value if text is None, empty or cant be decoded.
+  
+  Args:
+    text: string, encoded version data: a codec prefix and its data, or YAML if there is no known prefix
+    default_value: any (default None), returned if there is no data
+    int_key_levels: int (default VERSION_DATA_INT_KEY_LEVELS), levels of nested dicts to restore int keys in.  0 for a
+        single record's data.
+  
+  Returns: any data container type, usually dict
+  """
+  if text == None:
+    return default_value
+  
+  (codec, encoded) = SplitVersionCodec(text)
+  
+  # No known codec, so this was stored as YAML
+  if codec == None:
+    result = utility.path.LoadYamlFromString(text, default_value)
+  
+  else:
+    try:
+      result = VERSION_CODECS[codec][0](encoded, int_key_levels)
+    
+    except ValueError, e:
+      result = default_value
+  
+  # Match the YAML behavior: empty data is the default value
+  if result == None:
+    result = default_value
+  
+  return result
+
+
+def DumpVersionData(data, codec=DEFAULT_VERSION_CODEC):
+  """Returns string, the version data encoded with the codec, and prefixed with its name.
+  
+  Args:
+    data: dict (usually), version data
+    codec: string (default DEFAULT_VERSION_CODEC), name of codec to encode with.  'yaml' stores YAML with no prefix.
+  
+  Returns: string
+  """
+  if codec == 'yaml':
+    return utility.path.DumpYamlAsString(data)
+  
+  if codec not in VERSION_CODECS:
+    raise UnknownVersionCodec('Unknown version codec: %s  Allowed: %s' % (codec, ', '.join(sorted(VERSION_CODECS.keys()) + ['yaml'])))
+  
+  return codec + VERSION_CODEC_SEPARATOR + VERSION_CODECS[codec][1](data)
+
+
+def SplitVersionCodec(text):
+  """Returns tuple (string or None, string), the codec name and encoded data.  The codec is None if there is no known prefix."""
+  (codec, separator, encoded) = text.partition(VERSION_CODEC_SEPARATOR)
+  
+  if separator and codec in VERSION_CODECS:
+    return (codec, encoded)
+  
+  return (None, text)
+
+
+def LoadJsonVersionData(encoded, int_key_levels=VERSION_DATA_INT_KEY_LEVELS):
+  """Returns the data from JSON version data, with int keys and tagged values restored"""
+  data = json.loads(encoded, object_hook=RestoreJsonObject)
+  
+  return RestoreIntKeys(data, int_key_levels)
+
+
+def DumpJsonVersionData(data):
+  """Returns string, the data encoded as compact JSON.  Values JSON cant store are tagged."""
+  try:
+    return json.dumps(data, separators=(',', ':'), default=TagJsonValue)
+  
+  # Binary strings (ex: BLOB columns) arent UTF-8, so tag them and encode again.  Most data has none, so we dont look first.
+  except UnicodeDecodeError, e:
+    return json.dumps(TagBinaryStrings(data), separators=(',', ':'), default=TagJsonValue)
+
+
+def RestoreJsonObject(data):
+  """Returns a decoded JSON object, or the value it tagged"""
+  if len(data) == 1 and data.keys()[0] in TAGS:
+    return UntagJsonValue(data)
+  
+  return data
+
+
+def RestoreIntKeys(data, levels):
+  """Returns data with the keys that were ints restored, in its first levels of nested dicts"""
+  if levels <= 0 or not isinstance(data, dict):
+    return data
+  
+  restored = {}
+  
+  for (key, value) in data.iteritems():
+    if INT_KEY_REGEX.match(key):
+      key = int(key)
+    
+    restored[key] = RestoreIntKeys(value, levels - 1)
+  
+  return restored
+
+
+def TagBinaryStrings(data):
+  """Returns a copy of data, with its strings that arent UTF-8 tagged, as JSON cant store them"""
+  if isinstance(data, dict):
+    return dict([(key, TagBinaryStrings(value)) for (key, value) in data.iteritems()])
+  
+  elif isinstance(data, (list, tuple, set, frozenset)):
+    return [TagBinaryStrings(value) for value in data]
+  
+  elif isinstance(data, str):
+    try:
+      data.decode('utf-8')
+    
+    except UnicodeDecodeError, e:
+      return {TAG_BINARY: base64.b64encode(data)}
+  
+  return data
+
+
+def TagJsonValue(value):
+  """Returns a dict, tagging a value that JSON cant store, so it can be restored by UntagJsonValue()"""
+  if isinstance(value, datetime.datetime):
+    return {TAG_DATETIME: '%04d-%02d-%02d %02d:%02d:%02d.%06d' % (value.year, value.month, value.day, value.hour,
+                                                                  value.minute, value.second, value.microsecond)}
+  
+  elif isinstance(value, datetime.date):
+    return {TAG_DATE: '%04d-%02d-%02d' % (value.year, value.month, value.day)}
+  
+  # MySQL TIME columns
+  elif isinstance(value, datetime.timedelta):
+    return {TAG_TIMEDELTA: [value.days, value.seconds, value.microseconds]}
+  
+  elif isinstance(value, decimal.Decimal):
+    return {TAG_DECIMAL: str(value)}
+  
+  elif isinstance(value, (set, frozenset, tuple)):
+    return list(value)
+  
+  raise TypeError('Cannot encode version data value: %s: %s' % (type(value), value))
+
+
+def UntagJsonValue(data):
+  """Returns the value that TagJsonValue() tagged"""
+  (tag, value) = data.items()[0]
+  
+  if tag == TAG_DATETIME:
+    return datetime.datetime.strptime(value, DATETIME_FORMAT)
+  
+  elif tag == TAG_DATE:
+    return datetime.datetime.strptime(value, DATE_FORMAT).date()
+  
+  elif tag == TAG_TIMEDELTA:
+    return datetime.timedelta(days=value[0], seconds=value[1], microseconds=value[2])
+  
+  elif tag == TAG_BINARY:
+    return base64.b64decode(value)
+  
+  elif tag == TAG_DECIMAL:
+    return decimal.Decimal(value)
+  
+  raise ValueError('Unknown tagged version data value: %s' % data)
+
+
+# Codecs we can load and dump: name -> (load function, dump function)
+VERSION_CODECS = {
+  'json1': (LoadJsonVersionData, DumpJsonVersionData),
+}
@@ -0,0 +1,53 @@
+"""
+Field level diffs of records, between two versions.
+
+A record's image in a version is its full record (dict), or None if it didnt exist in that version.  The diff only
+keeps the fields that changed, so it stays small for wide tables.
+"""
+
+
+# Diff actions, for how a record changed between the versions
+DIFF_INSERT = 'insert'
+DIFF_UPDATE = 'update'
+DIFF_DELETE = 'delete'
+
+
+def DiffRecordImages(before, after):
+  """Returns tuple (string, dict) or None, the (action, changed fields) between two images of a record, or None if it
+  didnt change.
+  
+  Args:
+    before: dict or None, the record in the older version, None if it didnt exist
+    after: dict or None, the record in the newer version, None if it doesnt exist
+  
+  Returns: tuple (string, dict) or None.  Action is DIFF_INSERT, DIFF_UPDATE or DIFF_DELETE, and the changed fields
+      dict is field name -> (before value, after value).  Fields missing from an image are None.
+  """
+  if before == None and after == None:
+    return None
+  
+  if before == None:
+    action = DIFF_INSERT
+    before = {}
+  
+  elif after == None:
+    action = DIFF_DELETE
+    after = {}
+  
+  else:
+    action = DIFF_UPDATE
+  
+  fields = {}
+  
+  for field in set(before.keys()) | set(after.keys()):
+    before_value = before.get(field)
+    after_value = after.get(field)
+  
+    if action != DIFF_UPDATE or before_value != after_value:
+      fields[field] = (before_value, after_value)
+  
+  # Changed, and changed back
+  if not fields:
+    return None
+  
+  return (action, fields)
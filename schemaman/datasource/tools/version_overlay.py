@@ -0,0 +1,81 @@
+"""
+Overlay version data (working, pending or committed) onto table rows.
+
+The version data for a table is indexed by record id (a dict of updates and a set of deleted ids), so the rows are
+merged in a single pass, however many rows and version records there are.
+"""
+
+
+def OverlayVersionRows(rows, update_table, delete_table, filter_matches, key_range=None):
+  """Returns list of dicts, the rows with the version updates and deletes applied.
+  
+  Updates are applied over the matching rows (which are dropped if they no longer match the filter), version records
+  that are not in the rows are added if they match the filter, and deleted records are dropped.
+  
+  Args:
+    rows: list of dicts, the table rows.  Rows with updates are updated in place.
+    update_table: dict, key is record id, value is dict of the updated fields
+    delete_table: list (or dict or set) of record ids that are deleted
+    filter_matches: function, matches(record) -> boolean, from CompileFilter() with the rows' filter data
+    key_range: tuple (default None), (key, after, upto), only add version records with key greater than after and
+        less than or equal to upto.  None for after or upto is unbounded.  Used for pages of rows.
+  
+  Returns: list of dicts
+  """
+  delete_ids = set(delete_table or [])
+  
+  if not update_table:
+    update_table = {}
+  
+  # Nothing to change
+  if not update_table and not delete_ids:
+    return list(rows)
+  
+  result = []
+  row_ids = set()
+  
+  # Apply the updates and deletes to the rows we have
+  for row in rows:
+    row_ids.add(row['id'])
+    
+    if row['id'] in delete_ids:
+      continue
+    
+    if row['id'] in update_table:
+      row.update(update_table[row['id']])
+      
+      if not filter_matches(row):
+        continue
+    
+    result.append(row)
+  
+  # Add any version records that arent in the rows, but match
+  for (record_id, item) in update_table.iteritems():
+    if record_id in row_ids or record_id in delete_ids:
+      continue
+    
+    # Copy the record, so we dont change the version data.  The id is not stored in it, as it doesnt change.
+    record = dict(item)
+    record['id'] = record_id
+    
+    if key_range and not InKeyRange(record, key_range):
+      continue
+    
+    if filter_matches(record):
+      result.append(record)
+  
+  return result
+
+
+def InKeyRange(record, key_range):
+  """Returns boolean, True if the record's key is inside key_range: (key, after, upto).  None is unbounded."""
+  (range_key, range_after, range_upto) = key_range
+  
+  if range_key not in record:
+    return False
+  if range_after != None and not record[range_key] > range_after:
+    return False
+  if range_upto != None and not record[range_key] <= range_upto:
+    return False
+  
+  return True
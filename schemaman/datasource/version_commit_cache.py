@@ -0,0 +1,88 @@
+"""
+Version Commit Cache for SchemaMan
+
+Thread safe.  Caches the parsed version data of version_commit rows, so reading a committed version with
+version_number doesnt fetch and decode the same `data_yaml`, `delete_data_yaml` and `rollback_data_yaml` every time.
+
+Committed versions dont change after CommitVersionRecordToDatasource() has written their final data and rollback
+data, which invalidates them, so entries have no TTL.  The cache is bounded, and the least recently used entries are
+dropped first.
+
+The cached data is shared by all readers, and must not be changed.
+"""
+
+
+import collections
+import threading
+
+
+# Most version_commit rows to keep parsed, over all datasources
+VERSION_COMMIT_CACHE_SIZE = 256
+
+# Parsed version commit data, in least recently used order: key is (datasource alias, version_commit_id), value is
+#   (update_data, delete_data, rollback_data)
+VERSION_COMMIT_CACHE = collections.OrderedDict()
+VERSION_COMMIT_CACHE_LOCK = threading.Lock()
+
+
+def Get(request, version_commit_id):
+  """Returns tuple of (dict, dict, dict), the shared parsed (update_data, delete_data, rollback_data) of a version_commit
+  row, or None if it isnt cached.
+  """
+  cache_key = (request.connection_data['alias'], version_commit_id)
+  
+  try:
+    VERSION_COMMIT_CACHE_LOCK.acquire()
+  
+    version_data = VERSION_COMMIT_CACHE.pop(cache_key, None)
+  
+    # Put it back at the end, as the most recently used
+    if version_data != None:
+      VERSION_COMMIT_CACHE[cache_key] = version_data
+  
+  finally:
+    VERSION_COMMIT_CACHE_LOCK.release()
+  
+  return version_data
+
+
+def Set(request, version_commit_id, version_data):
+  """Cache the parsed (update_data, delete_data, rollback_data) of a version_commit row.  The caller must not change
+  them after this.
+  """
+  cache_key = (request.connection_data['alias'], version_commit_id)
+  
+  try:
+    VERSION_COMMIT_CACHE_LOCK.acquire()
+  
+    VERSION_COMMIT_CACHE.pop(cache_key, None)
+    VERSION_COMMIT_CACHE[cache_key] = version_data
+  
+    # Drop the least recently used entries, until we are back in our size
+    while len(VERSION_COMMIT_CACHE) > VERSION_COMMIT_CACHE_SIZE:
+      VERSION_COMMIT_CACHE.popitem(last=False)
+  
+  finally:
+    VERSION_COMMIT_CACHE_LOCK.release()
+
+
+def Invalidate(request, version_commit_id):
+  """Remove a version_commit row's cached data"""
+  try:
+    VERSION_COMMIT_CACHE_LOCK.acquire()
+  
+    VERSION_COMMIT_CACHE.pop((request.connection_data['alias'], version_commit_id), None)
+  
+  finally:
+    VERSION_COMMIT_CACHE_LOCK.release()
+
+
+def Clear():
+  """Remove all cached version commit data"""
+  try:
+    VERSION_COMMIT_CACHE_LOCK.acquire()
+  
+    VERSION_COMMIT_CACHE.clear()
+  
+  finally:
+    VERSION_COMMIT_CACHE_LOCK.release()
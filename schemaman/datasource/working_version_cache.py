@@ -0,0 +1,162 @@
+"""
+Working Version Cache for SchemaMan
+
+Thread safe.  Caches the parsed version data of each user's version_working row, so reading with
+use_working_version=True doesnt decode the same `data_yaml` and `delete_data_yaml` on every Get() and Filter().
+
+Each user has one entry, stored with a hash of the row's encoded data it was parsed from.  The row is still read every
+time, but it is only decoded again when its content changes, so writes from other processes are never missed.  Our own
+writes (SetVersion, DeleteVersion, SetWorkingVersionData, AbandonWorkingVersion) store the data they wrote, so the next
+read doesnt decode it either.
+
+Callers that only read the data can ask for the shared cached data.  Everyone else gets a copy, which they can change.
+"""
+
+
+import hashlib
+import threading
+
+import tools
+
+
+# Parsed working version data: key is (datasource alias, user_id), value is (content key, (update_data, delete_data))
+WORKING_VERSION_CACHE = {}
+WORKING_VERSION_CACHE_LOCK = threading.Lock()
+
+# Levels of containers in version data: update data is schema_id -> schema_table_id -> record_id -> record dict, and
+#   delete data is schema_id -> schema_table_id -> list of record_ids.  Values inside the last level are not copied.
+UPDATE_DATA_DEPTH = 4
+DELETE_DATA_DEPTH = 3
+
+
+def GetContentKey(data_yaml, delete_data_yaml):
+  """Returns string, hash of the encoded version data of a version_working row"""
+  content_hash = hashlib.sha1()
+  
+  for text in (data_yaml, delete_data_yaml):
+    # None and empty are different: an empty string is still data that was stored
+    if text == None:
+      content_hash.update('0:')
+    else:
+      if type(text) == unicode:
+        text = text.encode('utf-8')
+  
+      content_hash.update('%d:' % len(text))
+      content_hash.update(text)
+  
+  return content_hash.hexdigest()
+
+
+def LoadWorkingVersionData(request, user_id, data_yaml, delete_data_yaml, shared=False):
+  """Returns tuple of (dict, dict), the parsed (update_data, delete_data) of a user's version_working row.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    user_id: int, user.id of the version_working row
+    data_yaml: string, the row's `data_yaml` field
+    delete_data_yaml: string, the row's `delete_data_yaml` field
+    shared: boolean (default False), if True return the cached data, which must not be changed.  If False return a
+        copy, which the caller owns.
+  
+  Returns: tuple of (dict, dict), (update_data, delete_data).  Never None, empty data is {}.
+  """
+  cache_key = (request.connection_data['alias'], user_id)
+  content_key = GetContentKey(data_yaml, delete_data_yaml)
+  
+  try:
+    WORKING_VERSION_CACHE_LOCK.acquire()
+  
+    cached = WORKING_VERSION_CACHE.get(cache_key)
+  
+  finally:
+    WORKING_VERSION_CACHE_LOCK.release()
+  
+  # If the row hasnt changed since we parsed it, use what we parsed
+  if cached != None and cached[0] == content_key:
+    version_data = cached[1]
+  
+  else:
+    version_data = (tools.LoadVersionData(data_yaml, {}), tools.LoadVersionData(delete_data_yaml, {}))
+  
+    try:
+      WORKING_VERSION_CACHE_LOCK.acquire()
+  
+      WORKING_VERSION_CACHE[cache_key] = (content_key, version_data)
+  
+    finally:
+      WORKING_VERSION_CACHE_LOCK.release()
+  
+  if shared:
+    return version_data
+  
+  return CopyWorkingVersionData(version_data)
+
+
+def StoreWorkingVersionData(request, user_id, data_yaml, delete_data_yaml, update_data, delete_data):
+  """Cache a copy of version data that was just encoded and written to a user's version_working row.
+  
+  Args:
+    request: Request Object, the connection spec data and user and auth info, etc
+    user_id: int, user.id of the version_working row
+    data_yaml: string, the `data_yaml` that was written
+    delete_data_yaml: string, the `delete_data_yaml` that was written
+    update_data: dict, the data that was encoded into data_yaml
+    delete_data: dict, the data that was encoded into delete_data_yaml
+  """
+  cache_key = (request.connection_data['alias'], user_id)
+  content_key = GetContentKey(data_yaml, delete_data_yaml)
+  
+  # Copy it, the caller still owns what they wrote
+  version_data = CopyWorkingVersionData((update_data or {}, delete_data or {}))
+  
+  try:
+    WORKING_VERSION_CACHE_LOCK.acquire()
+  
+    WORKING_VERSION_CACHE[cache_key] = (content_key, version_data)
+  
+  finally:
+    WORKING_VERSION_CACHE_LOCK.release()
+
+
+def Invalidate(request, user_id):
+  """Remove a user's cached working version data"""
+  try:
+    WORKING_VERSION_CACHE_LOCK.acquire()
+  
+    WORKING_VERSION_CACHE.pop((request.connection_data['alias'], user_id), None)
+  
+  finally:
+    WORKING_VERSION_CACHE_LOCK.release()
+
+
+def Clear():
+  """Remove all cached working version data"""
+  try:
+    WORKING_VERSION_CACHE_LOCK.acquire()
+  
+    WORKING_VERSION_CACHE.clear()
+  
+  finally:
+    WORKING_VERSION_CACHE_LOCK.release()
+
+
+def CopyWorkingVersionData(version_data):
+  """Returns tuple of (dict, dict), a copy of (update_data, delete_data), down to the record dicts and record_id lists"""
+  (update_data, delete_data) = version_data
+  
+  return (CopyVersionContainers(update_data, UPDATE_DATA_DEPTH), CopyVersionContainers(delete_data, DELETE_DATA_DEPTH))
+
+
+def CopyVersionContainers(data, depth):
+  """Returns a copy of depth levels of nested version data containers.  Values inside the last level (record fields,
+  record_ids) are not copied, as they are never changed in place.
+  """
+  if depth <= 1 or not isinstance(data, dict):
+    if isinstance(data, dict):
+      return dict(data)
+    elif isinstance(data, list):
+      return list(data)
+    else:
+      return data
+  
+  return dict([(key, CopyVersionContainers(value, depth - 1)) for (key, value) in data.iteritems()])
@@ -35,10 +35,10 @@ def Main(args=None):
     args = []
 
   
-  long_options = ['dir=', 'verbose', 'help', 'yes']
+  long_options = ['dir=', 'verbose', 'help', 'yes', 'gzip', 'parallel=']
   
   try:
-    (options, args) = getopt.getopt(args, '?hvyd:', long_options)
+    (options, args) = getopt.getopt(args, '?hvyzd:p:', long_options)
   except getopt.GetoptError, e:
     Usage(e)
   
@@ -46,6 +46,8 @@ def Main(args=None):
   command_options = {}
   command_options['verbose'] = False
   command_options['always_yes'] = False
+  command_options['gzip'] = False
+  command_options['parallel'] = 1
   
   
   # Process out CLI options
@@ -62,6 +64,17 @@ def Main(args=None):
     elif option in ('-y', '--yes'):
       command_options['always_yes'] = True
     
+    # Gzip compress data files we write
+    elif option in ('-z', '--gzip'):
+      command_options['gzip'] = True
+    
+    # Number of parallel workers for data export/import
+    elif option in ('-p', '--parallel'):
+      try:
+        command_options['parallel'] = int(value)
+      except ValueError, e:
+        Usage('Parallel workers must be an integer: %s' % value)
+    
     # Invalid option
     else:
       Usage('Unknown option: %s' % option)
@@ -3,3 +3,4 @@ import path
 import interactive_input
 import error
 import data_control
+import worker_pool
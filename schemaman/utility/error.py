@@ -41,8 +41,9 @@ def Usage(error=None):
   output += '  schema create <schema>                     Create a schema interactively\n'
   output += '  schema export <schema> <source>            Export a database schema from a source\n'
   output += '  schema update <schema> <source> <target>   Migrate schema/data from source to target\n'
-  output += '  data export <schema> <source>              Export all the data from the schema/source\n'
-  output += '  data import <schema> <source>              Import data into the schema/source\n'
+  output += '  data export <schema> <path>                Export all the data from the schema to a directory\n'
+  output += '  data import <schema> <path>                Import data into the schema from a directory\n'
+  output += '  data migrate <source> <target> [<path>]    Copy all the data from source to target, resumable\n'
   output += '\n'
   output += 'Primary Data Actions:\n'
   output += '\n'
@@ -55,12 +56,16 @@ def Usage(error=None):
   output += '\n'
   output += '  action config version_change_management <target_schema>  Configure Version and Change Management\n'
   output += '  action populate schema_into_db <target_schema>           Populate Schema Into DB\n'
+  output += '  action test benchmark_version_codec [<records> ...]       Benchmark version data encoding\n'
+  output += '  action test tools                                        Run the datasource tools unit tests\n'
   output += '\n'
   output += 'Options:\n'
   output += '\n'
   output += '  -d <path>, --dir=<path>             Directory for SchemaMan data/conf/schemas\n'
   output += '                                          (Default is current working directory)\n'
   output += '  -y, --yes                           Answer Yes to all prompts\n'
+  output += '  -z, --gzip                          Gzip compress exported data files\n'
+  output += '  -p <count>, --parallel=<count>      Number of parallel workers for data export/import\n'
   output += '\n'
   output += '  -h, -?, --help                      This usage information\n'
   output += '  -v, --verbose                       Verbose output\n'
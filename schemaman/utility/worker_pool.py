@@ -0,0 +1,85 @@
+"""
+Worker Pool
+
+Run a list of tasks over a fixed number of worker threads.  Each worker can set up its own context (such as a
+datasource Request, which holds its own pooled connection), which is passed to every task it runs.
+"""
+
+
+import threading
+import Queue
+
+from log import Log
+
+
+class WorkerFailed(Exception):
+  """A task in the worker pool raised an exception."""
+
+
+def RunWorkerPool(function, task_args_list, worker_count, worker_setup=None, worker_teardown=None):
+  """Run function once for each args tuple in task_args_list, spread over worker_count threads.
+  
+  Once any task fails no more tasks are started, and WorkerFailed is raised after the running tasks finish.
+  
+  Args:
+    function: function, called as function(context, *task_args) for each task
+    task_args_list: list of tuples, the args for each task
+    worker_count: int, number of worker threads to run.  Never more than the number of tasks.
+    worker_setup: function (default None), called once in each worker thread, returns the context passed to
+        function.  If None, the context is None.
+    worker_teardown: function (default None), called with the context once a worker thread is done
+  
+  Returns: list, the results of each task, in the same order as task_args_list
+  """
+  results = [None] * len(task_args_list)
+  errors = []
+  
+  # Queue up all our tasks, with their position so we can store their results in order
+  task_queue = Queue.Queue()
+  for (position, task_args) in enumerate(task_args_list):
+    task_queue.put((position, task_args))
+  
+  
+  def Worker():
+    """Process tasks from the queue until it is empty, or a task has failed"""
+    context = None
+  
+    try:
+      if worker_setup:
+        context = worker_setup()
+  
+      while not errors:
+        try:
+          (position, task_args) = task_queue.get_nowait()
+        except Queue.Empty:
+          break
+  
+        results[position] = function(context, *task_args)
+  
+    except Exception, e:
+      Log('Worker Pool: Task failed: %s' % e)
+      errors.append(e)
+  
+    finally:
+      if worker_teardown and context != None:
+        worker_teardown(context)
+  
+  
+  # Dont start more workers than we have tasks
+  worker_count = max(1, min(worker_count, len(task_args_list)))
+  
+  threads = []
+  for count in range(0, worker_count):
+    thread = threading.Thread(target=Worker)
+    thread.daemon = True
+    thread.start()
+    threads.append(thread)
+  
+  # Wait for all our workers to finish
+  for thread in threads:
+    thread.join()
+  
+  if errors:
+    raise WorkerFailed('%s task(s) failed, first failure: %s' % (len(errors), errors[0]))
+  
+  return results